@@ -0,0 +1,29 @@
+"""Unique natural key index on observations
+
+Revision ID: 2d4f1b6e9c3
+Revises: 375e15ea383
+Create Date: 2014-10-06 11:02:41.518204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2d4f1b6e9c3'
+down_revision = '375e15ea383'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Remove any duplicate observations keeping the earliest inserted
+    op.execute(
+        'DELETE FROM observations a USING observations b '
+        'WHERE a.link_id = b.link_id AND a.type = b.type '
+        'AND a.observed_at = b.observed_at AND a.id > b.id'
+    )
+    op.create_index('ix_observation_link_id_type_observed_at', 'observations',
+            ['link_id', 'type', 'observed_at'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_observation_link_id_type_observed_at', table_name='observations')
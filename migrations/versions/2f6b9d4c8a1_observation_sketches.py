@@ -0,0 +1,39 @@
+"""observation sketches
+
+Revision ID: 2f6b9d4c8a1
+Revises: 5c8f1a3d9e4
+Create Date: 2014-10-16 10:05:52.119384
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2f6b9d4c8a1'
+down_revision = '5c8f1a3d9e4'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# The observation_types enum already exists
+observation_types = postgresql.ENUM('SPEED', 'FLOW', 'OCCUPANCY',
+        name='observation_types', create_type=False)
+
+def upgrade():
+    op.create_table('observation_sketches',
+    sa.Column('link_id', sa.Integer(), nullable=False),
+    sa.Column('type', observation_types, nullable=False),
+    sa.Column('bucket', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('means', postgresql.ARRAY(sa.Float()), nullable=False),
+    sa.Column('weights', postgresql.ARRAY(sa.Integer()), nullable=False),
+    sa.ForeignKeyConstraint(['link_id'], ['links.id'], ),
+    sa.PrimaryKeyConstraint('link_id', 'type', 'bucket')
+    )
+    op.create_index('ix_observation_sketches_bucket', 'observation_sketches', ['bucket'], unique=False)
+
+    # As for rollups, use "webapp rollups rebuild" to compute sketches for
+    # existing observations.
+
+
+def downgrade():
+    op.drop_index('ix_observation_sketches_bucket', 'observation_sketches')
+    op.drop_table('observation_sketches')
@@ -0,0 +1,33 @@
+"""observation_stats table
+
+Revision ID: 3e9b5d1f7a2
+Revises: 51c7e3a9f02
+Create Date: 2014-10-13 11:38:04.672931
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3e9b5d1f7a2'
+down_revision = '51c7e3a9f02'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('observation_stats',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('earliest', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('latest', sa.DateTime(timezone=True), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+    # Seed statistics from existing observations
+    op.execute(
+        'INSERT INTO observation_stats (id, earliest, latest) '
+        'SELECT 1, min(observed_at), max(observed_at) FROM observations'
+    )
+
+
+def downgrade():
+    op.drop_table('observation_stats')
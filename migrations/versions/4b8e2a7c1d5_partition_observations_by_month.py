@@ -0,0 +1,108 @@
+"""Partition observations by month
+
+Revision ID: 4b8e2a7c1d5
+Revises: 2d4f1b6e9c3
+Create Date: 2014-10-08 09:47:13.220518
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4b8e2a7c1d5'
+down_revision = '2d4f1b6e9c3'
+
+from alembic import op
+import sqlalchemy as sa
+
+INDEXES = (
+    ('ix_observation_observed_at', 'observed_at', False),
+    ('ix_observation_observed_at_link_id', 'observed_at, link_id', False),
+    ('ix_observation_link_id_type_observed_at', 'link_id, type, observed_at', True),
+)
+
+def rename_indexes(suffix_from, suffix_to):
+    for name, _, _ in INDEXES:
+        op.execute('ALTER INDEX {0}{1} RENAME TO {0}{2}'.format(name, suffix_from, suffix_to))
+
+def create_indexes():
+    for name, columns, unique in INDEXES:
+        op.execute('CREATE {0}INDEX {1} ON observations ({2})'.format(
+            'UNIQUE ' if unique else '', name, columns))
+
+def upgrade():
+    # Move the existing table out of the way
+    op.execute('ALTER TABLE observations RENAME TO observations_unpartitioned')
+    op.execute('ALTER TABLE observations_unpartitioned '
+               'RENAME CONSTRAINT observations_pkey TO observations_unpartitioned_pkey')
+    rename_indexes('', '_unpartitioned')
+
+    # Create the partitioned table. The partition key must form part of the
+    # primary key.
+    op.execute(
+        'CREATE TABLE observations ('
+        '    id integer NOT NULL DEFAULT nextval(\'observations_id_seq\'),'
+        '    value double precision NOT NULL,'
+        '    type observation_types NOT NULL,'
+        '    observed_at timestamp with time zone NOT NULL,'
+        '    link_id integer NOT NULL REFERENCES links (id),'
+        '    PRIMARY KEY (id, observed_at)'
+        ') PARTITION BY RANGE (observed_at)'
+    )
+    op.execute('CREATE TABLE observations_default PARTITION OF observations DEFAULT')
+    create_indexes()
+
+    # Create a partition for each month with data and for the current and next
+    # months
+    op.execute(
+        'DO $$ '
+        'DECLARE month timestamp; '
+        'BEGIN '
+        '    FOR month IN '
+        '        SELECT DISTINCT date_trunc(\'month\', observed_at AT TIME ZONE \'UTC\') '
+        '        FROM observations_unpartitioned '
+        '        UNION SELECT date_trunc(\'month\', now() AT TIME ZONE \'UTC\') '
+        '        UNION SELECT date_trunc(\'month\', now() AT TIME ZONE \'UTC\') + interval \'1 month\' '
+        '    LOOP '
+        '        EXECUTE format('
+        '            \'CREATE TABLE %I PARTITION OF observations '
+        '              FOR VALUES FROM (%L) TO (%L)\','
+        '            \'observations_y\' || to_char(month, \'YYYY"m"MM\'),'
+        '            month AT TIME ZONE \'UTC\','
+        '            (month + interval \'1 month\') AT TIME ZONE \'UTC\''
+        '        ); '
+        '    END LOOP; '
+        'END $$'
+    )
+
+    # Copy data and transfer ownership of the id sequence
+    op.execute(
+        'INSERT INTO observations (id, value, type, observed_at, link_id) '
+        'SELECT id, value, type, observed_at, link_id FROM observations_unpartitioned'
+    )
+    op.execute('ALTER SEQUENCE observations_id_seq OWNED BY observations.id')
+    op.execute('DROP TABLE observations_unpartitioned')
+
+
+def downgrade():
+    op.execute('ALTER TABLE observations RENAME TO observations_partitioned')
+    rename_indexes('', '_partitioned')
+
+    op.execute(
+        'CREATE TABLE observations ('
+        '    id integer NOT NULL DEFAULT nextval(\'observations_id_seq\'),'
+        '    value double precision NOT NULL,'
+        '    type observation_types NOT NULL,'
+        '    observed_at timestamp with time zone NOT NULL,'
+        '    link_id integer NOT NULL REFERENCES links (id),'
+        '    CONSTRAINT observations_pkey PRIMARY KEY (id)'
+        ')'
+    )
+    create_indexes()
+
+    op.execute(
+        'INSERT INTO observations (id, value, type, observed_at, link_id) '
+        'SELECT id, value, type, observed_at, link_id FROM observations_partitioned'
+    )
+    op.execute('ALTER SEQUENCE observations_id_seq OWNED BY observations.id')
+
+    # Dropping the partitioned table drops all of its partitions
+    op.execute('DROP TABLE observations_partitioned')
@@ -0,0 +1,40 @@
+"""latest observations
+
+Revision ID: 4d7f2e8b1c3
+Revises: 7e3a5c2b9d6
+Create Date: 2014-10-17 09:26:41.337052
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4d7f2e8b1c3'
+down_revision = '7e3a5c2b9d6'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# The observation_types enum already exists
+observation_types = postgresql.ENUM('SPEED', 'FLOW', 'OCCUPANCY',
+        name='observation_types', create_type=False)
+
+def upgrade():
+    op.create_table('latest_observations',
+    sa.Column('link_id', sa.Integer(), nullable=False),
+    sa.Column('type', observation_types, nullable=False),
+    sa.Column('observed_at', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('value', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['link_id'], ['links.id'], ),
+    sa.PrimaryKeyConstraint('link_id', 'type')
+    )
+
+    # Seed from existing observations
+    op.execute(
+        'INSERT INTO latest_observations (link_id, type, observed_at, value) '
+        'SELECT DISTINCT ON (link_id, type) link_id, type, observed_at, value '
+        'FROM observations ORDER BY link_id, type, observed_at DESC'
+    )
+
+
+def downgrade():
+    op.drop_table('latest_observations')
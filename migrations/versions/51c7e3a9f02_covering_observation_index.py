@@ -0,0 +1,31 @@
+"""Covering index for per-link observation queries
+
+Revision ID: 51c7e3a9f02
+Revises: 4b8e2a7c1d5
+Create Date: 2014-10-09 14:21:55.803127
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '51c7e3a9f02'
+down_revision = '4b8e2a7c1d5'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Including value allows per-link observation queries to be answered by
+    # an index-only scan. The index replaces the natural key index since it
+    # enforces the same uniqueness.
+    op.execute(
+        'CREATE UNIQUE INDEX ix_observation_link_id_type_observed_at_value '
+        'ON observations (link_id, type, observed_at) INCLUDE (value)'
+    )
+    op.drop_index('ix_observation_link_id_type_observed_at', table_name='observations')
+
+
+def downgrade():
+    op.create_index('ix_observation_link_id_type_observed_at', 'observations',
+            ['link_id', 'type', 'observed_at'], unique=True)
+    op.drop_index('ix_observation_link_id_type_observed_at_value', table_name='observations')
@@ -0,0 +1,49 @@
+"""observation rollups
+
+Revision ID: 5c8f1a3d9e4
+Revises: 3e9b5d1f7a2
+Create Date: 2014-10-15 14:21:37.804316
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5c8f1a3d9e4'
+down_revision = '3e9b5d1f7a2'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# The observation_types enum already exists
+observation_types = postgresql.ENUM('SPEED', 'FLOW', 'OCCUPANCY',
+        name='observation_types', create_type=False)
+
+def upgrade():
+    op.create_table('observation_rollups',
+    sa.Column('resolution', sa.Integer(), nullable=False),
+    sa.Column('link_id', sa.Integer(), nullable=False),
+    sa.Column('type', observation_types, nullable=False),
+    sa.Column('bucket', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.Column('sum', sa.Float(), nullable=False),
+    sa.Column('min', sa.Float(), nullable=False),
+    sa.Column('max', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['link_id'], ['links.id'], ),
+    sa.PrimaryKeyConstraint('resolution', 'link_id', 'type', 'bucket')
+    )
+    op.create_index('ix_observation_rollups_bucket', 'observation_rollups', ['bucket'], unique=False)
+    op.create_table('observation_rollup_dirty',
+    sa.Column('link_id', sa.Integer(), nullable=False),
+    sa.Column('type', observation_types, nullable=False),
+    sa.Column('bucket', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('link_id', 'type', 'bucket')
+    )
+
+    # Rollups for existing observations are not computed here since doing so
+    # may take some time. Use "webapp rollups rebuild" after upgrading.
+
+
+def downgrade():
+    op.drop_table('observation_rollup_dirty')
+    op.drop_index('ix_observation_rollups_bucket', 'observation_rollups')
+    op.drop_table('observation_rollups')
@@ -0,0 +1,27 @@
+"""change versions
+
+Revision ID: 6a2c4e8f1b9
+Revises: 4d7f2e8b1c3
+Create Date: 2014-10-20 11:02:17.518264
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6a2c4e8f1b9'
+down_revision = '4d7f2e8b1c3'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('change_versions',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('version', sa.BigInteger(), nullable=False),
+    sa.Column('modified_at', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    op.drop_table('change_versions')
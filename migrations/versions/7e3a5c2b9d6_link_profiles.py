@@ -0,0 +1,78 @@
+"""link profiles
+
+Revision ID: 7e3a5c2b9d6
+Revises: 2f6b9d4c8a1
+Create Date: 2014-10-16 16:42:18.530127
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7e3a5c2b9d6'
+down_revision = '2f6b9d4c8a1'
+
+from alembic import op
+from flask import current_app
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# Rollup resolutions in seconds from finest to coarsest
+RESOLUTIONS = (5*60, 60*60, 24*60*60)
+
+# The observation_types enum already exists
+observation_types = postgresql.ENUM('SPEED', 'FLOW', 'OCCUPANCY',
+        name='observation_types', create_type=False)
+
+def upgrade():
+    # Compute sums of squares for existing rollups from observations at the
+    # finest resolution and from finer rollups otherwise
+    op.add_column('observation_rollups', sa.Column('sum_sq', sa.Float(), nullable=True))
+    op.execute(
+        'UPDATE observation_rollups r SET sum_sq = s.sum_sq FROM ('
+        '    SELECT link_id, type, to_timestamp(floor(extract(epoch FROM observed_at) / {0}) * {0}) AS bucket,'
+        '        sum(value * value) AS sum_sq'
+        '    FROM observations GROUP BY 1, 2, 3'
+        ') s WHERE r.resolution = {0} AND r.link_id = s.link_id AND r.type = s.type '
+        'AND r.bucket = s.bucket'.format(RESOLUTIONS[0])
+    )
+    for finer, coarser in zip(RESOLUTIONS[:-1], RESOLUTIONS[1:]):
+        op.execute(
+            'UPDATE observation_rollups r SET sum_sq = s.sum_sq FROM ('
+            '    SELECT link_id, type, to_timestamp(floor(extract(epoch FROM bucket) / {1}) * {1}) AS bucket,'
+            '        sum(sum_sq) AS sum_sq'
+            '    FROM observation_rollups WHERE resolution = {0} GROUP BY 1, 2, 3'
+            ') s WHERE r.resolution = {1} AND r.link_id = s.link_id AND r.type = s.type '
+            'AND r.bucket = s.bucket'.format(finer, coarser)
+        )
+
+    # Rollups whose observations have since been removed cannot be recovered
+    op.execute('UPDATE observation_rollups SET sum_sq = 0 WHERE sum_sq IS NULL')
+    op.alter_column('observation_rollups', 'sum_sq', nullable=False)
+
+    op.create_table('link_profiles',
+    sa.Column('link_id', sa.Integer(), nullable=False),
+    sa.Column('type', observation_types, nullable=False),
+    sa.Column('slot', sa.SmallInteger(), autoincrement=False, nullable=False),
+    sa.Column('count', sa.BigInteger(), nullable=False),
+    sa.Column('sum', sa.Float(), nullable=False),
+    sa.Column('sum_sq', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['link_id'], ['links.id'], ),
+    sa.PrimaryKeyConstraint('link_id', 'type', 'slot')
+    )
+
+    # Build profiles from the finest rollups in 15 minute slots of the week
+    # starting at midnight on Monday in local time
+    op.get_bind().execute(sa.text(
+        'INSERT INTO link_profiles (link_id, type, slot, count, sum, sum_sq) '
+        'SELECT link_id, type, '
+        '    (CAST(extract(isodow FROM bucket AT TIME ZONE :timezone) AS integer) - 1) * 96 + '
+        '    CAST(extract(hour FROM bucket AT TIME ZONE :timezone) AS integer) * 4 + '
+        '    CAST(extract(minute FROM bucket AT TIME ZONE :timezone) AS integer) / 15, '
+        '    sum(count), sum(sum), sum(sum_sq) '
+        'FROM observation_rollups WHERE resolution = :resolution '
+        'GROUP BY 1, 2, 3'
+    ), timezone=current_app.config.get('PROFILE_TIMEZONE', 'UTC'), resolution=RESOLUTIONS[0])
+
+
+def downgrade():
+    op.drop_table('link_profiles')
+    op.drop_column('observation_rollups', 'sum_sq')
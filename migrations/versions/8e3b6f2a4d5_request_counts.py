@@ -0,0 +1,28 @@
+"""request counts
+
+Revision ID: 8e3b6f2a4d5
+Revises: 6a2c4e8f1b9
+Create Date: 2014-10-21 15:37:48.203615
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8e3b6f2a4d5'
+down_revision = '6a2c4e8f1b9'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('request_counts',
+    sa.Column('url_root', sa.String(), nullable=False),
+    sa.Column('full_path', sa.String(), nullable=False),
+    sa.Column('accept', sa.String(), nullable=False),
+    sa.Column('count', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('url_root', 'full_path', 'accept')
+    )
+
+
+def downgrade():
+    op.drop_table('request_counts')
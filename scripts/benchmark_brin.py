@@ -0,0 +1,115 @@
+# This script should be run via "webapp shell" and the "%run" magic
+#
+# Compare the size and range scan latency of a B-tree index and a BRIN index
+# on observation times. A separate benchmark_observations table is populated
+# with time-ordered synthetic observations so that the observations table is
+# not modified. The number of rows may be set via the BENCHMARK_ROWS
+# environment variable and defaults to just over 100 million.
+#
+# Generating the data set takes some time and requires around 10GB of disk.
+import datetime
+import os
+import time
+
+from trafficdb.models import *
+
+LINK_COUNT = 1000
+ROW_COUNT = int(os.environ.get('BENCHMARK_ROWS', 100800000))
+REPEATS = 5
+START = datetime.datetime(2014, 1, 1)
+
+BTREE_INDEX = 'ix_benchmark_observed_at'
+BRIN_INDEX = 'ix_benchmark_observed_at_brin'
+
+# Range widths to benchmark
+WINDOWS = (
+    ('1 hour', datetime.timedelta(hours=1)),
+    ('1 day', datetime.timedelta(days=1)),
+    ('7 days', datetime.timedelta(days=7)),
+)
+
+def create_benchmark_table():
+    minutes = ROW_COUNT // LINK_COUNT
+    print('Creating {0} rows ({1} links for {2} minutes)...'.format(
+        minutes * LINK_COUNT, LINK_COUNT, minutes))
+    db.session.execute('DROP TABLE IF EXISTS benchmark_observations')
+    db.session.execute(
+        'CREATE TABLE benchmark_observations ('
+        '    link_id integer NOT NULL,'
+        '    observed_at timestamp with time zone NOT NULL,'
+        '    value double precision NOT NULL'
+        ')'
+    )
+
+    # Rows are inserted in time order as they would be by a feed collector
+    db.session.execute(
+        'INSERT INTO benchmark_observations (link_id, observed_at, value) '
+        'SELECT l, CAST(:start AS timestamptz) + m * interval \'1 minute\', random() * 100 '
+        'FROM generate_series(0, :minutes - 1) m, generate_series(1, :links) l '
+        'ORDER BY m, l',
+        dict(start=START.isoformat() + '+00:00', minutes=minutes, links=LINK_COUNT))
+
+    print('Creating indexes...')
+    db.session.execute(
+        'CREATE INDEX ' + BTREE_INDEX + ' ON benchmark_observations (observed_at)')
+    db.session.execute(
+        'CREATE INDEX ' + BRIN_INDEX + ' ON benchmark_observations USING brin (observed_at)')
+    db.session.execute('ANALYZE benchmark_observations')
+    db.session.commit()
+
+def index_size(name):
+    return db.session.execute(
+        'SELECT pg_size_pretty(pg_relation_size(CAST(:name AS regclass)))',
+        dict(name=name)).scalar()
+
+def time_range_scan(window, only_index):
+    """Return the median time in milliseconds of a range scan over window
+    when only the index only_index is available.
+
+    """
+    timings = []
+    for _ in range(REPEATS):
+        # Temporarily drop the other index. DDL is transactional and so the
+        # index is restored on rollback.
+        other_index = BRIN_INDEX if only_index == BTREE_INDEX else BTREE_INDEX
+        db.session.execute('DROP INDEX ' + other_index)
+        db.session.execute('SET LOCAL enable_seqscan = off')
+
+        start = START + datetime.timedelta(days=1)
+        then = time.time()
+        db.session.execute(
+            'SELECT count(*), avg(value) FROM benchmark_observations '
+            'WHERE observed_at >= :start AND observed_at < :end',
+            dict(start=start.isoformat() + '+00:00',
+                 end=(start + window).isoformat() + '+00:00')).fetchall()
+        timings.append(1000.0 * (time.time() - then))
+
+        db.session.rollback()
+
+    timings.sort()
+    return timings[len(timings) // 2]
+
+# Rollback any incomplete session
+db.session.rollback()
+
+# Remember echo state
+prev_echo = db.engine.echo
+db.engine.echo = False
+
+create_benchmark_table()
+
+print('Index sizes:')
+print('  B-tree: {0}'.format(index_size(BTREE_INDEX)))
+print('  BRIN:   {0}'.format(index_size(BRIN_INDEX)))
+
+print('Median range scan latency over {0} runs:'.format(REPEATS))
+for label, window in WINDOWS:
+    btree_ms = time_range_scan(window, BTREE_INDEX)
+    brin_ms = time_range_scan(window, BRIN_INDEX)
+    print('  {0:>8}: B-tree {1:10.1f}ms, BRIN {2:10.1f}ms'.format(label, btree_ms, brin_ms))
+
+print('Dropping benchmark table')
+db.session.execute('DROP TABLE benchmark_observations')
+db.session.commit()
+
+db.engine.echo = prev_echo
@@ -0,0 +1,106 @@
+# This script should be run via "webapp shell" and the "%run" magic
+#
+# Benchmark whole-network snapshots, i.e. the last observation of each link
+# and type at or before a time, over a synthetic network. A separate
+# benchmark_snapshot_observations table is populated with one observation per
+# minute for each link and type so that the observations table is not
+# modified. The number of links may be set via the BENCHMARK_LINKS
+# environment variable and defaults to 50,000.
+#
+# The DISTINCT ON query used by the /network/snapshot endpoint is compared
+# with a LATERAL join probing the natural key index once per link and type.
+import datetime
+import os
+import time
+
+from trafficdb.models import *
+
+LINK_COUNT = int(os.environ.get('BENCHMARK_LINKS', 50000))
+MINUTES = 60
+REPEATS = 5
+START = datetime.datetime(2014, 1, 1)
+
+# Snapshot time and tolerance
+AT = START + datetime.timedelta(minutes=MINUTES-1, seconds=30)
+TOLERANCE = datetime.timedelta(minutes=15)
+
+QUERIES = (
+    ('DISTINCT ON',
+        'SELECT DISTINCT ON (link_id, type) link_id, type, observed_at, value '
+        'FROM benchmark_snapshot_observations '
+        'WHERE observed_at <= :at AND observed_at > :since '
+        'ORDER BY link_id, type, observed_at DESC'),
+    ('LATERAL',
+        'SELECT k.link_id, k.type, o.observed_at, o.value '
+        'FROM generate_series(1, :links) AS k(link_id) '
+        'CROSS JOIN unnest(enum_range(NULL::observation_types)) AS t(type) '
+        'CROSS JOIN LATERAL ('
+        '    SELECT observed_at, value FROM benchmark_snapshot_observations '
+        '    WHERE link_id = k.link_id AND type = t.type '
+        '    AND observed_at <= :at AND observed_at > :since '
+        '    ORDER BY observed_at DESC LIMIT 1'
+        ') o'),
+)
+
+def create_benchmark_table():
+    print('Creating {0} rows ({1} links for {2} minutes)...'.format(
+        LINK_COUNT * MINUTES * 3, LINK_COUNT, MINUTES))
+    db.session.execute('DROP TABLE IF EXISTS benchmark_snapshot_observations')
+    db.session.execute(
+        'CREATE TABLE benchmark_snapshot_observations ('
+        '    link_id integer NOT NULL,'
+        '    type observation_types NOT NULL,'
+        '    observed_at timestamp with time zone NOT NULL,'
+        '    value double precision NOT NULL'
+        ')'
+    )
+    db.session.execute(
+        'INSERT INTO benchmark_snapshot_observations (link_id, type, observed_at, value) '
+        'SELECT l, t, CAST(:start AS timestamptz) + m * interval \'1 minute\', random() * 100 '
+        'FROM generate_series(0, :minutes - 1) m, generate_series(1, :links) l, '
+        '    unnest(enum_range(NULL::observation_types)) t '
+        'ORDER BY m, l',
+        dict(start=START.isoformat() + '+00:00', minutes=MINUTES, links=LINK_COUNT))
+
+    # The same indexes as the observations table
+    print('Creating indexes...')
+    db.session.execute(
+        'CREATE INDEX ix_benchmark_snapshot_observed_at '
+        'ON benchmark_snapshot_observations (observed_at)')
+    db.session.execute(
+        'CREATE UNIQUE INDEX ix_benchmark_snapshot_natural_key '
+        'ON benchmark_snapshot_observations (link_id, type, observed_at) INCLUDE (value)')
+    db.session.execute('ANALYZE benchmark_snapshot_observations')
+    db.session.commit()
+
+def time_query(sql):
+    """Return the median time in milliseconds and the row count of sql."""
+    params = dict(at=AT.isoformat() + '+00:00',
+                  since=(AT - TOLERANCE).isoformat() + '+00:00', links=LINK_COUNT)
+    timings = []
+    for _ in range(REPEATS):
+        then = time.time()
+        rows = db.session.execute(sql, params).fetchall()
+        timings.append(1000.0 * (time.time() - then))
+    timings.sort()
+    return timings[len(timings) // 2], len(rows)
+
+# Rollback any incomplete session
+db.session.rollback()
+
+# Remember echo state
+prev_echo = db.engine.echo
+db.engine.echo = False
+
+create_benchmark_table()
+
+print('Median snapshot latency over {0} runs:'.format(REPEATS))
+for label, sql in QUERIES:
+    ms, count = time_query(sql)
+    print('  {0:>12}: {1:10.1f}ms ({2} rows)'.format(label, ms, count))
+
+print('Dropping benchmark table')
+db.session.execute('DROP TABLE benchmark_snapshot_observations')
+db.session.commit()
+
+db.engine.echo = prev_echo
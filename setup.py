@@ -41,6 +41,9 @@ setup(
     # For documentation
     extras_require={
         'docs': [ 'sphinx', 'docutils', ],
+        'numpy': [ 'numpy', ],
+        'arrow': [ 'numpy', 'pyarrow', ],
+        'memcached': [ 'pymemcache', ],
     },
 
     # Scripts and utilities
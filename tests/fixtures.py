@@ -8,7 +8,9 @@ import mixer.generators as mxgen
 import pytz
 from six.moves import range
 
+from trafficdb.ingest import copy_observations
 from trafficdb.models import *
+from trafficdb.rollups import refresh_rollups
 
 log = logging.getLogger(__name__)
 
@@ -57,7 +59,7 @@ def create_fake_observations(link_count=3, start=DEFAULT_START, duration=60*3, n
     mixer = Mixer(commit=False)
 
     # Extract ids
-    link_ids = set(db.session.query(Link.id))
+    link_ids = set(r[0] for r in db.session.query(Link.id))
 
     # A set of observation times
     obs_times = []
@@ -72,16 +74,10 @@ def create_fake_observations(link_count=3, start=DEFAULT_START, duration=60*3, n
                 Observation, type=type_, link_id=link_id,
                 observed_at=(t for t in obs_times)))
     log.info('Adding {0} observation(s) to database'.format(len(obs)))
-    # For bulk inserts, the following is more efficient than, e.g.,
-    # db.session.add_all(obs)
-    obs_values = list(
-        {
-            'value': o.value, 'type': o.type,
-            'observed_at': o.observed_at, 'link_id': o.link_id,
-        }
-        for o in obs
-    )
-    db.session.execute(Observation.__table__.insert(obs_values))
+    # Load observations via the same bulk COPY path used by the API
+    copy_observations(db.session,
+        ((o.link_id, o.type, o.observed_at, o.value) for o in obs))
+    refresh_rollups(db.session)
 
 def create_fake_link_aliases(alias_count=10):
     """Create a set of fake aliases for links.
@@ -1,8 +1,10 @@
+from collections import OrderedDict
 import datetime
+import json
 import logging
 
 from sqlalchemy import func
-from trafficdb.blueprint.api import PAGE_LIMIT
+from trafficdb.blueprint.api import PAGE_LIMIT, STREAM_BATCH_SIZE, iter_json
 from trafficdb.models import *
 
 from .fixtures import (
@@ -25,3 +27,31 @@ class TestApiRoot(TestCase):
         resources = response.json['resources']
         self.assertIn('links', resources)
         self.assertIn('linkAliases', resources)
+
+class TestIterJson(TestCase):
+    def test_plain_values(self):
+        for obj in (None, 1, 'foo', [1, 2, 3], dict(a=[1, 2])):
+            self.assertEqual(json.loads(''.join(iter_json(obj))), obj)
+
+    def test_empty_generator(self):
+        values = (v for v in [])
+        self.assertEqual(json.loads(''.join(iter_json(values))), [])
+
+    def test_generator_batches(self):
+        n_values = 2*STREAM_BATCH_SIZE + 3
+        values = ([idx, 0.5*idx] for idx in range(n_values))
+        pieces = list(iter_json(values))
+        self.assertGreater(len(pieces), 3)
+        self.assertEqual(json.loads(''.join(pieces)),
+                list([idx, 0.5*idx] for idx in range(n_values)))
+
+    def test_values_after_generator(self):
+        # Values after a generator are encoded once it is exhausted
+        page = dict(count=0)
+        def values():
+            for idx in range(5):
+                page['count'] += 1
+                yield idx
+        obj = OrderedDict((('values', values()), ('page', page)))
+        self.assertEqual(json.loads(''.join(iter_json(obj))),
+                dict(values=list(range(5)), page=dict(count=5)))
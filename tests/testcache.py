@@ -0,0 +1,135 @@
+from trafficdb.cache import *
+
+class FakeMemcachedClient(object):
+    """A stand-in for a memcached client holding values in a dictionary."""
+    def __init__(self):
+        self.values = {}
+        self.expires = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, expire=0):
+        assert len(key) <= 250 and ' ' not in key
+        self.values[key] = value
+        self.expires[key] = expire
+
+def test_lru_get_set():
+    cache = LRUCache(100)
+    assert cache.get('a') is None
+    cache.set('a', b'12345')
+    assert cache.get('a') == b'12345'
+    cache.set('a', b'678')
+    assert cache.get('a') == b'678'
+    assert len(cache) == 1
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(10)
+    cache.set('a', b'1234')
+    cache.set('b', b'1234')
+    assert cache.get('a') == b'1234'
+    cache.set('c', b'1234')
+
+    # b was least recently used
+    assert cache.get('b') is None
+    assert cache.get('a') == b'1234'
+    assert cache.get('c') == b'1234'
+
+def test_lru_too_large():
+    cache = LRUCache(10)
+    cache.set('a', b'1234')
+    cache.set('b', b'x' * 11)
+    assert cache.get('b') is None
+    assert cache.get('a') == b'1234'
+
+def test_lru_clear():
+    cache = LRUCache(10)
+    cache.set('a', b'1234')
+    cache.clear()
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+def test_memcached():
+    client = FakeMemcachedClient()
+    cache = MemcachedCache(client, 60)
+    key = u'http://localhost/\napi.links\ncount=20 and some spaces\n' + 'x' * 300
+    assert cache.get(key) is None
+    cache.set(key, b'1234')
+    assert cache.get(key) == b'1234'
+    assert list(client.expires.values()) == [60]
+
+class BrokenMemcachedClient(object):
+    """A stand-in for a memcached client whose server is unreachable."""
+    def get(self, key):
+        raise IOError('connection refused')
+
+    def set(self, key, value, expire=0):
+        raise IOError('connection refused')
+
+def test_memcached_fails_open():
+    cache = MemcachedCache(BrokenMemcachedClient(), 60)
+    cache.set('a', b'1234')
+    assert cache.get('a') is None
+
+    cache = TieredCache([LRUCache(100), cache])
+    cache.set('a', b'1234')
+    assert cache.get('a') == b'1234'
+
+def test_tiered_fills_earlier_caches():
+    local = LRUCache(100)
+    shared = MemcachedCache(FakeMemcachedClient(), 60)
+    cache = TieredCache([local, shared])
+
+    shared.set('a', b'1234')
+    assert local.get('a') is None
+    assert cache.get('a') == b'1234'
+    assert local.get('a') == b'1234'
+
+    cache.set('b', b'5678')
+    assert local.get('b') == b'5678'
+    assert shared.get('b') == b'5678'
+
+def test_create_response_cache():
+    config = dict(RESPONSE_CACHE_SIZE=100, RESPONSE_CACHE_MEMCACHED_SERVERS=[],
+            RESPONSE_CACHE_MEMCACHED_TTL=60)
+    assert isinstance(create_response_cache(config), LRUCache)
+    config['RESPONSE_CACHE_SIZE'] = 0
+    assert create_response_cache(config) is None
+
+def test_link_id_cache_get_set():
+    cache = LinkIdCache(10, 60)
+    assert cache.get('a') is None
+    cache.set('a', (1, 'a'))
+    assert cache.get('a') == (1, 'a')
+    cache.invalidate('a')
+    assert cache.get('a') is None
+
+def test_link_id_cache_not_found():
+    cache = LinkIdCache(10, 60)
+    cache.set('a', None)
+    assert cache.get('a') is NOT_FOUND
+
+    # Creating the link makes it visible at once
+    cache.invalidate('a')
+    assert cache.get('a') is None
+
+def test_link_id_cache_not_found_expires():
+    cache = LinkIdCache(10, 0)
+    cache.set('a', None)
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+def test_link_id_cache_evicts_least_recently_used():
+    cache = LinkIdCache(2, 60)
+    cache.set('a', (1, 'a'))
+    cache.set('b', (2, 'b'))
+    assert cache.get('a') == (1, 'a')
+    cache.set('c', (3, 'c'))
+    assert cache.get('b') is None
+    assert cache.get('a') == (1, 'a')
+    assert cache.get('c') == (3, 'c')
+
+def test_link_id_cache_disabled():
+    cache = LinkIdCache(0, 60)
+    cache.set('a', (1, 'a'))
+    assert cache.get('a') is None
@@ -0,0 +1,73 @@
+import threading
+import time
+
+from trafficdb.coalesce import *
+from trafficdb.models import db
+
+from .util import TestCase
+
+def test_single_flight_uncontended():
+    flights = SingleFlight()
+    assert not flights.acquire('a')
+    assert not flights.acquire('b')
+    assert len(flights) == 2
+    flights.release('a')
+    flights.release('b')
+    assert len(flights) == 0
+
+def test_single_flight_waits():
+    flights = SingleFlight()
+    events = []
+
+    def follower():
+        waited = flights.acquire('a')
+        events.append(('follower', waited))
+        flights.release('a')
+
+    assert not flights.acquire('a')
+    thread = threading.Thread(target=follower)
+    thread.start()
+
+    # The follower cannot proceed until the key is released
+    time.sleep(0.1)
+    events.append(('leader', False))
+    flights.release('a')
+    thread.join()
+
+    assert events == [('leader', False), ('follower', True)]
+    assert len(flights) == 0
+
+def test_advisory_lock_key():
+    key = advisory_lock_key(u'http://localhost/\napi.observations')
+    assert key == advisory_lock_key(u'http://localhost/\napi.observations')
+    assert key != advisory_lock_key(u'http://localhost/\napi.links')
+    assert -(1 << 63) <= key < (1 << 63)
+
+class TestAdvisoryLock(TestCase):
+    def test_acquire_release(self):
+        lock = AdvisoryLock(db.engine, 'a')
+        self.assertFalse(lock.acquire())
+        lock.release()
+        self.assertFalse(lock.acquire())
+        lock.release()
+
+        # Releasing an unheld lock does nothing
+        lock.release()
+
+    def test_waits(self):
+        leader = AdvisoryLock(db.engine, 'a')
+        self.assertFalse(leader.acquire())
+
+        waited = []
+        def follower():
+            lock = AdvisoryLock(db.engine, 'a')
+            waited.append(lock.acquire())
+            lock.release()
+        thread = threading.Thread(target=follower)
+        thread.start()
+
+        time.sleep(0.1)
+        self.assertEqual(waited, [])
+        leader.release()
+        thread.join()
+        self.assertEqual(waited, [True])
@@ -0,0 +1,37 @@
+from nose.plugins.skip import SkipTest
+from nose.tools import raises
+from trafficdb.downsample import *
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def setup():
+    if np is None:
+        raise SkipTest('NumPy is not installed')
+
+def test_short_series_unchanged():
+    indices = lttb_indices([0, 1, 2, 3], [5, 6, 7, 8], 10)
+    assert list(indices) == [0, 1, 2, 3]
+
+def test_point_count():
+    x = np.arange(1000)
+    indices = lttb_indices(x, np.sin(x / 50.0), 100)
+    assert len(indices) == 100
+    assert indices[0] == 0
+    assert indices[-1] == 999
+    assert np.all(np.diff(indices) > 0)
+
+def test_spike_preserved():
+    x = np.arange(1000)
+    y = np.zeros(1000)
+    y[437] = 100.0
+    y[811] = -100.0
+    indices = lttb_indices(x, y, 20)
+    assert 437 in indices
+    assert 811 in indices
+
+@raises(ValueError)
+def test_too_few_points():
+    lttb_indices([0, 1, 2, 3], [0, 1, 2, 3], 2)
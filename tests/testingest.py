@@ -0,0 +1,153 @@
+import datetime
+import logging
+
+from nose.tools import raises
+import pytz
+from trafficdb.ingest import *
+from trafficdb.models import *
+
+from .fixtures import create_fake_links
+from .util import TestCase, raises_integrity_error
+
+log = logging.getLogger(__name__)
+
+class TestCopyObservations(TestCase):
+    START_DATE = datetime.datetime(2013, 9, 10, tzinfo=pytz.utc)
+
+    @classmethod
+    def create_fixtures(cls):
+        create_fake_links(link_count=5)
+
+    def make_rows(self, count=20):
+        link_ids = list(r[0] for r in db.session.query(Link.id))
+        rows = []
+        for idx in range(count):
+            rows.append((
+                link_ids[idx % len(link_ids)], ObservationType.SPEED,
+                self.START_DATE + datetime.timedelta(minutes=idx), float(idx)
+            ))
+        return rows
+
+    def test_copy_nothing(self):
+        self.assertEqual(copy_observations(db.session, []), 0)
+        self.assertEqual(db.session.query(Observation.id).count(), 0)
+
+    def test_copy(self):
+        rows = self.make_rows()
+        self.assertEqual(copy_observations(db.session, rows), len(rows))
+        self.assertEqual(db.session.query(Observation.id).count(), len(rows))
+
+        for link_id, type, observed_at, value in rows:
+            obs = db.session.query(Observation).\
+                    filter_by(link_id=link_id, type=type, observed_at=observed_at).one()
+            self.assertEqual(obs.value, value)
+
+    def test_stats_updated(self):
+        rows = self.make_rows()
+        copy_observations(db.session, rows)
+        earliest, latest = db.session.query(
+                ObservationStats.earliest, ObservationStats.latest).one()
+        self.assertEqual(earliest, min(r[2] for r in rows))
+        self.assertEqual(latest, max(r[2] for r in rows))
+
+        # Stats should be widened by later ingest
+        later = self.START_DATE + datetime.timedelta(days=10)
+        copy_observations(db.session, [(rows[0][0], ObservationType.FLOW, later, 1.0)])
+        earliest, latest = db.session.query(
+                ObservationStats.earliest, ObservationStats.latest).one()
+        self.assertEqual(earliest, min(r[2] for r in rows))
+        self.assertEqual(latest, later)
+
+    def test_refresh_stats(self):
+        rows = self.make_rows()
+        copy_observations(db.session, rows)
+        db.session.query(Observation).filter(Observation.observed_at == rows[0][2]).delete()
+        refresh_observation_stats(db.session)
+        earliest, _ = db.session.query(ObservationStats.earliest, ObservationStats.latest).one()
+        self.assertEqual(earliest, rows[1][2])
+
+    def test_latest_updated(self):
+        rows = self.make_rows()
+        copy_observations(db.session, rows)
+        latest = db.session.query(LatestObservation).all()
+        self.assertEqual(len(latest), len(set(r[0] for r in rows)))
+        for l in latest:
+            link_rows = list(r for r in rows if r[0] == l.link_id)
+            self.assertEqual(l.observed_at, max(r[2] for r in link_rows))
+            self.assertEqual(l.value, max(link_rows, key=lambda r: r[2])[3])
+
+        # Earlier observations do not replace the latest
+        link_id = rows[0][0]
+        before = db.session.query(LatestObservation).filter_by(link_id=link_id).one().observed_at
+        copy_observations(db.session, [(link_id, ObservationType.SPEED,
+            self.START_DATE - datetime.timedelta(days=1), 100.0)])
+        after = db.session.query(LatestObservation).filter_by(link_id=link_id).one().observed_at
+        self.assertEqual(before, after)
+
+    def test_staging_table_emptied(self):
+        rows = self.make_rows()
+        copy_observations(db.session, rows)
+        self.assertEqual(merge_staged_observations(db.session), 0)
+        self.assertEqual(db.session.query(Observation.id).count(), len(rows))
+
+class TestConflictPolicies(TestCase):
+    START_DATE = datetime.datetime(2013, 9, 10, tzinfo=pytz.utc)
+
+    @classmethod
+    def create_fixtures(cls):
+        create_fake_links(link_count=1)
+
+    def setUp(self):
+        super(TestConflictPolicies, self).setUp()
+        self.link_id = db.session.query(Link.id).limit(1).one()[0]
+
+    def make_row(self, value):
+        return (self.link_id, ObservationType.SPEED, self.START_DATE, value)
+
+    def stored_values(self):
+        return list(r[0] for r in db.session.query(Observation.value))
+
+    def test_keep_first(self):
+        self.assertEqual(copy_observations(db.session, [self.make_row(1.0)]), 1)
+        self.assertEqual(copy_observations(db.session,
+            [self.make_row(2.0), self.make_row(3.0)], on_conflict=KEEP_FIRST), 0)
+        self.assertEqual(self.stored_values(), [1.0])
+
+    def test_keep_first_within_ingest(self):
+        copy_observations(db.session,
+            [self.make_row(2.0), self.make_row(3.0)], on_conflict=KEEP_FIRST)
+        self.assertEqual(self.stored_values(), [2.0])
+
+    def test_overwrite(self):
+        copy_observations(db.session, [self.make_row(1.0)])
+        self.assertEqual(copy_observations(db.session,
+            [self.make_row(2.0), self.make_row(3.0)], on_conflict=OVERWRITE), 1)
+        self.assertEqual(self.stored_values(), [3.0])
+
+    def latest_value(self):
+        return db.session.query(LatestObservation.value).\
+                filter_by(link_id=self.link_id, type=ObservationType.SPEED).scalar()
+
+    def test_latest_keep_first(self):
+        copy_observations(db.session, [self.make_row(1.0)])
+        copy_observations(db.session, [self.make_row(2.0)], on_conflict=KEEP_FIRST)
+        self.assertEqual(self.latest_value(), 1.0)
+
+    def test_latest_overwrite(self):
+        copy_observations(db.session, [self.make_row(1.0)])
+        copy_observations(db.session, [self.make_row(2.0)], on_conflict=OVERWRITE)
+        self.assertEqual(self.latest_value(), 2.0)
+
+    def test_overwrite_same_value(self):
+        copy_observations(db.session, [self.make_row(1.0)])
+        self.assertEqual(copy_observations(db.session,
+            [self.make_row(1.0)], on_conflict=OVERWRITE), 0)
+
+    @raises_integrity_error
+    def test_reject(self):
+        copy_observations(db.session, [self.make_row(1.0)])
+        copy_observations(db.session, [self.make_row(2.0)], on_conflict=REJECT)
+
+    @raises(ValueError)
+    def test_unknown_policy(self):
+        copy_observations(db.session, [self.make_row(1.0)], on_conflict='bogus')
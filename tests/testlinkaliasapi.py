@@ -330,3 +330,17 @@ class TestMutation(TestCase):
         log.info('Sending create request: {0}'.format(create))
         response = self.new_alias_request(dict(create=create))
         self.verify_create(create, response)
+
+    def test_create_changes_only_aliased_link_etag(self):
+        links = self.parse_links_response(self.get_links(count=2))[2]
+        urls = list(strip_url(l['properties']['url']) for l in links)
+        etags = list(self.client.get(url).headers['ETag'] for url in urls)
+
+        create = [dict(name='new-alias', link=links[0]['id'])]
+        self.verify_create(create, self.new_alias_request(dict(create=create)))
+
+        response = self.client.get(urls[0], headers={'If-None-Match': etags[0]})
+        self.assert_200(response)
+        self.assertIn('new-alias', response.json['properties']['aliases'])
+        response = self.client.get(urls[1], headers={'If-None-Match': etags[1]})
+        self.assertEqual(response.status_code, 304)
@@ -3,7 +3,8 @@ import json
 import logging
 
 from sqlalchemy import func
-from trafficdb.blueprint.api import PAGE_LIMIT
+from trafficdb.blueprint.api import PAGE_LIMIT, urlsafe_id_to_uuid
+from trafficdb.cache import NOT_FOUND
 from trafficdb.models import *
 
 from .fixtures import (
@@ -47,6 +48,18 @@ class TestIndex(TestCase):
         self.assertEqual(len(links), 0)
         self.assertNotIn('next', page)
 
+    def test_links_response_is_streamed(self):
+        response = self.client.get(API_PREFIX + '/links/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.mimetype, 'application/json')
+
+    def test_links_not_modified(self):
+        response = self.client.get(API_PREFIX + '/links/')
+        etag = response.headers['ETag']
+        response = self.client.get(API_PREFIX + '/links/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
     def test_integer_from(self):
         log.info('Querying page with integer from')
         response = self.get_links(from_=0)
@@ -154,6 +167,26 @@ class TestSingleLink(TestCase):
         response = self.client.get(url)
         self.assertEqual(response.status_code, 404)
 
+    def test_non_existant_link_is_cached(self):
+        url = strip_url(API_PREFIX + '/links/{0}/'.format('X'*22))
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+        link_id_cache = self.app.extensions['link_id_cache']
+        self.assertIs(link_id_cache.get(urlsafe_id_to_uuid('X'*22)), NOT_FOUND)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_link_is_cached(self):
+        link_feature = self.get_links(count=1).json['features'][0]
+        url = strip_url(link_feature['properties']['url'])
+        self.assert_200(self.client.get(url))
+
+        link_id_cache = self.app.extensions['link_id_cache']
+        link_uuid = urlsafe_id_to_uuid(link_feature['id'])
+        row = link_id_cache.get(link_uuid)
+        self.assertIsNotNone(row)
+        self.assertIsNot(row, NOT_FOUND)
+        self.assert_200(self.client.get(url))
+
     def test_link_information_query(self):
         log.info('Querying first link')
         link_feature = self.get_links(count=1).json['features'][0]
@@ -246,6 +279,20 @@ class TestMutation(TestCase):
         response = self.new_link_request(dict(create=create))
         self.verify_create(create, response)
 
+    def test_create_changes_etag(self):
+        etag = self.client.get(API_PREFIX + '/links/').headers['ETag']
+        create = [
+            {
+                'coordinates': [[-3, 46], [-2,47], [-1,48]],
+            },
+        ]
+        response = self.new_link_request(dict(create=create))
+        self.verify_create(create, response)
+
+        response = self.client.get(API_PREFIX + '/links/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
     def test_create_multiple(self):
         create = [
             { 'coordinates': [[-3, 46], [-2,47], [-1,48]], },
@@ -1,16 +1,58 @@
+import datetime
+import sys
+
 try:
     from unittest.mock import patch, Mock
 except ImportError:
     # Py <3.3 compatibility
     from mock import patch, Mock
 
-from trafficdb.manager import create_manager, main
+import pytz
+import six
+from sqlalchemy import func
+from trafficdb.ingest import copy_observations
+from trafficdb.manager import (
+        BrinIndexCommand,
+        BuildProfilesCommand,
+        CreatePartitionsCommand,
+        RebuildRollupsCommand,
+        RefreshRollupsCommand,
+        RetainCommand,
+        WarmCacheCommand,
+        create_manager,
+        main,
+)
+from trafficdb.models import *
+from trafficdb.partitions import (
+        BRIN_INDEX,
+        add_months,
+        create_observation_partitions,
+        month_start,
+        observation_partitions,
+        partition_name,
+)
+from trafficdb.rollups import RESOLUTIONS
+from trafficdb.versions import HISTORY, get_versions
+from trafficdb.warming import store_request_counts
+
+from .fixtures import create_fake_observations
+from .util import ApiTestCase as TestCase, API_PREFIX
+
+# Sub-commands registered by create_manager()
+COMMANDS = (
+    ('db', 'partition'),
+    ('db', 'retain'),
+    ('db', 'brin'),
+    ('rollups', 'rebuild'),
+    ('rollups', 'refresh'),
+    ('profiles', 'build'),
+    ('cache', 'warm'),
+)
 
 def test_create_manager():
     manager = create_manager()
     assert manager is not None
 
-    import sys
     new_argv = [sys.argv[0], '--help']
     with patch('sys.argv', new_argv), patch('sys.exit', Mock(side_effect=SystemExit)) as exit_mock:
         try:
@@ -25,7 +67,6 @@ def test_create_manager():
         exit_mock.assert_called_with(0)
 
 def test_main():
-    import sys
     new_argv = [sys.argv[0], '--help']
     with patch('sys.argv', new_argv), patch('sys.exit', Mock(side_effect=SystemExit)) as exit_mock:
         try:
@@ -38,3 +79,161 @@ def test_main():
 
         # Check return value
         exit_mock.assert_called_with(0)
+
+def test_command_help():
+    for command in COMMANDS:
+        yield check_command_help, command
+
+def check_command_help(command):
+    manager = create_manager()
+
+    new_argv = [sys.argv[0]] + list(command) + ['--help']
+    with patch('sys.argv', new_argv), patch('sys.exit', Mock(side_effect=SystemExit)) as exit_mock:
+        try:
+            # Should raise SystemExit
+            manager.run()
+        except SystemExit:
+            pass
+        else:
+            assert False
+
+        # Check return value
+        exit_mock.assert_called_with(0)
+
+class TestCommands(TestCase):
+    START_DATE = datetime.datetime(2013, 4, 29, 22, tzinfo=pytz.utc)
+
+    @classmethod
+    def create_fixtures(cls):
+        create_fake_observations(start=TestCommands.START_DATE, duration=60*4)
+
+    def setUp(self):
+        super(TestCommands, self).setUp()
+
+        # Commands commit their work which would end the per-test transaction
+        self.commit_patch = patch.object(db.session, 'commit', db.session.flush)
+        self.commit_patch.start()
+
+    def tearDown(self):
+        self.commit_patch.stop()
+        super(TestCommands, self).tearDown()
+
+    def run_command(self, command, **kwargs):
+        """Run command returning a (return value, output lines) pair."""
+        with patch('sys.stdout', new_callable=six.StringIO) as stdout:
+            rv = command.run(**kwargs)
+        return rv, stdout.getvalue().splitlines()
+
+    def history_version(self):
+        return get_versions(db.session, [HISTORY])[HISTORY][0]
+
+    def partition_names(self):
+        return list(p[0] for p in observation_partitions(db.session))
+
+    def test_partition(self):
+        # Partitions for the current and next months may have been created by
+        # the migrations
+        start = month_start(datetime.datetime.now(pytz.utc))
+        existing = self.partition_names()
+        expected = list(partition_name(add_months(start, months))
+                for months in range(4))
+
+        _, output = self.run_command(CreatePartitionsCommand(), months=3)
+        self.assertEqual(output, list('Created partition ' + name
+            for name in expected if name not in existing))
+        names = self.partition_names()
+        for name in expected:
+            self.assertIn(name, names)
+
+        # Existing partitions are left alone
+        _, output = self.run_command(CreatePartitionsCommand(), months=3)
+        self.assertEqual(output, [])
+
+    def test_retain(self):
+        create_observation_partitions(db.session, self.START_DATE,
+                self.START_DATE + datetime.timedelta(days=1))
+        obs_count = db.session.query(Observation.id).count()
+        version = self.history_version()
+
+        rv, _ = self.run_command(RetainCommand(),
+                older_than='forever', archive_schema=None, dry_run=False)
+        self.assertEqual(rv, 1)
+
+        # A dry run lists partitions older than the cutoff without detaching
+        _, output = self.run_command(RetainCommand(),
+                older_than='1y', archive_schema=None, dry_run=True)
+        self.assertEqual(output, ['Would detach partition observations_y2013m04'])
+        self.assertEqual(db.session.query(Observation.id).count(), obs_count)
+
+        _, output = self.run_command(RetainCommand(),
+                older_than='1y', archive_schema=None, dry_run=False)
+        self.assertEqual(output, ['Dropped partition observations_y2013m04'])
+        self.assertEqual(db.session.query(Observation.id).count(), 0)
+        self.assertEqual(self.history_version(), version + 1)
+
+    def test_brin(self):
+        def exists():
+            return db.session.execute(
+                'SELECT to_regclass(\'' + BRIN_INDEX + '\')').scalar() is not None
+
+        self.run_command(BrinIndexCommand(), state='off')
+        _, output = self.run_command(BrinIndexCommand(), state='on')
+        self.assertEqual(output, ['Created index ' + BRIN_INDEX])
+        self.assertTrue(exists())
+        _, output = self.run_command(BrinIndexCommand(), state='on')
+        self.assertEqual(output, ['Index {0} is already present'.format(BRIN_INDEX)])
+        _, output = self.run_command(BrinIndexCommand(), state='off')
+        self.assertEqual(output, ['Dropped index ' + BRIN_INDEX])
+        self.assertFalse(exists())
+
+    def test_rollups_refresh(self):
+        _, output = self.run_command(RefreshRollupsCommand())
+        self.assertEqual(output, ['Refreshed 0 bucket(s)'])
+
+        link_id = db.session.query(Link.id).limit(1).one()[0]
+        copy_observations(db.session, [(link_id, ObservationType.SPEED,
+            self.START_DATE + datetime.timedelta(minutes=7), 1000.0)])
+        _, output = self.run_command(RefreshRollupsCommand())
+        self.assertEqual(output, ['Refreshed 1 bucket(s)'])
+        self.assertEqual(db.session.query(ObservationRollupDirty).count(), 0)
+
+    def test_rollups_rebuild(self):
+        rv, _ = self.run_command(RebuildRollupsCommand(),
+                start='yesterday', end='2013-05-01', jobs=1)
+        self.assertEqual(rv, 1)
+
+        # Days are rebuilt, and committed, on connections of their own
+        version = self.history_version()
+        _, output = self.run_command(RebuildRollupsCommand(),
+                start='2013-04-29', end='2013-05-01', jobs=2)
+        self.assertEqual(sorted(output), [
+            'Rebuilt rollups for 2013-04-29', 'Rebuilt rollups for 2013-04-30'])
+        self.assertEqual(self.history_version(), version + 1)
+
+        raw_count = db.session.query(func.count(Observation.value)).scalar()
+        rollup_count = db.session.query(func.sum(ObservationRollup.count)).\
+                filter(ObservationRollup.resolution == RESOLUTIONS[-1]).scalar()
+        self.assertEqual(rollup_count, raw_count)
+
+    def test_profiles_build(self):
+        profile_count = db.session.query(LinkProfile).count()
+        self.assertGreater(profile_count, 0)
+        db.session.query(LinkProfile).delete()
+        version = self.history_version()
+
+        self.run_command(BuildProfilesCommand())
+        self.assertEqual(db.session.query(LinkProfile).count(), profile_count)
+        self.assertEqual(self.history_version(), version + 1)
+
+    def test_cache_warm(self):
+        link_id = self.get_some_link_id()
+        store_request_counts(db.session, {
+            ('http://localhost/', API_PREFIX + '/links/{0}/'.format(link_id), None): 2,
+            ('http://localhost/', API_PREFIX + '/links/nonexistent/', None): 1,
+        })
+
+        _, output = self.run_command(WarmCacheCommand(), count=1)
+        self.assertEqual(output, ['Warmed 1 of 1 request(s)'])
+        with patch.dict(self.app.config, CACHE_WARM_COUNT=10):
+            _, output = self.run_command(WarmCacheCommand(), count=None)
+        self.assertEqual(output, ['Warmed 1 of 2 request(s)'])
@@ -1,9 +1,31 @@
 import datetime
+import io
+import json
 import logging
+try:
+    from unittest.mock import patch
+except ImportError:
+    # Py <3.3 compatibility
+    from mock import patch
+try:
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlencode
 
+from nose.plugins.skip import SkipTest
+import pytz
 from sqlalchemy import func
-from trafficdb.blueprint.api import PAGE_LIMIT
+from trafficdb.blueprint.api import MAX_DURATION, PAGE_LIMIT, get_cached_response
+from trafficdb.columnar import (
+    ARROW_STREAM_MIMETYPE,
+    NPZ_MIMETYPE,
+    arrow_available,
+    columnar_available,
+)
+from trafficdb.downsample import downsampling_available
 from trafficdb.models import *
+from trafficdb.queries import observations_for_link
+from trafficdb.versions import OBSERVATIONS, bump_versions
 
 from .fixtures import (
     create_fake_link_aliases,
@@ -93,3 +115,932 @@ class TestObservations(TestCase):
         new_start = response.json['query']['start'] - response.json['query']['duration']
         response = self.get_observations(link_id, start=new_start)
         self.validate_observations_response(link_id, response)
+
+    def test_observations_for_one_type(self):
+        link_id = self.get_some_link_id()
+        response = self.get_observations(link_id, types='speed')
+        self.validate_observations_response(link_id, response, types=('speed',))
+        self.assertTrue(len(response.json['data']['speed']['values']) > 0)
+
+    def test_observations_for_two_types(self):
+        link_id = self.get_some_link_id()
+        response = self.get_observations(link_id, types='flow,occupancy')
+        self.validate_observations_response(link_id, response, types=('flow', 'occupancy'))
+
+    def test_observations_types_match_single_type_queries(self):
+        link_id = self.get_some_link_id()
+        all_data = self.get_observations(link_id).json['data']
+        for type in ('speed', 'flow', 'occupancy'):
+            data = self.get_observations(link_id, types=type).json['data']
+            self.assertEqual(data[type]['values'], all_data[type]['values'])
+
+    def test_observations_bad_type(self):
+        link_id = self.get_some_link_id()
+        response = self.get_observations(link_id, types='speed,bogus')
+        self.assert_400(response)
+
+class TestObservationRollups(TestCase):
+    START_DATE = datetime.datetime(2013, 9, 10, tzinfo=pytz.utc)
+
+    @classmethod
+    def create_fixtures(cls):
+        create_fake_observations(
+            link_count=2, start=TestObservationRollups.START_DATE, duration=3*24*60)
+
+    def start_ts(self):
+        return int((self.START_DATE - datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)).\
+            total_seconds() * 1000)
+
+    def test_raw_by_default(self):
+        link_id = self.get_some_link_id()
+        response = self.get_observations(link_id)
+        self.validate_observations_response(link_id, response)
+        self.assertIsNone(response.json['query']['resolution'])
+
+    def test_hourly_resolution(self):
+        link_id = self.get_some_link_id()
+        response = self.get_observations(link_id, start=self.start_ts(),
+                duration=24*60*60*1000, resolution=3600)
+        self.validate_observations_response(link_id, response)
+        self.assertEqual(response.json['query']['resolution'], 3600)
+
+        for type, v in response.json['data'].items():
+            self.assertEqual(len(v['values']), 24)
+            self.assertEqual(len(v['ranges']), 24)
+            for (ts, mean), (range_ts, min_value, max_value) in zip(v['values'], v['ranges']):
+                self.assertEqual(ts % (3600*1000), 0)
+                self.assertEqual(ts, range_ts)
+                self.assertTrue(min_value <= mean <= max_value)
+
+    def test_coarsest_satisfying_resolution(self):
+        link_id = self.get_some_link_id()
+        response = self.get_observations(link_id, resolution=2*60*60)
+        self.assertEqual(response.json['query']['resolution'], 3600)
+
+    def test_fine_resolution_is_raw(self):
+        link_id = self.get_some_link_id()
+        response = self.get_observations(link_id, resolution=60)
+        self.assert_200(response)
+        self.assertIsNone(response.json['query']['resolution'])
+
+    def test_max_points(self):
+        link_id = self.get_some_link_id()
+        response = self.get_observations(link_id, start=self.start_ts(),
+                duration=3*24*60*60*1000, max_points=100)
+        self.validate_observations_response(link_id, response)
+        self.assertEqual(response.json['query']['resolution'], 3600)
+        for v in response.json['data'].values():
+            self.assertTrue(len(v['values']) <= 100)
+
+    def test_max_points_default_duration(self):
+        link_id = self.get_some_link_id()
+        response = self.get_observations(link_id, max_points=1000)
+        self.validate_observations_response(link_id, response)
+        self.assertEqual(response.json['query']['resolution'], 300)
+        self.assertEqual(response.json['query']['duration'], MAX_DURATION)
+        for v in response.json['data'].values():
+            self.assertTrue(len(v['values']) <= 1000)
+
+    def test_max_points_raw(self):
+        link_id = self.get_some_link_id()
+        response = self.get_observations(link_id, start=self.start_ts(),
+                duration=60*60*1000, max_points=100)
+        self.validate_observations_response(link_id, response)
+        self.assertIsNone(response.json['query']['resolution'])
+        for v in response.json['data'].values():
+            self.assertEqual(len(v['values']), 5)
+
+    def test_coarse_resolution_lifts_duration_limit(self):
+        link_id = self.get_some_link_id()
+        duration = 30*24*60*60*1000
+        response = self.get_observations(link_id, start=self.start_ts(),
+                duration=duration, resolution=86400)
+        self.validate_observations_response(link_id, response)
+        self.assertEqual(response.json['query']['duration'], duration)
+        for v in response.json['data'].values():
+            self.assertEqual(len(v['values']), 3)
+
+        response = self.get_observations(link_id, start=self.start_ts(), duration=duration)
+        self.assertEqual(response.json['query']['duration'], MAX_DURATION)
+
+    def test_means_match_raw(self):
+        link_id = self.get_some_link_id()
+        duration = 60*60*1000
+        raw = self.get_observations(link_id, start=self.start_ts(),
+                duration=duration-1, types='speed').json['data']['speed']['values']
+        rollup = self.get_observations(link_id, start=self.start_ts(),
+                duration=duration, types='speed', resolution=3600).json['data']['speed']['values']
+        self.assertEqual(len(rollup), 1)
+        self.assertAlmostEqual(rollup[0][1], sum(v for _, v in raw) / len(raw))
+
+    def test_bad_resolution(self):
+        link_id = self.get_some_link_id()
+        self.assert_400(self.get_observations(link_id, resolution='hourly'))
+        self.assert_400(self.get_observations(link_id, resolution=0))
+        self.assert_400(self.get_observations(link_id, max_points=-1))
+        self.assert_400(self.get_observations(link_id, resolution=3600, max_points=100))
+
+class TestDownsampledObservations(TestCase):
+    @classmethod
+    def create_fixtures(cls):
+        create_fake_observations(link_count=2, duration=3*24*60)
+
+    def setUp(self):
+        super(TestDownsampledObservations, self).setUp()
+        if not downsampling_available():
+            raise SkipTest('NumPy is not installed')
+
+    def test_lttb(self):
+        link_id = self.get_some_link_id()
+        raw = self.get_observations(link_id).json['data']
+        response = self.get_observations(link_id, downsample='lttb', points=50)
+        self.validate_observations_response(link_id, response)
+        self.assertEqual(response.json['query']['downsample'], 'lttb')
+        self.assertEqual(response.json['query']['points'], 50)
+
+        for type, v in response.json['data'].items():
+            self.assertEqual(len(v['values']), 50)
+
+            # Selected points are a subset of the raw points including the
+            # extremes
+            raw_values = raw[type]['values']
+            for point in v['values']:
+                self.assertIn(point, raw_values)
+            self.assertEqual(v['values'][0], raw_values[0])
+            self.assertEqual(v['values'][-1], raw_values[-1])
+
+    def test_lttb_rollups(self):
+        link_id = self.get_some_link_id()
+        response = self.get_observations(link_id, resolution=300, downsample='lttb', points=20)
+        self.validate_observations_response(link_id, response)
+        for v in response.json['data'].values():
+            self.assertEqual(len(v['values']), 20)
+            self.assertEqual(list(r[0] for r in v['ranges']), list(p[0] for p in v['values']))
+
+    def test_bad_downsample(self):
+        link_id = self.get_some_link_id()
+        self.assert_400(self.get_observations(link_id, downsample='average', points=50))
+        self.assert_400(self.get_observations(link_id, downsample='lttb'))
+        self.assert_400(self.get_observations(link_id, downsample='lttb', points=2))
+        self.assert_400(self.get_observations(link_id, downsample='lttb', points='many'))
+
+class TestColumnarObservations(TestCase):
+    @classmethod
+    def create_fixtures(cls):
+        create_fake_observations(link_count=2, duration=3*24*60)
+
+    def setUp(self):
+        super(TestColumnarObservations, self).setUp()
+        if not columnar_available():
+            raise SkipTest('NumPy is not installed')
+
+    def load_npz(self, response):
+        import numpy as np
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, NPZ_MIMETYPE)
+        return np.load(io.BytesIO(response.data))
+
+    def test_json_is_default(self):
+        link_id = self.get_some_link_id()
+        for accept in (None, '*/*', 'application/json, {0};q=0.5'.format(NPZ_MIMETYPE)):
+            headers = {'Accept': accept} if accept is not None else None
+            response = self.get_observations(link_id, headers=headers)
+            self.validate_observations_response(link_id, response)
+
+    def test_npz(self):
+        link_id = self.get_some_link_id()
+        raw = self.get_observations(link_id).json['data']
+        arrays = self.load_npz(self.get_observations(link_id, headers={'Accept': NPZ_MIMETYPE}))
+
+        for type, v in raw.items():
+            timestamps = arrays[type + '_timestamp']
+            values = arrays[type + '_value']
+            self.assertEqual(timestamps.dtype.kind, 'i')
+            self.assertEqual(values.dtype.kind, 'f')
+            self.assertEqual(list(zip(timestamps.tolist(), values.tolist())),
+                    list(tuple(p) for p in v['values']))
+
+    def test_npz_rollups(self):
+        link_id = self.get_some_link_id()
+        rollups = self.get_observations(link_id, resolution=3600).json['data']
+        arrays = self.load_npz(self.get_observations(
+            link_id, resolution=3600, headers={'Accept': NPZ_MIMETYPE}))
+
+        for type, v in rollups.items():
+            self.assertEqual(arrays[type + '_timestamp'].tolist(), list(p[0] for p in v['values']))
+            self.assertEqual(arrays[type + '_min'].tolist(), list(r[1] for r in v['ranges']))
+            self.assertEqual(arrays[type + '_max'].tolist(), list(r[2] for r in v['ranges']))
+            for mean, p in zip(arrays[type + '_value'].tolist(), v['values']):
+                self.assertAlmostEqual(mean, p[1])
+
+    def test_npz_types(self):
+        link_id = self.get_some_link_id()
+        arrays = self.load_npz(self.get_observations(
+            link_id, types='flow', headers={'Accept': NPZ_MIMETYPE}))
+        self.assertEqual(sorted(arrays.files), ['flow_timestamp', 'flow_value'])
+
+    def test_npz_downsampled(self):
+        link_id = self.get_some_link_id()
+        arrays = self.load_npz(self.get_observations(
+            link_id, downsample='lttb', points=50, headers={'Accept': NPZ_MIMETYPE}))
+        for name in arrays.files:
+            self.assertEqual(len(arrays[name]), 50)
+
+    def test_arrow(self):
+        if not arrow_available():
+            raise SkipTest('PyArrow is not installed')
+        import pyarrow as pa
+
+        link_id = self.get_some_link_id()
+        raw = self.get_observations(link_id, types='speed,flow').json['data']
+        response = self.get_observations(
+            link_id, types='speed,flow', headers={'Accept': ARROW_STREAM_MIMETYPE})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, ARROW_STREAM_MIMETYPE)
+
+        reader = pa.ipc.open_stream(response.data)
+        types = json.loads(reader.schema.metadata[b'types'].decode('utf8'))
+        self.assertEqual(types, ['speed', 'flow'])
+        for type, batch in zip(types, reader):
+            self.assertEqual(batch.column(1).to_pylist(),
+                    list(p[1] for p in raw[type]['values']))
+
+class TestConditionalObservations(TestCase):
+    START_TS = 1367193600000 # 2013-04-29T00:00:00Z as a JavaScript timestamp
+
+    @classmethod
+    def create_fixtures(cls):
+        create_fake_observations(link_count=2)
+
+    def get_window(self, link_id, headers=None):
+        return self.get_observations(link_id, start=self.START_TS,
+                duration=60*60*1000, headers=headers)
+
+    def test_cache_headers(self):
+        link_id = self.get_some_link_id()
+        response = self.get_window(link_id)
+        self.validate_observations_response(link_id, response)
+        self.assertIsNotNone(response.headers.get('ETag'))
+        self.assertIsNotNone(response.headers.get('Last-Modified'))
+        self.assertIn('Accept', response.headers.get('Vary'))
+
+        # The window is in the past
+        self.assertTrue(response.cache_control.public)
+        self.assertEqual(response.cache_control.max_age,
+                self.app.config['HISTORICAL_MAX_AGE'])
+
+    def test_recent_window_must_revalidate(self):
+        link_id = self.get_some_link_id()
+        now_ts = int(1000 * (datetime.datetime.utcnow() -
+            datetime.datetime(1970, 1, 1)).total_seconds())
+        response = self.get_observations(link_id, start=now_ts - 60*60*1000, duration=2*60*60*1000)
+        self.validate_observations_response(link_id, response)
+        self.assertTrue(response.cache_control.no_cache)
+        self.assertEqual(response.cache_control.max_age, 0)
+
+    def test_not_modified(self):
+        link_id = self.get_some_link_id()
+        etag = self.get_window(link_id).headers['ETag']
+        response = self.get_window(link_id, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        self.assertEqual(response.headers['ETag'], etag)
+
+    def test_not_modified_since(self):
+        link_id = self.get_some_link_id()
+        last_modified = self.get_window(link_id).headers['Last-Modified']
+        response = self.get_window(link_id, headers={'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 304)
+
+    def test_default_window_modified_by_any_ingest(self):
+        link_id = self.get_some_link_id()
+        last_modified = self.get_observations(link_id).headers['Last-Modified']
+
+        # An ingest of another link moves the default window
+        bump_versions(db.session, [OBSERVATIONS])
+        db.session.query(ChangeVersion).filter(ChangeVersion.name == OBSERVATIONS).\
+                update(dict(modified_at=func.now() + datetime.timedelta(hours=1)),
+                        synchronize_session=False)
+        headers = {'If-Modified-Since': last_modified}
+        self.assert_200(self.get_observations(link_id, headers=headers))
+
+        # A window with an explicit start is not affected
+        window_modified = self.get_window(link_id).headers['Last-Modified']
+        response = self.get_window(link_id, headers={'If-Modified-Since': window_modified})
+        self.assertEqual(response.status_code, 304)
+
+    def test_ingest_changes_etag(self):
+        link_id = self.get_some_link_id()
+        etag = self.get_window(link_id).headers['ETag']
+
+        # Observations of another link do not change the ETag
+        links = self.get_links().json['features']
+        other_link_id = list(l['id'] for l in links if l['id'] != link_id)[0]
+        create = [dict(type='speed', observedAt=self.START_TS + 30*1000, value=1.0)]
+        self.assert_200(self.patch_observations(other_link_id, create))
+        self.assertEqual(self.get_window(link_id).headers['ETag'], etag)
+
+        self.assert_200(self.patch_observations(link_id, create))
+        response = self.get_window(link_id, headers={'If-None-Match': etag})
+        self.validate_observations_response(link_id, response)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_response_cache(self):
+        link_id = self.get_some_link_id()
+        response = self.get_window(link_id)
+        self.validate_observations_response(link_id, response)
+
+        # A repeated request is served from the cache
+        with patch('trafficdb.blueprint.api.observations_for_link') as observations_for_link:
+            cached = self.get_window(link_id)
+        self.assertFalse(observations_for_link.called)
+        self.assertEqual(cached.json, response.json)
+        self.assertEqual(cached.headers['ETag'], response.headers['ETag'])
+
+        # Ingest makes the cached response unreachable
+        create = [dict(type='speed', observedAt=self.START_TS + 30*1000, value=1.0)]
+        self.assert_200(self.patch_observations(link_id, create))
+        response = self.get_window(link_id)
+        self.assertEqual(len(response.json['data']['speed']['values']),
+                len(cached.json['data']['speed']['values']) + 1)
+
+    def test_coalesced_turns_released(self):
+        link_id = self.get_some_link_id()
+        single_flight = self.app.extensions['single_flight']
+        response = self.get_window(link_id)
+        self.validate_observations_response(link_id, response)
+        self.assertEqual(len(single_flight), 0)
+
+    def test_turn_ends_before_response_is_sent(self):
+        link_id = self.get_some_link_id()
+        single_flight = self.app.extensions['single_flight']
+        url = API_PREFIX + '/links/{0}/observations?'.format(link_id) + \
+                urlencode(dict(start=self.START_TS, duration=60*60*1000))
+        response = self.client.get(url, buffered=False)
+        self.assertEqual(len(single_flight), 0)
+        self.assert_200(response)
+        response.close()
+
+    def test_waiter_cache_hit_ends_turn(self):
+        link_id = self.get_some_link_id()
+        single_flight = self.app.extensions['single_flight']
+        self.validate_observations_response(link_id, self.get_window(link_id))
+
+        # A waiter which misses the cache but finds a response cached by the
+        # previous turn ends its turn before the body is sent
+        misses = [None]
+        def get_cached(cache_key):
+            return misses.pop() if misses else get_cached_response(cache_key)
+        acquire = single_flight.acquire
+        url = API_PREFIX + '/links/{0}/observations?'.format(link_id) + \
+                urlencode(dict(start=self.START_TS, duration=60*60*1000))
+        with patch('trafficdb.blueprint.api.get_cached_response', side_effect=get_cached), \
+                patch.object(single_flight, 'acquire',
+                        side_effect=lambda key: acquire(key) or True):
+            response = self.client.get(url, buffered=False)
+        self.assertEqual(len(single_flight), 0)
+        self.assert_200(response)
+
+        # A third identical request which misses the cache goes ahead without
+        # waiting while the waiter's body is still being sent
+        self.app.extensions['response_cache'].clear()
+        waited = []
+        def record_acquire(key):
+            waited.append(acquire(key))
+            return waited[-1]
+        with patch.object(single_flight, 'acquire', side_effect=record_acquire):
+            self.validate_observations_response(link_id, self.get_window(link_id))
+        self.assertEqual(waited, [False])
+        response.close()
+
+    def test_too_large_response_ends_turn(self):
+        link_id = self.get_some_link_id()
+        single_flight = self.app.extensions['single_flight']
+        with patch.dict(self.app.config, RESPONSE_CACHE_MAX_ITEM_SIZE=10):
+            response = self.get_window(link_id)
+            self.validate_observations_response(link_id, response)
+            self.assertEqual(len(single_flight), 0)
+
+            # The response was not cached
+            with patch('trafficdb.blueprint.api.observations_for_link',
+                    wraps=observations_for_link) as wrapped:
+                self.assertEqual(self.get_window(link_id).json, response.json)
+            self.assertTrue(wrapped.called)
+
+    def test_representations_differ(self):
+        if not columnar_available():
+            raise SkipTest('NumPy is not installed')
+        link_id = self.get_some_link_id()
+        etag = self.get_window(link_id).headers['ETag']
+        response = self.get_window(link_id, headers={'Accept': NPZ_MIMETYPE})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+        response = self.get_window(link_id,
+                headers={'Accept': NPZ_MIMETYPE, 'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+class TestQuantiles(TestCase):
+    START_DATE = datetime.datetime(2013, 9, 10, tzinfo=pytz.utc)
+
+    @classmethod
+    def create_fixtures(cls):
+        create_fake_observations(
+            link_count=2, start=TestQuantiles.START_DATE, duration=2*24*60)
+
+    def get_quantiles(self, link_id, **query):
+        url = API_PREFIX + '/links/{0}/quantiles'.format(link_id)
+        if len(query) > 0:
+            url += '?' + urlencode(query)
+        log.info('GET {0}'.format(url))
+        return self.client.get(url)
+
+    def test_default_quantiles(self):
+        link_id = self.get_some_link_id()
+        response = self.get_quantiles(link_id)
+        self.assert_200(response)
+        self.assertEqual(response.json['link']['id'], link_id)
+        self.assertEqual(response.json['query']['q'], [0.5, 0.85, 0.95])
+        self.assertEqual(set(response.json['data'].keys()), set(('speed', 'flow', 'occupancy')))
+
+    def test_quantiles_match_raw(self):
+        link_id = self.get_some_link_id()
+        start_ts = int((self.START_DATE - datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)).\
+            total_seconds() * 1000)
+        duration = 2*24*60*60*1000
+        response = self.get_quantiles(link_id, start=start_ts, duration=duration,
+                types='speed', q='0,0.5,1')
+        self.assert_200(response)
+        data = response.json['data']['speed']
+
+        raw = sorted(v for _, v in self.get_observations(link_id, start=start_ts,
+            duration=duration-1, types='speed').json['data']['speed']['values'])
+        self.assertEqual(data['count'], len(raw))
+
+        quantiles = dict(data['quantiles'])
+        self.assertAlmostEqual(quantiles[0], raw[0])
+        self.assertAlmostEqual(quantiles[1], raw[-1])
+        self.assertTrue(raw[0] <= quantiles[0.5] <= raw[-1])
+
+    def test_no_observations(self):
+        link_id = self.get_some_link_id()
+        response = self.get_quantiles(link_id, start=0, duration=1000, types='flow')
+        self.assert_200(response)
+        self.assertEqual(response.json['data']['flow']['count'], 0)
+        self.assertEqual(response.json['data']['flow']['quantiles'], [[0.5, None],
+            [0.85, None], [0.95, None]])
+
+    def test_bad_quantiles(self):
+        link_id = self.get_some_link_id()
+        self.assert_400(self.get_quantiles(link_id, q='median'))
+        self.assert_400(self.get_quantiles(link_id, q='0.5,1.5'))
+
+    def test_non_existent_link(self):
+        response = self.get_quantiles('X'*22)
+        self.assertEqual(response.status_code, 404)
+
+class TestProfile(TestCase):
+    # A Tuesday
+    START_DATE = datetime.datetime(2013, 9, 10, 8, tzinfo=pytz.utc)
+
+    @classmethod
+    def create_fixtures(cls):
+        create_fake_observations(link_count=2, start=TestProfile.START_DATE, duration=2*60)
+
+    def get_profile(self, link_id, **query):
+        url = API_PREFIX + '/links/{0}/profile'.format(link_id)
+        if len(query) > 0:
+            url += '?' + urlencode(query)
+        log.info('GET {0}'.format(url))
+        return self.client.get(url)
+
+    def test_profile(self):
+        link_id = self.get_some_link_id()
+        response = self.get_profile(link_id)
+        self.assert_200(response)
+        self.assertEqual(response.json['link']['id'], link_id)
+        self.assertEqual(response.json['query']['slotDuration'], 15*60*1000)
+
+        data = response.json['data']
+        self.assertEqual(set(data.keys()), set(('speed', 'flow', 'occupancy')))
+        for v in data.values():
+            # Observations are every 15 minutes for two hours from 08:00
+            self.assertEqual(list(r[0] for r in v['values']),
+                list(range(96 + 8*4, 96 + 10*4)))
+            for slot, mean, stddev, count in v['values']:
+                self.assertEqual(count, 1)
+                self.assertIsNone(stddev)
+
+    def test_profile_at(self):
+        link_id = self.get_some_link_id()
+        at = int((self.START_DATE + datetime.timedelta(minutes=15) -
+            datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)).total_seconds() * 1000)
+        response = self.get_profile(link_id, at=at, types='speed')
+        self.assert_200(response)
+        values = response.json['data']['speed']['values']
+        self.assertEqual(len(values), 1)
+        self.assertEqual(values[0][0], 96 + 8*4 + 1)
+
+        raw = self.get_observations(link_id, start=at, duration=0, types='speed')
+        self.assertEqual(values[0][1], raw.json['data']['speed']['values'][0][1])
+
+    def test_bad_at(self):
+        link_id = self.get_some_link_id()
+        self.assert_400(self.get_profile(link_id, at='tuesday'))
+
+    def test_out_of_range_at(self):
+        link_id = self.get_some_link_id()
+        response = self.get_profile(link_id, at=10**20)
+        self.assert_400(response)
+        self.assertIn('out of range', response.json['error']['message'])
+
+    def test_non_existent_link(self):
+        response = self.get_profile('X'*22)
+        self.assertEqual(response.status_code, 404)
+
+class TestNetworkLatest(TestCase):
+    @classmethod
+    def create_fixtures(cls):
+        create_fake_observations(link_count=10, duration=2*60)
+
+    def get_latest(self, **query):
+        url = API_PREFIX + '/network/latest'
+        if len(query) > 0:
+            url += '?' + urlencode(query)
+        log.info('GET {0}'.format(url))
+        return self.client.get(url)
+
+    def test_latest(self):
+        response = self.get_latest()
+        self.assert_200(response)
+        data = response.json['data']
+        self.assertEqual(len(data), db.session.query(Link.id).count())
+
+        # Latest values should match the last value of each link's series
+        link_id, link_data = sorted(data.items())[0]
+        self.assertEqual(set(link_data.keys()), set(('speed', 'flow', 'occupancy')))
+        series = self.get_observations(link_id).json['data']
+        for type, (timestamp, value) in link_data.items():
+            self.assertEqual([timestamp, value], series[type]['values'][-1])
+
+    def test_types(self):
+        response = self.get_latest(types='flow')
+        self.assert_200(response)
+        for link_data in response.json['data'].values():
+            self.assertEqual(list(link_data.keys()), ['flow'])
+
+    def test_bbox(self):
+        everything = self.get_latest(bbox='-180,-90,180,90').json['data']
+        self.assertEqual(len(everything), db.session.query(Link.id).count())
+
+        nothing = self.get_latest(bbox='100,-10,110,0').json['data']
+        self.assertEqual(len(nothing), 0)
+
+    def test_bad_bbox(self):
+        self.assert_400(self.get_latest(bbox='1,2,3'))
+        self.assert_400(self.get_latest(bbox='a,b,c,d'))
+        self.assert_400(self.get_latest(bbox='3,2,1,0'))
+
+class TestNetworkSnapshot(TestCase):
+    START_DATE = datetime.datetime(2013, 9, 10, tzinfo=pytz.utc)
+
+    @classmethod
+    def create_fixtures(cls):
+        create_fake_observations(link_count=10, start=TestNetworkSnapshot.START_DATE,
+                duration=3*60)
+
+    def get_snapshot(self, **query):
+        url = API_PREFIX + '/network/snapshot'
+        if len(query) > 0:
+            url += '?' + urlencode(query)
+        log.info('GET {0}'.format(url))
+        return self.client.get(url)
+
+    def start_ts(self):
+        return int((self.START_DATE - datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)).\
+            total_seconds() * 1000)
+
+    def test_default_is_latest(self):
+        snapshot = self.get_snapshot()
+        self.assert_200(snapshot)
+        latest = self.client.get(API_PREFIX + '/network/latest')
+        self.assertEqual(snapshot.json['data'], latest.json['data'])
+
+    def test_snapshot_at(self):
+        # Observations are every 15 minutes
+        at = self.start_ts() + 20*60*1000
+        response = self.get_snapshot(at=at)
+        self.assert_200(response)
+        self.assertEqual(response.json['query']['at'], at)
+
+        data = response.json['data']
+        self.assertEqual(len(data), db.session.query(Link.id).count())
+        for link_id, link_data in data.items():
+            for type, (timestamp, value) in link_data.items():
+                self.assertEqual(timestamp, self.start_ts() + 15*60*1000)
+
+    def test_tolerance(self):
+        at = self.start_ts() + 20*60*1000
+        response = self.get_snapshot(at=at, tolerance=60*1000)
+        self.assert_200(response)
+        self.assertEqual(response.json['data'], {})
+
+    def test_bbox(self):
+        nothing = self.get_snapshot(bbox='100,-10,110,0').json['data']
+        self.assertEqual(len(nothing), 0)
+
+    def test_bad_parameters(self):
+        self.assert_400(self.get_snapshot(at='yesterday'))
+        self.assert_400(self.get_snapshot(tolerance='-1'))
+        self.assert_400(self.get_snapshot(bbox='1,2'))
+
+    def test_out_of_range_at(self):
+        response = self.get_snapshot(at=10**20)
+        self.assert_400(response)
+        self.assertIn('out of range', response.json['error']['message'])
+
+    def test_earliest_at(self):
+        # The tolerance window reaches before the earliest datetime
+        earliest = datetime.datetime.min.replace(tzinfo=pytz.utc)
+        at = int((earliest - datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)).\
+            total_seconds() * 1000)
+        response = self.get_snapshot(at=at)
+        self.assert_200(response)
+        self.assertEqual(response.json['data'], {})
+
+class TestCreateObservations(TestCase):
+    START_TS = 1378771200000 # 2013-09-10T00:00:00Z as a JavaScript timestamp
+
+    @classmethod
+    def create_fixtures(cls):
+        create_fake_links(link_count=10)
+
+    def make_create_requests(self, link_id, count=10, type='speed'):
+        return list(
+            dict(link=link_id, type=type, observedAt=self.START_TS + 60000*idx, value=idx)
+            for idx in range(count)
+        )
+
+    def test_empty_body(self):
+        response = self.client.post(API_PREFIX + '/observations/',
+                data='', content_type='application/json')
+        self.assert_400(response)
+
+    def test_non_json_body(self):
+        response = self.client.post(API_PREFIX + '/observations/',
+                data='not json', content_type='application/json')
+        self.assert_400(response)
+
+    def test_empty_request(self):
+        response = self.post_observations([])
+        self.assert_200(response)
+        self.assertEqual(response.json['create']['count'], 0)
+
+    def test_bad_type(self):
+        create = self.make_create_requests(self.get_some_link_id(), type='not-a-type')
+        response = self.post_observations(create)
+        self.assert_400(response)
+
+    def test_bad_timestamp(self):
+        create = self.make_create_requests(self.get_some_link_id())
+        create[2]['observedAt'] = 'yesterday'
+        response = self.post_observations(create)
+        self.assert_400(response)
+
+    def test_out_of_range_timestamp(self):
+        create = self.make_create_requests(self.get_some_link_id())
+        create[2]['observedAt'] = 10**20
+        response = self.post_observations(create)
+        self.assert_400(response)
+        self.assertIn('number 3', response.json['error']['message'])
+
+    def test_non_existent_link(self):
+        create = self.make_create_requests('X'*22)
+        response = self.post_observations(create)
+        self.assert_400(response)
+
+    def test_create(self):
+        link_id = self.get_some_link_id()
+        create = self.make_create_requests(link_id, count=30)
+        response = self.post_observations(create)
+        self.assert_200(response)
+        self.assertEqual(response.json['create']['count'], len(create))
+
+        response = self.get_observations(link_id, start=self.START_TS, duration=60*60*1000)
+        self.validate_observations_response(link_id, response)
+        values = response.json['data']['speed']['values']
+        self.assertEqual(len(values), len(create))
+        for (ts, value), cr in zip(values, create):
+            self.assertEqual(ts, cr['observedAt'])
+            self.assertEqual(value, cr['value'])
+
+    def test_create_for_link(self):
+        link_id = self.get_some_link_id()
+        create = self.make_create_requests(link_id, count=30, type='flow')
+        for cr in create:
+            del cr['link']
+        response = self.patch_observations(link_id, create)
+        self.assert_200(response)
+        self.assertEqual(response.json['create']['count'], len(create))
+
+        response = self.get_observations(link_id, start=self.START_TS, duration=60*60*1000)
+        self.validate_observations_response(link_id, response)
+        self.assertEqual(len(response.json['data']['flow']['values']), len(create))
+
+    def test_retry_is_no_op(self):
+        link_id = self.get_some_link_id()
+        create = self.make_create_requests(link_id)
+        response = self.post_observations(create)
+        self.assertEqual(response.json['create']['count'], len(create))
+        response = self.post_observations(create)
+        self.assert_200(response)
+        self.assertEqual(response.json['create']['count'], 0)
+
+    def test_overwrite(self):
+        link_id = self.get_some_link_id()
+        create = self.make_create_requests(link_id)
+        self.post_observations(create)
+        for cr in create:
+            cr['value'] += 100
+        response = self.post_observations(create, on_conflict='overwrite')
+        self.assert_200(response)
+        self.assertEqual(response.json['create']['count'], len(create))
+
+        response = self.get_observations(link_id, start=self.START_TS, duration=60*60*1000)
+        values = response.json['data']['speed']['values']
+        self.assertEqual(list(v for _, v in values), list(cr['value'] for cr in create))
+
+    def test_reject(self):
+        link_id = self.get_some_link_id()
+        create = self.make_create_requests(link_id)
+        self.post_observations(create)
+        response = self.post_observations(create, on_conflict='reject')
+        self.assert_400(response)
+
+    def test_bad_conflict_policy(self):
+        response = self.post_observations([], on_conflict='bogus')
+        self.assert_400(response)
+
+    def test_create_for_non_existent_link(self):
+        response = self.patch_observations('X'*22, [])
+        self.assert_404(response)
+
+class TestStreamingCreateObservations(TestCase):
+    START_TS = 1378771200000 # 2013-09-10T00:00:00Z as a JavaScript timestamp
+
+    @classmethod
+    def create_fixtures(cls):
+        create_fake_links(link_count=10)
+        create_fake_link_aliases(alias_count=5)
+
+    def post_upload(self, body, content_type):
+        return self.client.post(API_PREFIX + '/observations/',
+                data=body, content_type=content_type)
+
+    def parse_upload_response(self, response):
+        self.assert_200(response)
+        lines = list(json.loads(l) for l in response.data.decode('utf8').splitlines())
+        log.info('Upload response: {0}'.format(lines))
+        return lines
+
+    def test_ndjson_upload(self):
+        link_id = self.get_some_link_id()
+        records = list(
+            dict(link=link_id, type='speed', observedAt=self.START_TS + 60000*idx, value=idx)
+            for idx in range(25)
+        )
+        body = '\n'.join(json.dumps(r) for r in records)
+
+        with patch('trafficdb.blueprint.api.INGEST_CHUNK_SIZE', 10):
+            lines = self.parse_upload_response(self.post_upload(body, 'application/x-ndjson'))
+
+        # Three chunks and a final status
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(list(l['progress']['total'] for l in lines[:3]), [10, 20, 25])
+        self.assertEqual(lines[-1]['create']['count'], 25)
+
+        response = self.get_observations(link_id, start=self.START_TS, duration=60*60*1000)
+        self.validate_observations_response(link_id, response)
+        self.assertEqual(len(response.json['data']['speed']['values']), 25)
+
+    def test_csv_upload_with_aliases(self):
+        alias = db.session.query(LinkAlias.name).limit(1).one()[0]
+        lines = ['alias,type,observedAt,value']
+        lines.extend(
+            '{0},flow,{1},{2}'.format(alias, self.START_TS + 60000*idx, idx)
+            for idx in range(15)
+        )
+
+        with patch('trafficdb.blueprint.api.INGEST_CHUNK_SIZE', 10):
+            lines = self.parse_upload_response(self.post_upload('\n'.join(lines), 'text/csv'))
+
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[-1]['create']['count'], 15)
+
+    def test_malformed_upload(self):
+        link_id = self.get_some_link_id()
+        body = '\n'.join([
+            json.dumps(dict(link=link_id, type='speed', observedAt=self.START_TS, value=1)),
+            'not json',
+        ])
+        lines = self.parse_upload_response(self.post_upload(body, 'application/x-ndjson'))
+        self.assertIn('error', lines[-1])
+
+    def test_undecodable_upload(self):
+        link_id = self.get_some_link_id()
+        body = json.dumps(dict(link=link_id, type='speed', observedAt=self.START_TS, value=1))
+        body = body.encode('utf8') + b'\n\xff\xfe\n'
+        lines = self.parse_upload_response(self.post_upload(body, 'application/x-ndjson'))
+        self.assertIn('error', lines[-1])
+
+    def test_retried_upload_counts_inserted(self):
+        link_id = self.get_some_link_id()
+        body = '\n'.join(
+            json.dumps(dict(link=link_id, type='speed', observedAt=self.START_TS + 60000*idx, value=idx))
+            for idx in range(5)
+        )
+        lines = self.parse_upload_response(self.post_upload(body, 'application/x-ndjson'))
+        self.assertEqual(lines[-1]['create']['count'], 5)
+        lines = self.parse_upload_response(self.post_upload(body, 'application/x-ndjson'))
+        self.assertEqual(lines[-1]['create']['count'], 0)
+
+    def test_non_existent_alias_upload(self):
+        body = json.dumps(dict(alias='_no_such_alias', type='speed', observedAt=self.START_TS, value=1))
+        lines = self.parse_upload_response(self.post_upload(body, 'application/x-ndjson'))
+        self.assertEqual(len(lines), 1)
+        self.assertIn('error', lines[0])
+
+class TestMultiLinkObservations(TestCase):
+    @classmethod
+    def create_fixtures(cls):
+        start_date = datetime.datetime(2013, 9, 10)
+        create_fake_observations(link_count=10, start=start_date, duration=6*60)
+        create_fake_link_aliases(alias_count=5)
+
+    def make_query(self, body):
+        return self.client.post(API_PREFIX + '/observations/query',
+                data=json.dumps(body), content_type='application/json')
+
+    def get_link_ids(self, count):
+        response = self.get_links(count=count)
+        properties, page, links = self.parse_links_response(response)
+        return list(l['id'] for l in links)
+
+    def test_empty_body(self):
+        response = self.client.post(API_PREFIX + '/observations/query',
+                data='', content_type='application/json')
+        self.assert_400(response)
+
+    def test_bad_links(self):
+        self.assert_400(self.make_query(dict(links='not a list')))
+        self.assert_400(self.make_query(dict(links=[1, 2])))
+
+    def test_too_many_links(self):
+        from trafficdb.blueprint.api import MULTI_LINK_LIMIT
+        response = self.make_query(dict(links=['X'*22] * (MULTI_LINK_LIMIT+1)))
+        self.assert_400(response)
+
+    def test_empty_query(self):
+        response = self.make_query({})
+        self.assert_200(response)
+        self.assertEqual(response.json['data'], {})
+
+    def test_matches_single_link_queries(self):
+        link_ids = self.get_link_ids(3)
+        response = self.make_query(dict(links=link_ids + ['X'*22]))
+        self.assert_200(response)
+        self.assertEqual(response.json['missing'], ['X'*22])
+
+        query = response.json['query']
+        data = response.json['data']
+        self.assertEqual(set(data.keys()), set(link_ids))
+        for link_id in link_ids:
+            single = self.get_observations(link_id,
+                    start=query['start'], duration=query['duration']).json
+            for type in ('speed', 'flow', 'occupancy'):
+                self.assertEqual(data[link_id][type]['values'],
+                        single['data'][type]['values'])
+
+    def test_missing_in_request_order(self):
+        missing = ['Z'*22, 'X'*22, 'Y'*22, 'X'*22]
+        response = self.make_query(dict(links=missing))
+        self.assert_200(response)
+        self.assertEqual(response.json['missing'], ['Z'*22, 'X'*22, 'Y'*22])
+
+    def test_bad_window(self):
+        self.assert_400(self.make_query(dict(start=[1])))
+        self.assert_400(self.make_query(dict(start={'a': 1})))
+        self.assert_400(self.make_query(dict(duration=[1])))
+        self.assert_400(self.make_query(dict(start=10**20)))
+
+    def test_aliases(self):
+        aliases = list(r[0] for r in db.session.query(LinkAlias.name).limit(2))
+        response = self.make_query(dict(aliases=aliases + ['_no_such_alias'], types=['speed']))
+        self.assert_200(response)
+
+        resolved = response.json['aliases']
+        self.assertIsNone(resolved['_no_such_alias'])
+        for alias in aliases:
+            link_id = resolved[alias]
+            self.assertIsNotNone(link_id)
+            self.assertEqual(list(response.json['data'][link_id].keys()), ['speed'])
@@ -0,0 +1,128 @@
+import datetime
+import logging
+
+from nose.tools import raises
+import pytz
+from trafficdb.models import *
+from trafficdb.partitions import *
+from trafficdb.queries import observations_for_link
+
+from .fixtures import create_fake_observations
+from .util import TestCase
+
+log = logging.getLogger(__name__)
+
+def test_month_start():
+    dt = datetime.datetime(2013, 9, 10, 12, 34, tzinfo=pytz.utc)
+    assert month_start(dt) == datetime.datetime(2013, 9, 1, tzinfo=pytz.utc)
+
+def test_month_start_naive():
+    dt = datetime.datetime(2013, 9, 10, 12, 34)
+    assert month_start(dt) == datetime.datetime(2013, 9, 1, tzinfo=pytz.utc)
+
+def test_add_months():
+    dt = datetime.datetime(2013, 11, 10, tzinfo=pytz.utc)
+    assert add_months(dt, 1) == datetime.datetime(2013, 12, 1, tzinfo=pytz.utc)
+    assert add_months(dt, 2) == datetime.datetime(2014, 1, 1, tzinfo=pytz.utc)
+    assert add_months(dt, -11) == datetime.datetime(2012, 12, 1, tzinfo=pytz.utc)
+
+def test_partition_name():
+    dt = datetime.datetime(2013, 9, 10, tzinfo=pytz.utc)
+    assert partition_name(dt) == 'observations_y2013m09'
+
+def test_retention_cutoff():
+    now = datetime.datetime(2014, 10, 8, 12, 0, tzinfo=pytz.utc)
+    assert retention_cutoff('2y', now) == datetime.datetime(2012, 10, 1, tzinfo=pytz.utc)
+    assert retention_cutoff('18m', now) == datetime.datetime(2013, 4, 1, tzinfo=pytz.utc)
+    assert retention_cutoff('2w', now) == datetime.datetime(2014, 9, 24, 12, 0, tzinfo=pytz.utc)
+    assert retention_cutoff('10d', now) == datetime.datetime(2014, 9, 28, 12, 0, tzinfo=pytz.utc)
+
+@raises(ValueError)
+def test_bad_retention_cutoff():
+    retention_cutoff('two years')
+
+class TestPartitions(TestCase):
+    START_DATE = datetime.datetime(2012, 4, 29, tzinfo=pytz.utc)
+    END_DATE = datetime.datetime(2012, 5, 2, tzinfo=pytz.utc)
+
+    @classmethod
+    def create_fixtures(cls):
+        duration = int((TestPartitions.END_DATE - TestPartitions.START_DATE).total_seconds() // 60)
+        create_fake_observations(start=TestPartitions.START_DATE, duration=duration)
+
+    def partition_count(self, name):
+        return db.session.execute('SELECT count(*) FROM ' + name).scalar()
+
+    def test_create_partitions(self):
+        obs_count = db.session.query(Observation.id).count()
+
+        created = create_observation_partitions(db.session, self.START_DATE, self.END_DATE)
+        log.info('Created partitions: {0}'.format(created))
+        self.assertEqual(created, ['observations_y2012m04', 'observations_y2012m05'])
+
+        # Observations should have been moved out of the default partition
+        self.assertEqual(self.partition_count(DEFAULT_PARTITION), 0)
+        self.assertEqual(
+            self.partition_count(created[0]) + self.partition_count(created[1]), obs_count)
+        self.assertEqual(db.session.query(Observation.id).count(), obs_count)
+
+        names = list(p[0] for p in observation_partitions(db.session))
+        self.assertIn(created[0], names)
+        self.assertIn(created[1], names)
+
+    def test_create_existing_partition(self):
+        created = create_observation_partitions(db.session, self.START_DATE, self.END_DATE)
+        self.assertEqual(len(created), 2)
+        created = create_observation_partitions(db.session, self.START_DATE, self.END_DATE)
+        self.assertEqual(len(created), 0)
+
+    def test_queries_after_partitioning(self):
+        link_id = db.session.query(Link.id).limit(1).one()[0]
+        def query():
+            return observations_for_link(db.session, link_id, ObservationType.SPEED,
+                    self.START_DATE, self.END_DATE).count()
+
+        before = query()
+        create_observation_partitions(db.session, self.START_DATE, self.END_DATE)
+        self.assertEqual(query(), before)
+
+    def test_retain(self):
+        create_observation_partitions(db.session, self.START_DATE, self.END_DATE)
+        may_count = self.partition_count('observations_y2012m05')
+
+        cutoff = datetime.datetime(2012, 5, 1, tzinfo=pytz.utc)
+        detached = retain_observations(db.session, cutoff)
+        self.assertEqual(detached, ['observations_y2012m04'])
+
+        names = list(p[0] for p in observation_partitions(db.session))
+        self.assertNotIn('observations_y2012m04', names)
+        self.assertEqual(db.session.query(Observation.id).count(), may_count)
+
+    def test_retain_archive(self):
+        create_observation_partitions(db.session, self.START_DATE, self.END_DATE)
+        april_count = self.partition_count('observations_y2012m04')
+
+        cutoff = datetime.datetime(2012, 5, 1, tzinfo=pytz.utc)
+        retain_observations(db.session, cutoff, archive_schema='archive')
+        self.assertEqual(self.partition_count('archive.observations_y2012m04'), april_count)
+
+    def test_retain_nothing_expired(self):
+        create_observation_partitions(db.session, self.START_DATE, self.END_DATE)
+        detached = retain_observations(db.session, self.START_DATE)
+        self.assertEqual(detached, [])
+
+    def test_brin_index(self):
+        def exists():
+            return db.session.execute(
+                'SELECT to_regclass(\'' + BRIN_INDEX + '\')').scalar() is not None
+
+        set_brin_index(db.session, False)
+        self.assertFalse(exists())
+        self.assertTrue(set_brin_index(db.session, True))
+        self.assertTrue(exists())
+        self.assertFalse(set_brin_index(db.session, True))
+
+        # New partitions are indexed too
+        create_observation_partitions(db.session, self.START_DATE, self.END_DATE)
+        self.assertTrue(set_brin_index(db.session, False))
+        self.assertFalse(exists())
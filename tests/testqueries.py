@@ -1,7 +1,9 @@
 import datetime
 import logging
 
+from nose.plugins.skip import SkipTest
 import pytz
+from trafficdb.blueprint.api import datetime_to_javascript_timestamp
 from trafficdb.models import *
 from trafficdb.queries import *
 
@@ -33,6 +35,11 @@ class TestQueries(TestCase):
         assert max_d <= TestQueries.END_DATE
         assert (max_d - min_d).total_seconds() > 60
 
+    def test_cached_date_range(self):
+        cached = cached_observation_date_range(db.session).one()
+        exact = observation_date_range(db.session).one()
+        self.assertEqual(tuple(cached), tuple(exact))
+
     def test_single_link_observations(self):
         link_id = db.session.query(Link.id).limit(1).first().id
         logging.info('Fetching observations for link {0}'.format(link_id))
@@ -40,6 +47,67 @@ class TestQueries(TestCase):
                 TestQueries.START_DATE, TestQueries.START_DATE + datetime.timedelta(days=1)).all()
         self.assertTrue(len(obs) >= 96)
 
+    def test_single_link_multiple_type_observations(self):
+        link_id = db.session.query(Link.id).limit(1).first().id
+        types = [ObservationType.SPEED, ObservationType.FLOW]
+        obs = observations_for_link(db.session, link_id, types,
+                TestQueries.START_DATE, TestQueries.START_DATE + datetime.timedelta(days=1)).all()
+        self.assertTrue(len(obs) >= 96*2)
+        self.assertEqual(set(o.type for o in obs), set(types))
+
+        # Observations should be ordered by type (in declaration order of the
+        # database enum) and then time
+        type_order = list(ObservationType)
+        keys = list((type_order.index(o.type), o.observed_at) for o in obs)
+        self.assertEqual(keys, sorted(keys))
+
+    def test_observation_values(self):
+        link_id = db.session.query(Link.id).limit(1).first().id
+        q = observations_for_link(db.session, link_id, list(ObservationType),
+                TestQueries.START_DATE, TestQueries.START_DATE + datetime.timedelta(days=1))
+        obs = q.all()
+        values = observation_values(q).all()
+        self.assertEqual(len(values), len(obs))
+        for o, (type, timestamp, value) in zip(obs, values):
+            self.assertEqual(type, o.type)
+            self.assertEqual(timestamp, datetime_to_javascript_timestamp(o.observed_at))
+            self.assertEqual(value, o.value)
+
+    def test_observation_arrays(self):
+        if np is None:
+            raise SkipTest('NumPy is not installed')
+
+        link_id = db.session.query(Link.id).limit(1).first().id
+        q = observations_for_link(db.session, link_id, list(ObservationType),
+                TestQueries.START_DATE, TestQueries.START_DATE + datetime.timedelta(days=1))
+        arrays = observation_arrays(q)
+        self.assertEqual(set(arrays.keys()), set(ObservationType))
+        for type, (timestamps, values) in arrays.items():
+            self.assertEqual(timestamps.dtype, np.int64)
+            self.assertEqual(values.dtype, np.float64)
+            self.assertEqual(timestamps.shape, values.shape)
+            self.assertTrue(np.all(np.diff(timestamps) > 0))
+
+    def test_snapshot(self):
+        # Observations are every 15 minutes so a snapshot between them with a
+        # 10 minute tolerance sees the earlier one
+        at = TestQueries.START_DATE + datetime.timedelta(hours=1, minutes=5)
+        rows = snapshot_observation_values(db.session, list(ObservationType), at,
+                datetime.timedelta(minutes=10)).all()
+        link_count = db.session.query(Link.id).count()
+        self.assertEqual(len(rows), link_count * len(ObservationType))
+
+        expected_ts = datetime_to_javascript_timestamp(
+                TestQueries.START_DATE + datetime.timedelta(hours=1))
+        for link_uuid, type, timestamp, value in rows:
+            self.assertEqual(timestamp, expected_ts)
+
+    def test_snapshot_tolerance(self):
+        at = TestQueries.START_DATE + datetime.timedelta(hours=1, minutes=5)
+        rows = snapshot_observation_values(db.session, ObservationType.SPEED, at,
+                datetime.timedelta(minutes=2)).all()
+        self.assertEqual(rows, [])
+
     def test_multiple_link_observations(self):
         link_ids = db.session.query(Link.id).limit(3).all()
         logging.info('Using link ids: {0}'.format(link_ids))
@@ -0,0 +1,61 @@
+import datetime
+import logging
+
+import pytz
+from trafficdb.models import *
+from trafficdb.queries import *
+
+from .fixtures import create_fake_observations
+from .util import TestCase
+
+log = logging.getLogger(__name__)
+
+class QueryPlanTestCase(TestCase):
+    """Test case for checking which indexes the planner chooses.
+
+    Test fixtures are far smaller than a production database and so the
+    planner would prefer sequential scans over any index. Sequential scans are
+    disabled for each test so that the choice between indexes can be checked.
+
+    """
+    def setUp(self):
+        super(QueryPlanTestCase, self).setUp()
+        db.session.execute('SET LOCAL enable_seqscan = off')
+
+    def index_names(self, index_name):
+        """Return a set containing index_name and the names of the
+        corresponding indexes on each partition.
+
+        """
+        q = db.session.execute(
+            'SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+            'WHERE i.inhparent = CAST(:name AS regclass)', dict(name=index_name))
+        return set([index_name]) | set(r[0] for r in q)
+
+    def assertUsesIndex(self, q, index_name):
+        plan = '\n'.join(query_plan(db.session, q))
+        log.info('Query plan:\n{0}'.format(plan))
+        self.assertTrue(any(name in plan for name in self.index_names(index_name)),
+                'Query plan does not use index {0}'.format(index_name))
+
+class TestObservationQueryPlans(QueryPlanTestCase):
+    START_DATE = datetime.datetime(2012, 4, 23, tzinfo=pytz.utc)
+    END_DATE = datetime.datetime(2012, 4, 25, tzinfo=pytz.utc)
+
+    @classmethod
+    def create_fixtures(cls):
+        duration = int((cls.END_DATE - cls.START_DATE).total_seconds() // 60)
+        create_fake_observations(link_count=10, start=cls.START_DATE, duration=duration)
+
+    def test_observations_endpoint_uses_covering_index(self):
+        # This is the query made by the observations endpoint
+        link_id = db.session.query(Link.id).limit(1).one()[0]
+        q = observation_values(observations_for_link(db.session, link_id,
+            ObservationType.SPEED, self.START_DATE, self.END_DATE))
+        self.assertUsesIndex(q, 'ix_observation_link_id_type_observed_at_value')
+
+    def test_observations_endpoint_uses_covering_index_for_all_types(self):
+        link_id = db.session.query(Link.id).limit(1).one()[0]
+        q = observation_values(observations_for_link(db.session, link_id,
+            list(ObservationType), self.START_DATE, self.END_DATE))
+        self.assertUsesIndex(q, 'ix_observation_link_id_type_observed_at_value')
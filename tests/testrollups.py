@@ -0,0 +1,249 @@
+import datetime
+import logging
+import threading
+
+import pytz
+from sqlalchemy import func
+from trafficdb.ingest import OVERWRITE, copy_observations
+from trafficdb.models import *
+from trafficdb.rollups import *
+from trafficdb.sketches import SKETCH_CENTROIDS
+
+from .fixtures import create_fake_observations
+from .util import TestCase
+
+log = logging.getLogger(__name__)
+
+def test_bucket_start():
+    dt = datetime.datetime(2013, 4, 29, 12, 34, 56, tzinfo=pytz.utc)
+    assert bucket_start(dt, 300) == datetime.datetime(2013, 4, 29, 12, 30, tzinfo=pytz.utc)
+    assert bucket_start(dt, 3600) == datetime.datetime(2013, 4, 29, 12, tzinfo=pytz.utc)
+    assert bucket_start(dt, 86400) == datetime.datetime(2013, 4, 29, tzinfo=pytz.utc)
+
+def test_bucket_start_naive():
+    dt = datetime.datetime(2013, 4, 29, 12, 34, 56)
+    assert bucket_start(dt, 3600) == datetime.datetime(2013, 4, 29, 12, tzinfo=pytz.utc)
+
+def test_profile_slot():
+    # Tuesday 08:15
+    dt = datetime.datetime(2014, 10, 14, 8, 15, tzinfo=pytz.utc)
+    assert profile_slot(dt, 'UTC') == 96 + 8*4 + 1
+    assert profile_slot(dt + datetime.timedelta(minutes=14), 'UTC') == 96 + 8*4 + 1
+    assert profile_slot(datetime.datetime(2014, 10, 13, tzinfo=pytz.utc), 'UTC') == 0
+    assert profile_slot(datetime.datetime(2014, 10, 19, 23, 59, tzinfo=pytz.utc), 'UTC') == \
+            PROFILE_SLOTS - 1
+
+def test_profile_slot_local_time():
+    # 07:15 UTC is 08:15 British Summer Time
+    dt = datetime.datetime(2014, 10, 14, 7, 15, tzinfo=pytz.utc)
+    assert profile_slot(dt, 'Europe/London') == 96 + 8*4 + 1
+
+def test_rebuild_rollup_ranges():
+    start = datetime.datetime(2013, 4, 29, 12, tzinfo=pytz.utc)
+    end = datetime.datetime(2013, 5, 1, 6, tzinfo=pytz.utc)
+    ranges = rebuild_rollup_ranges(start, end)
+    assert len(ranges) == 3
+    assert ranges[0][0] == datetime.datetime(2013, 4, 29, tzinfo=pytz.utc)
+    assert ranges[-1][1] == datetime.datetime(2013, 5, 2, tzinfo=pytz.utc)
+
+class TestRollups(TestCase):
+    START_DATE = datetime.datetime(2013, 4, 29, 22, tzinfo=pytz.utc)
+
+    @classmethod
+    def create_fixtures(cls):
+        create_fake_observations(start=TestRollups.START_DATE, duration=60*4)
+
+    def rollup_totals(self, resolution):
+        return db.session.query(
+                func.sum(ObservationRollup.count), func.sum(ObservationRollup.sum)).\
+            filter(ObservationRollup.resolution == resolution).one()
+
+    def raw_totals(self):
+        return db.session.query(
+                func.count(Observation.value), func.sum(Observation.value)).one()
+
+    def assertRollupsMatchRaw(self):
+        raw_count, raw_sum = self.raw_totals()
+        for resolution in RESOLUTIONS:
+            count, sum_ = self.rollup_totals(resolution)
+            self.assertEqual(count, raw_count)
+            self.assertAlmostEqual(sum_, raw_sum, places=6)
+
+    def test_rollups_refreshed(self):
+        self.assertEqual(db.session.query(ObservationRollupDirty).count(), 0)
+        self.assertRollupsMatchRaw()
+
+    def test_buckets_span_days(self):
+        days = db.session.query(ObservationRollup.bucket).\
+            filter(ObservationRollup.resolution == RESOLUTIONS[-1]).distinct().count()
+        self.assertEqual(days, 2)
+
+    def test_bucket_aggregates(self):
+        rollup = db.session.query(ObservationRollup).\
+            filter(ObservationRollup.resolution == 3600).first()
+        values = list(r[0] for r in db.session.query(Observation.value).\
+            filter(Observation.link_id == rollup.link_id).\
+            filter(Observation.type == rollup.type).\
+            filter(Observation.observed_at >= rollup.bucket).\
+            filter(Observation.observed_at < rollup.bucket + datetime.timedelta(hours=1)))
+        self.assertEqual(rollup.count, len(values))
+        self.assertAlmostEqual(rollup.sum, sum(values), places=6)
+        self.assertEqual(rollup.min, min(values))
+        self.assertEqual(rollup.max, max(values))
+
+    def test_ingest_marks_dirty(self):
+        link_id = db.session.query(Link.id).limit(1).one()[0]
+        observed_at = self.START_DATE + datetime.timedelta(minutes=7)
+        copy_observations(db.session,
+            [(link_id, ObservationType.SPEED, observed_at, 1000.0)])
+        dirty = db.session.query(ObservationRollupDirty).all()
+        self.assertEqual(len(dirty), 1)
+        self.assertEqual(dirty[0].bucket, bucket_start(observed_at, RESOLUTIONS[0]))
+
+        self.assertEqual(refresh_rollups(db.session), 1)
+        self.assertEqual(db.session.query(ObservationRollupDirty).count(), 0)
+        self.assertRollupsMatchRaw()
+
+    def test_overwrite_updates_rollups(self):
+        obs = db.session.query(Observation).first()
+        copy_observations(db.session,
+            [(obs.link_id, obs.type, obs.observed_at, obs.value + 1000.0)],
+            on_conflict=OVERWRITE)
+        refresh_rollups(db.session)
+        self.assertRollupsMatchRaw()
+
+        daily = db.session.query(ObservationRollup).\
+            filter(ObservationRollup.resolution == RESOLUTIONS[-1]).\
+            filter(ObservationRollup.link_id == obs.link_id).\
+            filter(ObservationRollup.type == obs.type).\
+            filter(ObservationRollup.bucket == bucket_start(obs.observed_at, RESOLUTIONS[-1])).one()
+        self.assertGreaterEqual(daily.max, 1000.0)
+
+    def assertSketchesMatchRollups(self):
+        hourly = dict(
+            ((r.link_id, r.type, r.bucket), r.count)
+            for r in db.session.query(ObservationRollup).\
+                filter(ObservationRollup.resolution == SKETCH_RESOLUTION))
+        sketches = db.session.query(ObservationSketch).all()
+        self.assertEqual(len(sketches), len(hourly))
+        for sketch in sketches:
+            self.assertEqual(sum(sketch.weights), hourly[(sketch.link_id, sketch.type, sketch.bucket)])
+            self.assertEqual(sketch.means, sorted(sketch.means))
+            self.assertTrue(len(sketch.means) <= SKETCH_CENTROIDS)
+
+    def assertProfilesMatchRollups(self):
+        expected = {}
+        for r in db.session.query(ObservationRollup).\
+                filter(ObservationRollup.resolution == RESOLUTIONS[0]):
+            key = (r.link_id, r.type, profile_slot(r.bucket, 'UTC'))
+            count, sum_, sum_sq = expected.get(key, (0, 0.0, 0.0))
+            expected[key] = (count + r.count, sum_ + r.sum, sum_sq + r.sum_sq)
+
+        profiles = dict(
+            ((p.link_id, p.type, p.slot), (p.count, p.sum, p.sum_sq))
+            for p in db.session.query(LinkProfile) if p.count != 0)
+        self.assertEqual(set(profiles.keys()), set(expected.keys()))
+        for key, (count, sum_, sum_sq) in expected.items():
+            self.assertEqual(profiles[key][0], count)
+            self.assertAlmostEqual(profiles[key][1], sum_, places=6)
+            self.assertAlmostEqual(profiles[key][2], sum_sq, places=3)
+
+    def test_profiles(self):
+        self.assertProfilesMatchRollups()
+
+    def test_profiles_follow_overwrite(self):
+        obs = db.session.query(Observation).first()
+        copy_observations(db.session,
+            [(obs.link_id, obs.type, obs.observed_at, obs.value + 1000.0)],
+            on_conflict=OVERWRITE)
+        refresh_rollups(db.session)
+        self.assertProfilesMatchRollups()
+
+    def test_profiles_follow_rebuild(self):
+        rebuild_rollups(db.session, self.START_DATE,
+                self.START_DATE + datetime.timedelta(days=1))
+        self.assertProfilesMatchRollups()
+
+    def test_build_profiles(self):
+        db.session.query(LinkProfile).delete()
+        build_profiles(db.session)
+        self.assertProfilesMatchRollups()
+
+    def test_sketches(self):
+        self.assertSketchesMatchRollups()
+
+    def test_sketch_tails_are_exact(self):
+        # Centroids are smallest in the tails and so hold the extreme values
+        # of small hours alone
+        hourly = dict(
+            ((r.link_id, r.type, r.bucket), (r.min, r.max))
+            for r in db.session.query(ObservationRollup).\
+                filter(ObservationRollup.resolution == SKETCH_RESOLUTION))
+        for sketch in db.session.query(ObservationSketch):
+            self.assertEqual(sketch.weights[0], 1)
+            self.assertEqual(sketch.weights[-1], 1)
+            self.assertEqual((sketch.means[0], sketch.means[-1]),
+                    hourly[(sketch.link_id, sketch.type, sketch.bucket)])
+
+    def test_ingest_updates_sketches(self):
+        link_id = db.session.query(Link.id).limit(1).one()[0]
+        observed_at = self.START_DATE + datetime.timedelta(minutes=7)
+        copy_observations(db.session,
+            [(link_id, ObservationType.SPEED, observed_at, 1000.0)])
+        refresh_rollups(db.session)
+        self.assertSketchesMatchRollups()
+
+        sketch = db.session.query(ObservationSketch).\
+            filter_by(link_id=link_id, type=ObservationType.SPEED,
+                      bucket=bucket_start(observed_at, SKETCH_RESOLUTION)).one()
+        self.assertEqual(sketch.means[-1], 1000.0)
+
+    def test_refresh_nothing_dirty(self):
+        self.assertEqual(refresh_rollups(db.session), 0)
+
+    def test_rebuild(self):
+        db.session.query(ObservationRollup).delete()
+        rebuild_rollups(db.session, self.START_DATE,
+                self.START_DATE + datetime.timedelta(days=1))
+        self.assertRollupsMatchRaw()
+        self.assertSketchesMatchRollups()
+
+    def test_rebuild_is_idempotent(self):
+        for _ in range(2):
+            rebuild_rollups(db.session, self.START_DATE,
+                    self.START_DATE + datetime.timedelta(days=1))
+        self.assertRollupsMatchRaw()
+
+    def test_concurrent_rebuilds_take_turns(self):
+        start = self.START_DATE
+        end = self.START_DATE + datetime.timedelta(days=1)
+
+        first, second = db.engine.connect(), db.engine.connect()
+        try:
+            first_transaction = first.begin()
+            rebuild_rollups(first, start, end)
+
+            errors = []
+            def rebuild_second():
+                try:
+                    with second.begin():
+                        rebuild_rollups(second, start, end)
+                except Exception as e:
+                    errors.append(e)
+            thread = threading.Thread(target=rebuild_second)
+            thread.start()
+
+            # The second rebuild waits for the first to commit rather than
+            # conflicting with the rows it has replaced
+            thread.join(1)
+            self.assertTrue(thread.is_alive())
+            first_transaction.commit()
+            thread.join()
+            self.assertEqual(errors, [])
+        finally:
+            first.close()
+            second.close()
+
+        self.assertRollupsMatchRaw()
+        self.assertSketchesMatchRollups()
+        self.assertProfilesMatchRollups()
@@ -0,0 +1,68 @@
+import random
+
+from nose.tools import raises
+from trafficdb.sketches import *
+
+def exact_quantile(values, q):
+    values = sorted(values)
+    return values[int(round(q * (len(values) - 1)))]
+
+def make_sketch(values):
+    """Build a sketch in the same way as the database: equal sized groups of
+    sorted values.
+
+    """
+    values = sorted(values)
+    n, k = len(values), min(SKETCH_CENTROIDS, len(values))
+    means, weights, idx = [], [], 0
+    for tile in range(k):
+        size = n // k + (1 if tile < n % k else 0)
+        group = values[idx:idx+size]
+        means.append(sum(group) / float(len(group)))
+        weights.append(len(group))
+        idx += size
+    return means, weights
+
+def test_empty():
+    assert merge_centroids([]) == []
+    assert centroid_quantile([], 0.5) is None
+    assert sketch_quantiles([], [0.5]) == ([None], 0)
+
+def test_single_centroid():
+    assert centroid_quantile([(3.0, 10)], 0.1) == 3.0
+    assert centroid_quantile([(3.0, 10)], 0.9) == 3.0
+
+def test_merge_preserves_weight():
+    centroids = list((float(v), 1) for v in range(1000))
+    merged = merge_centroids(centroids)
+    assert len(merged) < len(centroids)
+    assert sum(w for _, w in merged) == 1000
+    assert merged == sorted(merged)
+
+def test_merge_keeps_tails():
+    centroids = list((float(v), 1) for v in range(1000))
+    merged = merge_centroids(centroids)
+    assert merged[0] == (0.0, 1)
+    assert merged[-1] == (999.0, 1)
+
+def test_quantiles_of_merged_sketches():
+    rng = random.Random(42)
+    values = list(rng.gauss(60, 15) for _ in range(24*60))
+    sketches = list(make_sketch(values[idx:idx+60]) for idx in range(0, len(values), 60))
+
+    qs = [0.05, 0.5, 0.85, 0.95]
+    estimates, count = sketch_quantiles(sketches, qs)
+    assert count == len(values)
+    for q, estimate in zip(qs, estimates):
+        assert abs(estimate - exact_quantile(values, q)) < 1.0
+
+def test_quantiles_monotonic():
+    rng = random.Random(7)
+    sketches = [make_sketch(list(rng.expovariate(0.1) for _ in range(200)))]
+    qs = list(q / 20.0 for q in range(21))
+    estimates, _ = sketch_quantiles(sketches, qs)
+    assert estimates == sorted(estimates)
+
+@raises(ValueError)
+def test_bad_quantile():
+    centroid_quantile([(1.0, 1)], 1.5)
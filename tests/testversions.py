@@ -0,0 +1,79 @@
+import datetime
+import logging
+
+import pytz
+from trafficdb.ingest import copy_observations
+from trafficdb.models import *
+from trafficdb.versions import *
+
+from .fixtures import create_fake_links
+from .util import TestCase
+
+log = logging.getLogger(__name__)
+
+def test_link_version_name():
+    assert link_version_name(12) == 'link:12'
+    assert link_version_name(12) != link_version_name(123)
+
+class TestChangeVersions(TestCase):
+    START_DATE = datetime.datetime(2013, 9, 10, tzinfo=pytz.utc)
+
+    @classmethod
+    def create_fixtures(cls):
+        create_fake_links(link_count=3)
+
+    def test_unbumped_version(self):
+        self.assertEqual(get_versions(db.session, ['foo']), dict(foo=(0, None)))
+
+    def test_bump(self):
+        bump_versions(db.session, ['foo', 'bar'])
+        bump_versions(db.session, ['foo', 'foo'])
+        versions = get_versions(db.session, ['foo', 'bar', 'buzz'])
+        self.assertEqual(versions['foo'][0], 2)
+        self.assertEqual(versions['bar'][0], 1)
+        self.assertEqual(versions['buzz'], (0, None))
+        self.assertIsNotNone(versions['foo'][1])
+
+    def test_bump_nothing(self):
+        bump_versions(db.session, [])
+        self.assertEqual(db.session.query(ChangeVersion).count(), 0)
+
+    def test_deferred_versions(self):
+        defer_versions(db.session, ['foo', 'bar'])
+        defer_versions(db.session, ['foo'])
+        self.assertEqual(get_versions(db.session, ['foo'])['foo'][0], 0)
+        bump_deferred_versions(db.session)
+        versions = get_versions(db.session, ['foo', 'bar'])
+        self.assertEqual(versions['foo'][0], 1)
+        self.assertEqual(versions['bar'][0], 1)
+
+        # Nothing remains deferred
+        bump_deferred_versions(db.session)
+        self.assertEqual(get_versions(db.session, ['foo'])['foo'][0], 1)
+
+    def test_ingest_bumps_links(self):
+        link_ids = list(r[0] for r in db.session.query(Link.id).order_by(Link.id))
+        names = list(link_version_name(link_id) for link_id in link_ids)
+
+        rows = list((link_ids[0], ObservationType.SPEED,
+            self.START_DATE + datetime.timedelta(minutes=idx), float(idx))
+            for idx in range(5))
+        rows.append((link_ids[1], ObservationType.FLOW, self.START_DATE, 1.0))
+        copy_observations(db.session, rows)
+
+        # Versions are bumped when the session commits
+        self.assertEqual(get_versions(db.session, [OBSERVATIONS])[OBSERVATIONS][0], 0)
+        bump_deferred_versions(db.session)
+
+        versions = get_versions(db.session, names + [OBSERVATIONS])
+        self.assertEqual(versions[names[0]][0], 1)
+        self.assertEqual(versions[names[1]][0], 1)
+        self.assertEqual(versions[names[2]][0], 0)
+        self.assertEqual(versions[OBSERVATIONS][0], 1)
+
+        copy_observations(db.session, rows[:1])
+        db.session.commit()
+        versions = get_versions(db.session, names + [OBSERVATIONS])
+        self.assertEqual(versions[names[0]][0], 2)
+        self.assertEqual(versions[names[1]][0], 1)
+        self.assertEqual(versions[OBSERVATIONS][0], 2)
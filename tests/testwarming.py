@@ -0,0 +1,129 @@
+import logging
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    # Py <3.3 compatibility
+    from mock import patch
+
+from trafficdb.warming import *
+
+from trafficdb.models import db
+
+from .fixtures import create_fake_observations
+from .util import ApiTestCase as TestCase, API_PREFIX
+
+log = logging.getLogger(__name__)
+
+def test_tracker_hottest():
+    tracker = AccessTracker(100)
+    for idx in range(5):
+        for _ in range(idx + 1):
+            tracker.record('http://localhost/', '/api/links/{0}/'.format(idx), None)
+    hottest = tracker.hottest(2)
+    assert hottest == [
+        ('http://localhost/', '/api/links/4/', None),
+        ('http://localhost/', '/api/links/3/', None),
+    ]
+    assert len(tracker.hottest(10)) == 5
+
+def test_tracker_ageing():
+    tracker = AccessTracker(3)
+    for _ in range(4):
+        tracker.record('http://localhost/', '/a', None)
+    tracker.record('http://localhost/', '/b', None)
+    tracker.record('http://localhost/', '/c', None)
+    tracker.record('http://localhost/', '/d', None)
+
+    # Rarely made requests are forgotten and counts are halved
+    assert len(tracker) <= 3
+    assert tracker.hottest(1) == [('http://localhost/', '/a', None)]
+
+def test_tracker_drain():
+    tracker = AccessTracker(3)
+    tracker.record('http://localhost/', '/a', None)
+    tracker.record('http://localhost/', '/a', None)
+    assert tracker.drain() == {('http://localhost/', '/a', None): 2}
+    assert len(tracker) == 0
+
+def test_tracker_clear():
+    tracker = AccessTracker(3)
+    tracker.record('http://localhost/', '/a', None)
+    tracker.clear()
+    assert len(tracker) == 0
+
+class TestWarming(TestCase):
+    @classmethod
+    def create_fixtures(cls):
+        create_fake_observations(link_count=2)
+
+    def setUp(self):
+        super(TestWarming, self).setUp()
+        self.tracker = self.app.extensions['access_tracker']
+        self.tracker.clear()
+
+    def test_requests_tracked(self):
+        link_id = self.get_some_link_id()
+        self.get_observations(link_id, start=1367193600000)
+        self.get_observations(link_id, start=1367193600000)
+        self.client.get(API_PREFIX + '/links/{0}/'.format(link_id))
+        self.client.get(API_PREFIX + '/links/')
+
+        hottest = self.tracker.hottest(10)
+        self.assertEqual(len(hottest), 2)
+        url_root, full_path, accept = hottest[0]
+        self.assertEqual(url_root, 'http://localhost/')
+        self.assertIn('/observations?', full_path)
+        self.assertIn('start=1367193600000', full_path)
+
+    def test_warm_requests(self):
+        link_id = self.get_some_link_id()
+        path = API_PREFIX + '/links/{0}/'.format(link_id)
+        requests = [('http://localhost/', path, None),
+                ('http://localhost/', API_PREFIX + '/links/nonexistent/', None)]
+        self.assertEqual(warm_requests(self.app, requests), 1)
+
+        # Warming requests are not tracked
+        self.assertEqual(len(self.tracker), 0)
+
+    def test_request_counts_shared(self):
+        # Counts flushed by two processes are summed
+        store_request_counts(db.session, {
+            ('http://localhost/', '/a', None): 1,
+            ('http://localhost/', '/b', 'text/csv'): 3,
+        })
+        store_request_counts(db.session, {
+            ('http://localhost/', '/a', None): 4,
+            ('http://localhost/', '/c', None): 1,
+        })
+        self.assertEqual(hottest_requests(db.session, 2), [
+            ('http://localhost/', '/a', None),
+            ('http://localhost/', '/b', 'text/csv'),
+        ])
+        self.assertEqual(len(hottest_requests(db.session, 10)), 3)
+
+    def test_request_counts_ageing(self):
+        store_request_counts(db.session, {
+            ('http://localhost/', '/a', None): 4,
+            ('http://localhost/', '/b', None): 1,
+            ('http://localhost/', '/c', None): 1,
+        })
+        age_request_counts(db.session, 3)
+        self.assertEqual(len(hottest_requests(db.session, 10)), 3)
+        age_request_counts(db.session, 2)
+        self.assertEqual(hottest_requests(db.session, 10), [('http://localhost/', '/a', None)])
+
+    def test_warmer_warms_shared_requests(self):
+        link_id = self.get_some_link_id()
+        path = API_PREFIX + '/links/{0}/'.format(link_id)
+
+        # Requests tracked by another process are warmed by this one
+        store_request_counts(db.session, {('http://localhost/', path, None): 2})
+        self.client.get(API_PREFIX + '/links/nonexistent/')
+        self.assertEqual(len(self.tracker), 1)
+
+        warmer = self.app.extensions['cache_warmer']
+        with patch.dict(self.app.config, CACHE_WARM_COUNT=10):
+            self.assertEqual(warmer.warm(), 1)
+        self.assertEqual(len(self.tracker), 0)
+        self.assertEqual(len(hottest_requests(db.session, 10)), 2)
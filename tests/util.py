@@ -23,6 +23,9 @@ raises_integrity_error = raises(exc.IntegrityError)
 log.info('Creating new flask app')
 app = create_app()
 
+# Background cache warming would race with the per-test transactions
+app.config['CACHE_WARM_COUNT'] = 0
+
 # Setup mixer
 mixer.init_app(app)
 
@@ -46,12 +49,22 @@ class TestCase(FlaskTestCase):
         with app.app_context():
             # Delete any data initially present
             drop_all_data()
+            app.extensions['link_id_cache'].clear()
 
             # Create fixtures with logging temporarily disabled
             cls.create_fixtures()
             db.session.commit()
 
     def setUp(self):
+        # Cached responses are keyed by change versions which are rolled back
+        # between tests and so may be reused with different data
+        response_cache = app.extensions['response_cache']
+        if response_cache is not None:
+            response_cache.clear()
+
+        # Links created by a test are rolled back
+        app.extensions['link_id_cache'].clear()
+
         # Start transaction
         db.session.begin_nested()
 
@@ -63,6 +76,14 @@ class TestCase(FlaskTestCase):
         pass
 
 def drop_all_data():
+    db.session.query(ChangeVersion).delete()
+    db.session.query(RequestCount).delete()
+    db.session.query(LatestObservation).delete()
+    db.session.query(LinkProfile).delete()
+    db.session.query(ObservationRollupDirty).delete()
+    db.session.query(ObservationRollup).delete()
+    db.session.query(ObservationSketch).delete()
+    db.session.query(ObservationStats).delete()
     db.session.query(Observation).delete()
     db.session.query(LinkAlias).delete()
     db.session.query(Link).delete()
@@ -108,18 +129,46 @@ class ApiTestCase(TestCase):
         properties, page, links = self.parse_links_response(response)
         return links[0]['id']
 
-    def get_observations(self, link_id, start=None, duration=None):
+    def get_observations(self, link_id, start=None, duration=None, types=None,
+            resolution=None, max_points=None, downsample=None, points=None,
+            headers=None):
         """Make an observations query"""
         query = {}
         if start is not None:
             query['start'] = start
         if duration is not None:
             query['duration'] = duration
+        if types is not None:
+            query['types'] = types
+        if resolution is not None:
+            query['resolution'] = resolution
+        if max_points is not None:
+            query['maxPoints'] = max_points
+        if downsample is not None:
+            query['downsample'] = downsample
+        if points is not None:
+            query['points'] = points
         url = API_PREFIX + '/links/{0}/observations'.format(link_id)
         if len(query) > 0:
             url += '?' + urlencode(query)
         log.info('GET {0}'.format(url))
-        return self.client.get(url)
+        return self.client.get(url, headers=headers)
+
+    def post_observations(self, create, on_conflict=None):
+        """Make a bulk observation create request"""
+        url = API_PREFIX + '/observations/'
+        if on_conflict is not None:
+            url += '?' + urlencode(dict(onConflict=on_conflict))
+        log.info('POST {0}'.format(url))
+        return self.client.post(url,
+                data=json.dumps(dict(create=create)), content_type='application/json')
+
+    def patch_observations(self, link_id, create):
+        """Make an observation create request for a single link"""
+        url = API_PREFIX + '/links/{0}/observations'.format(link_id)
+        log.info('PATCH {0}'.format(url))
+        return self.client.patch(url,
+                data=json.dumps(dict(create=create)), content_type='application/json')
 
     def get_link_aliases(self, from_=None, count=None):
         """Make a link alias query"""
@@ -128,7 +177,8 @@ class ApiTestCase(TestCase):
             from_= from_, count = count,
         )
 
-    def validate_observations_response(self, link_id, response):
+    def validate_observations_response(self, link_id, response,
+            types=('speed', 'flow', 'occupancy')):
         # Response should look like:
         # {
         #   "link": {
@@ -158,14 +208,13 @@ class ApiTestCase(TestCase):
         self.assertIn('earlier', query)
         self.assertIn('later', query)
 
-        self.assertIn('speed', data)
-        self.assertIn('flow', data)
-        self.assertIn('occupancy', data)
+        self.assertEqual(set(data.keys()), set(types))
+        self.assertEqual(set(query['types']), set(types))
 
         log.info('Returned data: {0}'.format(data))
         total_value_count = 0
         for k, v in data.items():
-            self.assertIn(k, ('speed', 'flow', 'occupancy'))
+            self.assertIn(k, types)
             self.assertIn('values', v)
             total_value_count += len(v['values'])
             for ts, obs in v['values']:
@@ -2,7 +2,12 @@
 
 """
 import base64
+from collections import OrderedDict
+import csv
 import datetime
+import hashlib
+import itertools
+from types import GeneratorType
 try:
     from urllib.parse import urljoin, urlencode, parse_qs
 except ImportError:
@@ -13,17 +18,67 @@ import uuid
 from flask import *
 import six
 from sqlalchemy import func
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import DataError, IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
 import pytz
 from werkzeug.exceptions import NotFound, BadRequest
 
+from trafficdb.cache import NOT_FOUND
+from trafficdb.coalesce import AdvisoryLock
+from trafficdb.columnar import (
+        ARROW_STREAM_MIMETYPE,
+        NPZ_MIMETYPE,
+        arrow_available,
+        columnar_available,
+        encode_arrow_stream,
+        encode_npz,
+        observation_columns,
+        rollup_columns,
+)
+from trafficdb.downsample import (
+        DOWNSAMPLE_METHODS,
+        MIN_POINTS,
+        downsampling_available,
+        lttb_indices,
+)
+from trafficdb.ingest import CONFLICT_POLICIES, copy_observations
 from trafficdb.models import *
+from trafficdb.partitions import as_utc
+from trafficdb.rollups import (
+        PROFILE_SLOT,
+        RESOLUTIONS,
+        SKETCH_RESOLUTION,
+        profile_slot,
+        refresh_rollups,
+)
+from trafficdb.sketches import sketch_quantiles
+from trafficdb.warming import WARMING_ENVIRON_KEY
+from trafficdb.versions import (
+        ALIASES,
+        HISTORY,
+        LINKS,
+        OBSERVATIONS,
+        bump_versions,
+        get_versions,
+        link_aliases_version_name,
+        link_version_name,
+)
 from trafficdb.queries import (
-        observation_date_range,
+        cached_observation_date_range,
+        latest_observation_values,
+        link_observation_values,
+        links_for_aliases,
+        links_for_uuids,
+        observation_values,
         observations_for_link,
+        observations_for_links,
         prepare_resolve_link_aliases,
+        profile_for_link,
+        snapshot_observation_values,
         resolve_link_aliases,
+        rollup_values,
+        rollups_for_link,
+        sketches_for_link,
 )
 
 __all__ = ['api']
@@ -37,9 +92,43 @@ app = api
 # Maximum number of results to return
 PAGE_LIMIT = 20
 
+# Maximum number of observations which may be created in one request
+INGEST_LIMIT = 200000
+
+# Number of observations loaded per chunk in streaming uploads
+INGEST_CHUNK_SIZE = 10000
+
+# Maximum number of links which may be queried for observations at once
+MULTI_LINK_LIMIT = 5000
+
+# Maximum number of link ids to resolve in a single database query
+LINK_RESOLVE_BATCH_SIZE = 1000
+
 # Maximum duration to query over in *milliseconds*
 MAX_DURATION = 3*24*60*60*1000
 
+# Maximum duration to query rollups over in *milliseconds* keyed by rollup
+# resolution. Observations arrive at most once a minute and so a rollup
+# returns at most as many points as a raw query over MAX_DURATION.
+ROLLUP_MAX_DURATIONS = dict((res, MAX_DURATION * res // 60) for res in RESOLUTIONS)
+
+# Default and maximum tolerance of network snapshots in *milliseconds*
+SNAPSHOT_TOLERANCE = 15*60*1000
+MAX_SNAPSHOT_TOLERANCE = 6*60*60*1000
+
+# Quantiles returned by the quantiles view if none are requested
+DEFAULT_QUANTILES = (0.5, 0.85, 0.95)
+
+# Number of rows fetched from the database at once and number of array items
+# encoded at once by streamed JSON responses
+STREAM_BATCH_SIZE = 2000
+
+# Streamed JSON responses are sent in chunks of at least this many characters
+STREAM_CHUNK_SIZE = 16*1024
+
+# Endpoints whose requests are tracked and warmed after ingest
+WARMED_ENDPOINTS = ('api.observations', 'api.link')
+
 JAVASCRIPT_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)
 
 def javascript_timestamp_to_datetime(ts):
@@ -64,7 +153,8 @@ def urlsafe_id_to_uuid(urlsafe_id):
 
 def verify_link_id(unverified_link_id):
     """Return a Link given the unverified link id from a URL. Aborts with 404
-    if the link id is invalid or not found.
+    if the link id is invalid or not found. Links and non-existent link ids
+    are remembered by the process's link id cache.
 
     """
     # Verify link id
@@ -74,15 +164,59 @@ def verify_link_id(unverified_link_id):
         # If the uuid is invalid, just return 404
         return abort(404)
 
+    link_id_cache = current_app.extensions['link_id_cache']
+    row = link_id_cache.get(link_uuid)
+    if row is NOT_FOUND:
+        raise NotFound()
+    if row is not None:
+        return row
+
     link_q = db.session.query(Link.id, Link.uuid).filter(Link.uuid == link_uuid).limit(1)
     try:
-        return link_q.one()
+        row = link_q.one()
     except NoResultFound:
         # 404 on non-existent link
+        link_id_cache.set(link_uuid, None)
         raise NotFound()
 
-    # Should be unreachable
-    assert False
+    link_id_cache.set(link_uuid, row)
+    return row
+
+def resolve_link_ids(unverified_link_ids):
+    """Return a dict mapping unverified link ids from a request to link
+    primary keys. Link ids which are invalid or not found are omitted from
+    the result. Links are resolved in batches of LINK_RESOLVE_BATCH_SIZE.
+
+    """
+    # Map link UUIDs back to the link id which was requested
+    requested_ids = {}
+    for unverified_link_id in set(unverified_link_ids):
+        try:
+            requested_ids[urlsafe_id_to_uuid(unverified_link_id)] = unverified_link_id
+        except:
+            # Invalid link ids are simply not resolved
+            pass
+
+    link_uuids = list(requested_ids.keys())
+    resolved = {}
+    for idx in range(0, len(link_uuids), LINK_RESOLVE_BATCH_SIZE):
+        batch = link_uuids[idx:idx+LINK_RESOLVE_BATCH_SIZE]
+        for link_id, link_uuid in links_for_uuids(db.session, batch):
+            resolved[requested_ids[uuid.UUID(link_uuid).hex]] = link_id
+    return resolved
+
+def resolve_alias_links(aliases):
+    """Return a dict mapping link aliases to (link primary key, link uuid)
+    pairs. Aliases which are not found are omitted from the result. Aliases
+    are resolved in batches of LINK_RESOLVE_BATCH_SIZE.
+
+    """
+    aliases = list(set(aliases))
+    resolved = {}
+    for idx in range(0, len(aliases), LINK_RESOLVE_BATCH_SIZE):
+        batch = aliases[idx:idx+LINK_RESOLVE_BATCH_SIZE]
+        resolved.update((r[0], (r[1], r[2])) for r in links_for_aliases(db.session, batch))
+    return resolved
 
 class ApiBadRequest(BadRequest):
     def __init__(self, message):
@@ -110,6 +244,304 @@ def extend_request_query(base_url, query):
         qs[k] = [v,]
     return urljoin(base_url, '?' + urlencode(qs, doseq=True))
 
+def get_cache_validators(names, variant=None):
+    """Return an (etag, last_modified) pair for a response derived from the
+    data named by the sequence of change version names at their current
+    versions. variant distinguishes representations of the same resource,
+    e.g. negotiated media types. last_modified is None if no name has been
+    bumped. See trafficdb.versions.
+
+    Versions should be read before the data they name so that a concurrent
+    write can only make the ETag older than the response.
+
+    """
+    versions = get_versions(db.session, names)
+    digest = hashlib.sha1()
+    for name in sorted(versions.keys()):
+        digest.update('{0}={1};'.format(name, versions[name][0]).encode('utf8'))
+    if variant is not None:
+        digest.update(variant.encode('utf8'))
+
+    modified = list(m for _, m in versions.values() if m is not None)
+    return digest.hexdigest(), max(modified) if len(modified) > 0 else None
+
+def window_version_names(link_id):
+    """Return the change version names of a response for a time window of
+    observations of link_id. If the "start" query parameter is omitted, the
+    window follows the latest observation of any link and so OBSERVATIONS is
+    included so that Last-Modified changes when the window moves.
+
+    """
+    names = [link_version_name(link_id), HISTORY]
+    if request.args.get('start') is None:
+        names.append(OBSERVATIONS)
+    return names
+
+def is_not_modified(etag, last_modified):
+    """Return True if the conditional headers of the request show that the
+    client already holds the response identified by etag and last_modified.
+    If-None-Match takes precedence over If-Modified-Since.
+
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since is not None and last_modified is not None:
+        # HTTP dates have a resolution of one second
+        return as_utc(last_modified).replace(microsecond=0) <= \
+                as_utc(request.if_modified_since)
+    return False
+
+def set_cache_headers(response, etag, last_modified, max_age=0):
+    """Set the ETag, Last-Modified and Cache-Control headers of response and
+    return it. Shared caches may store the response. If max_age is zero, the
+    response must be revalidated before each use. Otherwise it may be used
+    for max_age seconds.
+
+    """
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    if max_age == 0:
+        response.cache_control.no_cache = True
+    return response
+
+def not_modified_response(etag, last_modified, max_age=0):
+    """Return an empty 304 response with cache headers as for
+    set_cache_headers().
+
+    """
+    return set_cache_headers(Response(status=304), etag, last_modified, max_age)
+
+def response_cache_key(etag):
+    """Return the response cache key of the current request given the ETag
+    of its response. The key comprises the host, endpoint, view arguments and
+    query parameters in a canonical order.
+
+    """
+    parts = [request.host_url, request.endpoint]
+    parts.extend(u'{0}={1}'.format(k, v) for k, v in sorted(request.view_args.items()))
+    parts.extend(u'{0}={1}'.format(k, v) for k, v in sorted(request.args.items(multi=True)))
+    parts.append(etag)
+    return u'\n'.join(parts)
+
+def get_cached_response(key):
+    """Return a response from the response cache for key or None if there is
+    no cached response.
+
+    """
+    cache = current_app.extensions['response_cache']
+    value = cache.get(key) if cache is not None else None
+    if value is None:
+        return None
+    mimetype, _, body = value.partition(b'\n')
+    return Response(body, mimetype=mimetype.decode('utf8'))
+
+def cache_response(key, response):
+    """Store the body of response in the response cache under key and return
+    response. Responses larger than RESPONSE_CACHE_MAX_ITEM_SIZE are not
+    stored.
+
+    A streamed response is stored once it has been sent in full unless the
+    request holds a turn for key, see coalesce_request(). The body is then
+    read before the response is sent and the turn ends as soon as the body is
+    stored or found to be too large so that identical requests need not wait
+    for a slow client.
+
+    """
+    cache = current_app.extensions['response_cache']
+    if cache is None or response.status_code != 200:
+        end_coalesced_request(key)
+        return response
+
+    max_size = current_app.config['RESPONSE_CACHE_MAX_ITEM_SIZE']
+    prefix = response.mimetype.encode('utf8') + b'\n'
+    if not response.is_streamed:
+        body = response.get_data()
+        if len(body) <= max_size:
+            cache.set(key, prefix + body)
+        end_coalesced_request(key)
+        return response
+
+    def encode(chunks):
+        for chunk in chunks:
+            yield chunk if isinstance(chunk, bytes) else chunk.encode(response.charset)
+    chunks = encode(response.response)
+
+    if key in getattr(g, 'coalesced_turns', {}):
+        captured, size = [], 0
+        for chunk in chunks:
+            captured.append(chunk)
+            size += len(chunk)
+            if size > max_size:
+                # Identical requests must compute the response themselves
+                end_coalesced_request(key)
+                response.response = itertools.chain(captured, chunks)
+                return response
+
+        body = b''.join(captured)
+        cache.set(key, prefix + body)
+        end_coalesced_request(key)
+        response.set_data(body)
+        return response
+
+    def capture(chunks):
+        # Chunks are collected only until the body is too large
+        captured, size = [], 0
+        for chunk in chunks:
+            if captured is not None:
+                size += len(chunk)
+                if size <= max_size:
+                    captured.append(chunk)
+                else:
+                    captured = None
+            yield chunk
+        if captured is not None:
+            cache.set(key, prefix + b''.join(captured))
+
+    response.response = capture(chunks)
+    return response
+
+def coalesce_request(cache_key):
+    """Take a turn among identical concurrent requests which missed the
+    response cache under cache_key. Returns a response from the cache if an
+    identical request cached one while waiting or None if the caller should
+    compute the response and pass it to cache_response(), which ends the
+    turn. A request which had to wait ends its turn at once: it is served from
+    the cache or, if the previous turn did not cache a response, e.g. because
+    it was too large, computes its response concurrently with other waiting
+    requests.
+
+    Requests are coalesced within the process if COALESCE_REQUESTS is set and
+    also across processes if COALESCE_ADVISORY_LOCKS is set.
+
+    """
+    if current_app.extensions['response_cache'] is None or \
+            not current_app.config['COALESCE_REQUESTS']:
+        return None
+
+    turns = getattr(g, 'coalesced_turns', {})
+    g.coalesced_turns = turns
+
+    single_flight = current_app.extensions['single_flight']
+    waited = single_flight.acquire(cache_key)
+    turns[cache_key] = None
+
+    if current_app.config['COALESCE_ADVISORY_LOCKS']:
+        lock = AdvisoryLock(db.engine, cache_key)
+        try:
+            waited = lock.acquire() or waited
+        except:
+            end_coalesced_request(cache_key)
+            raise
+        turns[cache_key] = lock
+
+    if not waited:
+        return None
+    # The previous turn has ended and so this one is not needed to fill the
+    # cache: it ends before any cached body is sent to a possibly slow client
+    end_coalesced_request(cache_key)
+    return get_cached_response(cache_key)
+
+def end_coalesced_request(cache_key):
+    """End the turn taken by coalesce_request() for cache_key if the current
+    request holds one.
+
+    """
+    turns = getattr(g, 'coalesced_turns', {})
+    if cache_key not in turns:
+        return
+    lock = turns.pop(cache_key)
+    try:
+        if lock is not None:
+            lock.release()
+    finally:
+        current_app.extensions['single_flight'].release(cache_key)
+
+@app.before_request
+def track_request():
+    """Record client requests to endpoints in WARMED_ENDPOINTS so that the
+    most frequent may be warmed after ingest and start the warmer of this
+    process so that it flushes them. See trafficdb.warming.
+
+    """
+    if request.method != 'GET' or request.endpoint not in WARMED_ENDPOINTS:
+        return
+    if request.environ.get(WARMING_ENVIRON_KEY):
+        return
+    current_app.extensions['access_tracker'].record(
+            request.url_root, request.full_path, request.headers.get('Accept'))
+    current_app.extensions['cache_warmer'].start()
+
+@app.teardown_request
+def end_coalesced_requests(exc):
+    """End any turns taken by coalesce_request() which were not ended by
+    cache_response(), e.g. because the view failed.
+
+    """
+    for cache_key in list(getattr(g, 'coalesced_turns', {}).keys()):
+        end_coalesced_request(cache_key)
+
+def historical_max_age(end_date):
+    """Return the number of seconds a response for a time window ending at
+    end_date may be used without revalidation. Windows entirely in the past
+    change only if observations are backfilled and so may be used for
+    HISTORICAL_MAX_AGE seconds. Other windows must always be revalidated.
+
+    """
+    if end_date < pytz.utc.localize(datetime.datetime.utcnow()):
+        return current_app.config['HISTORICAL_MAX_AGE']
+    return 0
+
+def iter_json(obj):
+    """Yield the JSON encoding of obj in pieces. Dictionaries are encoded
+    key by key in iteration order and generators are encoded as arrays
+    STREAM_BATCH_SIZE items at a time. All other values are encoded in one
+    piece when reached and so may be populated by a generator encoded before
+    them.
+
+    """
+    if isinstance(obj, dict):
+        yield '{'
+        for idx, (key, value) in enumerate(obj.items()):
+            yield (',' if idx > 0 else '') + json.dumps(key) + ':'
+            for piece in iter_json(value):
+                yield piece
+        yield '}'
+    elif isinstance(obj, GeneratorType):
+        yield '['
+        sep = ''
+        while True:
+            batch = list(itertools.islice(obj, STREAM_BATCH_SIZE))
+            if len(batch) == 0:
+                break
+            # Strip the brackets from the encoded batch
+            yield sep + json.dumps(batch)[1:-1]
+            sep = ','
+        yield ']'
+    else:
+        yield json.dumps(obj)
+
+def stream_json(obj):
+    """Return a streaming response with the JSON encoding of obj as
+    generated by iter_json(). The response starts as soon as the first
+    STREAM_CHUNK_SIZE characters have been encoded and so generators should
+    fetch rows with Query.yield_per() to bound the memory used.
+
+    """
+    def generate():
+        chunk, chunk_len = [], 0
+        for piece in iter_json(obj):
+            chunk.append(piece)
+            chunk_len += len(piece)
+            if chunk_len >= STREAM_CHUNK_SIZE:
+                yield ''.join(chunk)
+                chunk, chunk_len = [], 0
+        yield ''.join(chunk)
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
 @app.route('/links/')
 def links():
     try:
@@ -125,6 +557,15 @@ def links():
     if requested_count < 0:
         raise ApiBadRequest('count parameter must be positive')
 
+    etag, last_modified = get_cache_validators([LINKS])
+    if is_not_modified(etag, last_modified):
+        return not_modified_response(etag, last_modified)
+
+    cache_key = response_cache_key(etag)
+    response = get_cached_response(cache_key)
+    if response is not None:
+        return set_cache_headers(response, etag, last_modified)
+
     # Query link objects
     links_q = db.session.query(Link.uuid, func.ST_AsGeoJSON(Link.geom)).order_by(Link.uuid)
 
@@ -156,33 +597,30 @@ def links():
         )
         return feature
 
-    links = list(row_to_dict(l) for l in links_q)
-
-    # How many links to return and do we still have more?
-    count = min(requested_count, len(links))
-
-    # Limit size of output
-    next_link_id = links[requested_count]['id'] if len(links) > requested_count else None
-    links = links[:requested_count]
+    # The features are streamed and then the page is formed from the number
+    # of features sent and whether there was an extra link.
+    page = dict(count=0)
+
+    def features():
+        for row in links_q.yield_per(STREAM_BATCH_SIZE):
+            if page['count'] == requested_count:
+                # Form next url
+                page['next'] = extend_request_query(
+                    url_for('.links', _external=True),
+                    {'from': uuid_to_urlsafe_id(row[0])}
+                )
+                break
+            page['count'] += 1
+            yield row_to_dict(row)
 
     # Form response
-    page = dict(count = count)
-    feature_collection = dict(
-        type='FeatureCollection',
-        features=links,
-        properties=dict(page=page),
-    )
-
-    # Form next url if necessary
-    if next_link_id is not None:
-        next_args = parse_qs(request.query_string)
-        next_args['from'.encode('utf8')] = [next_link_id,]
-        page['next'] = extend_request_query(
-            url_for('.links', _external=True),
-            {'from': next_link_id}
-        )
-
-    return jsonify(feature_collection)
+    feature_collection = OrderedDict((
+        ('type', 'FeatureCollection'),
+        ('features', features()),
+        ('properties', dict(page=page)),
+    ))
+    response = cache_response(cache_key, stream_json(feature_collection))
+    return set_cache_headers(response, etag, last_modified)
 
 @app.route('/links/', methods=['PATCH'])
 def patch_links():
@@ -211,6 +649,7 @@ def patch_links():
             uuid=uuid.uuid4().hex,
             geom=func.ST_SetSRID(func.ST_GeomFromGeoJSON(geom_geojson), 4326)))
     db.session.add_all(created_links)
+    bump_versions(db.session, [LINKS])
 
     def make_create_response(l):
         id = uuid_to_urlsafe_id(l.uuid)
@@ -218,32 +657,74 @@ def patch_links():
     create_responses = list(make_create_response(l) for l in created_links)
 
     db.session.commit()
+
+    # The new links may have been looked up before they existed
+    link_id_cache = current_app.extensions['link_id_cache']
+    for l in created_links:
+        link_id_cache.invalidate(l.uuid)
+
     response = dict(create=create_responses)
     return jsonify(response)
 
-@app.route('/links/<unverified_link_id>/observations')
-def observations(unverified_link_id):
-    # Verify link id
-    link_id, link_uuid = verify_link_id(unverified_link_id)
-    link_urlsafe_id=uuid_to_urlsafe_id(link_uuid)
-    link_data = dict(id=link_urlsafe_id)
+def parse_observation_types(type_names):
+    """Return a list of ObservationTypes given a sequence of type names or
+    None for all types. Aborts with 400 if a type is unknown.
+
+    """
+    if type_names is None:
+        return list(ObservationType)
 
-    # Work out if a time range has been specified
     try:
-        duration = int(request.args.get('duration', MAX_DURATION))
+        types = list(ObservationType(t) for t in type_names)
     except ValueError:
+        raise ApiBadRequest('types must be a list of: {0}'.format(
+            ', '.join(type.value for type in ObservationType)))
+
+    # Remove duplicates preserving order
+    return list(t for idx, t in enumerate(types) if t not in types[:idx])
+
+def get_observation_types():
+    """Return a list of the ObservationTypes requested via the "types" query
+    parameter. This is a comma-separated list of type names and defaults to
+    all types. Aborts with 400 if a type is unknown.
+
+    """
+    types_param = request.args.get('types')
+    return parse_observation_types(
+            types_param.split(',') if types_param is not None else None)
+
+def parse_duration(duration, default, name='duration'):
+    """Parse a duration parameter in milliseconds returning an integer.
+    duration may be None in which case default is returned. name is the name
+    of the parameter used in error messages. Aborts with 400 if the duration
+    is malformed or negative.
+
+    """
+    try:
+        duration = int(duration if duration is not None else default)
+    except (TypeError, ValueError, OverflowError):
         # If duration can't be parsed as an integer, that's a bad request
-        raise ApiBadRequest('duration parameter must be an integer')
+        raise ApiBadRequest('{0} parameter must be an integer'.format(name))
 
-    # Restrict duration to the maximum we're comfortable with
-    duration = min(MAX_DURATION, duration)
     if duration < 0:
-        raise ApiBadRequest('duration parameter must be positive')
+        raise ApiBadRequest('{0} parameter must be positive'.format(name))
+    return duration
+
+def parse_time_window(start_ts, duration, max_duration=MAX_DURATION):
+    """Sanitise the start timestamp and duration of an observations query
+    returning a (start_ts, duration) pair of integers. Either may be None.
+    The duration defaults to, and is limited to, max_duration. If start_ts
+    is None, the window ends at the latest observation. Aborts with 400 if
+    either is malformed.
+
+    """
+    # Restrict duration to the maximum we're comfortable with
+    duration = min(max_duration, parse_duration(duration, max_duration))
 
-    start_ts = request.args.get('start')
     if start_ts is None:
         # Get minimum and maximum times
-        min_d, max_d = observation_date_range(db.session).one()
+        date_range = cached_observation_date_range(db.session).first()
+        min_d, max_d = date_range if date_range is not None else (None, None)
 
         # Corner case: if there are no observations in the database, it doesn't
         # really matter what start time we use so just use now.
@@ -257,11 +738,228 @@ def observations(unverified_link_id):
         # Verify start ts is indeed an integer
         try:
             start_ts = int(start_ts)
-        except ValueError:
+        except (TypeError, ValueError, OverflowError):
             raise ApiBadRequest('start timestamp must be an integer')
 
+        # The window must be representable as datetimes
+        try:
+            javascript_timestamp_to_datetime(start_ts)
+            javascript_timestamp_to_datetime(start_ts + duration)
+        except OverflowError:
+            raise ApiBadRequest('start timestamp is out of range')
+
+    return start_ts, duration
+
+def parse_at(value):
+    """Parse the "at" query parameter which must be an integer JavaScript
+    timestamp representable as a datetime. Returns a (timestamp, datetime)
+    pair. Aborts with 400 otherwise.
+
+    """
+    try:
+        at_ts = int(value)
+    except (TypeError, ValueError, OverflowError):
+        raise ApiBadRequest('at timestamp must be an integer')
+    try:
+        return at_ts, javascript_timestamp_to_datetime(at_ts)
+    except (OverflowError, ValueError):
+        raise ApiBadRequest('at timestamp is out of range')
+
+def parse_positive_int(value, name):
+    """Parse a query parameter which must be a positive integer. Aborts with
+    400 otherwise.
+
+    """
+    try:
+        value = int(value)
+    except ValueError:
+        raise ApiBadRequest('{0} parameter must be an integer'.format(name))
+    if value < 1:
+        raise ApiBadRequest('{0} parameter must be positive'.format(name))
+    return value
+
+def get_resolution(duration):
+    """Return a (resolution, duration) pair where resolution is the rollup
+    resolution in seconds selected by the "resolution" or "maxPoints" query
+    parameters or None if raw observations should be returned. duration is
+    the unparsed duration parameter and the returned duration is the one to
+    query over.
+
+    "resolution" is the coarsest acceptable spacing between points in
+    seconds. The coarsest rollup no coarser than this is selected or, if there
+    is none, raw observations. "maxPoints" is the maximum number of points to
+    return for each type. Raw observations, which arrive at most once a
+    minute, or the finest rollup which returns no more points over duration
+    is selected or, if there is none, the coarsest rollup. The duration then
+    defaults to MAX_DURATION, the duration the choice was made for, rather
+    than to the maximum duration of the selected resolution. Aborts with 400
+    if the parameters are malformed or both are given.
+
+    """
+    resolution = request.args.get('resolution')
+    max_points = request.args.get('maxPoints')
+    if resolution is not None and max_points is not None:
+        raise ApiBadRequest('only one of resolution and maxPoints may be specified')
+
+    if resolution is not None:
+        resolution = parse_positive_int(resolution, 'resolution')
+        candidates = list(res for res in RESOLUTIONS if res <= resolution)
+        return (candidates[-1] if len(candidates) > 0 else None), duration
+
+    if max_points is not None:
+        max_points = parse_positive_int(max_points, 'maxPoints')
+        duration = parse_duration(duration, MAX_DURATION)
+        for res, spacing, max_duration in [(None, 60, MAX_DURATION)] + \
+                list((res, res, ROLLUP_MAX_DURATIONS[res]) for res in RESOLUTIONS):
+            # Windows include both ends and so may hold one extra point
+            if duration <= max_duration and duration // (spacing*1000) + 1 <= max_points:
+                return res, duration
+        return RESOLUTIONS[-1], duration
+
+    return None, duration
+
+def get_downsample():
+    """Return a (method, points) pair from the "downsample" and "points" query
+    parameters or (None, None) if no downsampling was requested. Aborts with
+    400 if the parameters are malformed or downsampling is unavailable.
+
+    """
+    method = request.args.get('downsample')
+    if method is None:
+        return None, None
+
+    if method not in DOWNSAMPLE_METHODS:
+        raise ApiBadRequest('downsample must be one of: {0}'.format(
+            ', '.join(DOWNSAMPLE_METHODS)))
+    if not downsampling_available():
+        raise ApiBadRequest('downsampling is not supported by this server')
+
+    points = request.args.get('points')
+    if points is None:
+        raise ApiBadRequest('points parameter is required when downsampling')
+    points = parse_positive_int(points, 'points')
+    if points < MIN_POINTS:
+        raise ApiBadRequest('points parameter must be at least {0}'.format(MIN_POINTS))
+
+    return method, points
+
+def downsample_series(series, points):
+    """Downsample the values of a series in an observations response to at
+    most points points in place. Any ranges are reduced to match.
+
+    """
+    values = series['values']
+    if len(values) <= points:
+        return
+
+    indices = lttb_indices(
+        list(v[0] for v in values), list(v[1] for v in values), points)
+    for key in ('values', 'ranges'):
+        if key in series:
+            series[key] = list(series[key][idx] for idx in indices)
+
+def series_values(q, types):
+    """Yield a (type, rows) pair for each of types where rows is an iterator
+    over the rows of q for that type. q should be ordered by type as returned
+    by observation_values() or rollup_values(). Rows are fetched
+    STREAM_BATCH_SIZE at a time in a single pass over q and so each iterator
+    must be exhausted before iteration of the next begins.
+
+    """
+    rows = iter(q.yield_per(STREAM_BATCH_SIZE))
+
+    # The first row not yet yielded by an iterator
+    pending = [next(rows, None)]
+
+    def type_rows(type):
+        row = pending[0]
+        while row is not None and row[0] == type:
+            yield row
+            row = next(rows, None)
+        pending[0] = row
+
+    # Types are ordered in the database as they are declared
+    for type in sorted(types, key=list(ObservationType).index):
+        yield type, type_rows(type)
+
+def series_from_values(rows, with_ranges):
+    """Return an observations response series from the rows of one type
+    yielded by series_values(). If with_ranges is True, rows are rollup rows
+    and the series has ranges.
+
+    """
+    if not with_ranges:
+        return dict(values=list((row[1], row[2]) for row in rows))
+
+    # Values are bucket means. Ranges give the minimum and maximum.
+    series = dict(values=[], ranges=[])
+    for _, timestamp, mean, min_value, max_value in rows:
+        series['values'].append((timestamp, mean))
+        series['ranges'].append((timestamp, min_value, max_value))
+    return series
+
+def stream_series(rows, with_ranges):
+    """As series_from_values() but returns a series for stream_json() whose
+    values are generated from rows. Ranges are collected as values are
+    generated and encoded after them.
+
+    """
+    if not with_ranges:
+        return dict(values=((row[1], row[2]) for row in rows))
+
+    ranges = []
+    def values():
+        for _, timestamp, mean, min_value, max_value in rows:
+            ranges.append((timestamp, min_value, max_value))
+            yield (timestamp, mean)
+
+    return OrderedDict((('values', values()), ('ranges', ranges)))
+
+def get_columnar_format():
+    """Return the media type of the columnar encoding of observations
+    preferred to JSON by the Accept header or None if JSON should be
+    returned. Encodings whose dependencies are missing are not offered.
+
+    """
+    offered = []
+    if arrow_available():
+        offered.append(ARROW_STREAM_MIMETYPE)
+    if columnar_available():
+        offered.append(NPZ_MIMETYPE)
+
+    accept = request.accept_mimetypes
+    best = accept.best_match(offered)
+    if best is None or accept[best] <= accept['application/json']:
+        return None
+    return best
+
+def downsample_columns(columns, points):
+    """Return the columns of one type returned by observation_columns() or
+    rollup_columns() downsampled to at most points points.
+
+    """
+    indices = lttb_indices(columns['timestamp'], columns['value'], points)
+    return dict((name, column[indices]) for name, column in columns.items())
+
+@app.route('/links/<unverified_link_id>/observations')
+def observations(unverified_link_id):
+    # Verify link id
+    link_id, link_uuid = verify_link_id(unverified_link_id)
+    link_urlsafe_id=uuid_to_urlsafe_id(link_uuid)
+    link_data = dict(id=link_urlsafe_id)
+
+    # Rollups may be queried over longer durations than raw observations
+    resolution, duration = get_resolution(request.args.get('duration'))
+    max_duration = MAX_DURATION if resolution is None else ROLLUP_MAX_DURATIONS[resolution]
+
+    start_ts, duration = parse_time_window(request.args.get('start'), duration, max_duration)
+    types = get_observation_types()
+    downsample, points = get_downsample()
+
     # Record parameters of sanitised query
-    query_params = dict(start=start_ts, duration=duration)
+    query_params = dict(start=start_ts, duration=duration,
+            types=list(type.value for type in types), resolution=resolution,
+            downsample=downsample, points=points)
     query_params['earlier'] = extend_request_query(
         url_for('.observations', unverified_link_id=link_urlsafe_id, _external=True),
         dict(start=start_ts-duration),
@@ -274,15 +972,565 @@ def observations(unverified_link_id):
     start_date = javascript_timestamp_to_datetime(start_ts)
     end_date = javascript_timestamp_to_datetime(start_ts + duration)
 
+    # Observations may be returned as binary columns rather than JSON
+    columnar_format = get_columnar_format()
+
+    # The response depends on the sanitised query, whose start may default to
+    # the latest observation of any link, and on the negotiated format
+    etag, last_modified = get_cache_validators(window_version_names(link_id),
+            variant=json.dumps([query_params, columnar_format], sort_keys=True))
+    max_age = historical_max_age(end_date)
+    if is_not_modified(etag, last_modified):
+        response = not_modified_response(etag, last_modified, max_age)
+        response.vary.add('Accept')
+        return response
+
+    # Identical requests which miss the cache take turns to fill it
+    cache_key = response_cache_key(etag)
+    response = get_cached_response(cache_key)
+    if response is None:
+        response = coalesce_request(cache_key)
+    if response is not None:
+        response.vary.add('Accept')
+        return set_cache_headers(response, etag, last_modified, max_age)
+
+    if columnar_format is not None:
+        if resolution is None:
+            columns = observation_columns(db.session, link_id, types, start_date, end_date)
+        else:
+            columns = rollup_columns(
+                db.session, link_id, types, resolution, start_date, end_date)
+
+        if downsample is not None:
+            columns = dict((type, downsample_columns(type_columns, points))
+                    for type, type_columns in columns.items())
+
+        if columnar_format == ARROW_STREAM_MIMETYPE:
+            body = encode_arrow_stream(columns, types,
+                    metadata=dict(link=link_data, query=query_params))
+        else:
+            body = encode_npz(columns, types)
+
+        response = cache_response(cache_key, Response(body, mimetype=columnar_format))
+        response.vary.add('Accept')
+        return set_cache_headers(response, etag, last_modified, max_age)
+
+    # Fetch all requested types in one query
+    if resolution is None:
+        q = observation_values(
+                observations_for_link(db.session, link_id, types, start_date, end_date))
+    else:
+        q = rollup_values(rollups_for_link(
+            db.session, link_id, types, resolution, start_date, end_date))
+
+    if downsample is not None:
+        # Downsampling needs whole series and so the response is not streamed
+        data = dict((type.value, series_from_values(values, resolution is not None))
+                for type, values in series_values(q, types))
+        for series in data.values():
+            downsample_series(series, points)
+        response = cache_response(cache_key,
+                jsonify(dict(link=link_data, data=data, query=query_params)))
+        response.vary.add('Accept')
+        return set_cache_headers(response, etag, last_modified, max_age)
+
+    data = OrderedDict((type.value, stream_series(values, resolution is not None))
+            for type, values in series_values(q, types))
+    response = cache_response(cache_key, stream_json(
+        OrderedDict((('link', link_data), ('query', query_params), ('data', data)))))
+    response.vary.add('Accept')
+    return set_cache_headers(response, etag, last_modified, max_age)
+
+def get_quantiles():
+    """Return a list of the quantiles requested via the "q" query parameter.
+    This is a comma-separated list of numbers between 0 and 1 and defaults to
+    DEFAULT_QUANTILES. Aborts with 400 if a quantile is malformed.
+
+    """
+    q_param = request.args.get('q')
+    if q_param is None:
+        return list(DEFAULT_QUANTILES)
+
+    try:
+        qs = list(float(q) for q in q_param.split(','))
+    except ValueError:
+        raise ApiBadRequest('q must be a list of numbers')
+    if not all(0 <= q <= 1 for q in qs):
+        raise ApiBadRequest('q must be a list of numbers between 0 and 1')
+    return qs
+
+@app.route('/links/<unverified_link_id>/quantiles')
+def quantiles(unverified_link_id):
+    # Verify link id
+    link_id, link_uuid = verify_link_id(unverified_link_id)
+    link_data = dict(id=uuid_to_urlsafe_id(link_uuid))
+
+    # Sketches are hourly and so may be queried over the same duration as
+    # hourly rollups. Only hours starting within the window are included.
+    start_ts, duration = parse_time_window(
+            request.args.get('start'), request.args.get('duration'),
+            ROLLUP_MAX_DURATIONS[SKETCH_RESOLUTION])
+    types = get_observation_types()
+    qs = get_quantiles()
+
+    # Record parameters of sanitised query
+    query_params = dict(start=start_ts, duration=duration,
+            types=list(type.value for type in types), q=qs)
+
+    start_date = javascript_timestamp_to_datetime(start_ts)
+    end_date = javascript_timestamp_to_datetime(start_ts + duration)
+
+    # The start of the window may default to the latest observation of any
+    # link and so the sanitised query is part of the ETag
+    etag, last_modified = get_cache_validators(window_version_names(link_id),
+            variant=json.dumps(query_params, sort_keys=True))
+    max_age = historical_max_age(end_date)
+    if is_not_modified(etag, last_modified):
+        return not_modified_response(etag, last_modified, max_age)
+
+    sketches = dict((type, []) for type in types)
+    q = sketches_for_link(db.session, link_id, types, start_date, end_date)
+    for type, means, weights in q:
+        sketches[type].append((means, weights))
+
     data = {}
-    for type in ObservationType:
-        values = []
-        q = observations_for_link(db.session, link_id, type, start_date, end_date)
-        for obs in q:
-            values.append((datetime_to_javascript_timestamp(obs.observed_at), obs.value))
-        data[type.value] = dict(values=values)
+    for type, type_sketches in sketches.items():
+        values, count = sketch_quantiles(type_sketches, qs)
+        data[type.value] = dict(count=count, quantiles=list(zip(qs, values)))
+
+    response = dict(link=link_data, data=data, query=query_params)
+    return set_cache_headers(jsonify(response), etag, last_modified, max_age)
+
+@app.route('/links/<unverified_link_id>/profile')
+def profile(unverified_link_id):
+    # Verify link id
+    link_id, link_uuid = verify_link_id(unverified_link_id)
+    link_data = dict(id=uuid_to_urlsafe_id(link_uuid))
+
+    types = get_observation_types()
+    timezone = current_app.config['PROFILE_TIMEZONE']
+
+    # Optionally return only the slot containing a given time
+    at_ts, slot = request.args.get('at'), None
+    if at_ts is not None:
+        at_ts, at = parse_at(at_ts)
+        try:
+            slot = profile_slot(at, timezone)
+        except (OverflowError, ValueError):
+            # Conversion to the profile time zone left the datetime range
+            raise ApiBadRequest('at timestamp is out of range')
+
+    # Record parameters of sanitised query
+    query_params = dict(types=list(type.value for type in types), at=at_ts,
+            timezone=timezone, slotDuration=PROFILE_SLOT*1000)
+
+    etag, last_modified = get_cache_validators([link_version_name(link_id), HISTORY])
+    if is_not_modified(etag, last_modified):
+        return not_modified_response(etag, last_modified)
+
+    # Each value is a (slot, mean, standard deviation, count) tuple
+    data = dict((type.value, dict(values=[])) for type in types)
+    for type, slot, count, mean, stddev in profile_for_link(db.session, link_id, types, slot):
+        data[type.value]['values'].append((slot, mean, stddev, count))
 
     response = dict(link=link_data, data=data, query=query_params)
+    return set_cache_headers(jsonify(response), etag, last_modified)
+
+def get_bbox():
+    """Return the bounding box requested via the "bbox" query parameter as a
+    (min_lng, min_lat, max_lng, max_lat) tuple or None if not given. Aborts
+    with 400 if the bounding box is malformed.
+
+    """
+    bbox_param = request.args.get('bbox')
+    if bbox_param is None:
+        return None
+
+    try:
+        bbox = tuple(float(v) for v in bbox_param.split(','))
+    except ValueError:
+        raise ApiBadRequest('bbox must be a list of numbers')
+    if len(bbox) != 4 or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+        raise ApiBadRequest('bbox must be min longitude, min latitude, max longitude, max latitude')
+    return bbox
+
+@app.route('/network/latest')
+def network_latest():
+    types = get_observation_types()
+    bbox = get_bbox()
+
+    # Record parameters of sanitised query
+    query_params = dict(types=list(type.value for type in types), bbox=bbox)
+
+    etag, last_modified = get_cache_validators([OBSERVATIONS, LINKS])
+    if is_not_modified(etag, last_modified):
+        return not_modified_response(etag, last_modified)
+
+    # Data is keyed by link id and then by type. Each value is a (timestamp,
+    # value) pair.
+    data = {}
+    for link_uuid, type, timestamp, value in \
+            latest_observation_values(db.session, types, bbox=bbox):
+        link_data = data.setdefault(uuid_to_urlsafe_id(link_uuid), {})
+        link_data[type.value] = (timestamp, value)
+
+    response = dict(data=data, query=query_params)
+    return set_cache_headers(jsonify(response), etag, last_modified)
+
+@app.route('/network/snapshot')
+def network_snapshot():
+    types = get_observation_types()
+    bbox = get_bbox()
+
+    # The snapshot time defaults to the latest observation. A snapshot at a
+    # given time in the past changes only if observations are backfilled.
+    etag, last_modified = get_cache_validators([OBSERVATIONS, LINKS, HISTORY])
+    at_ts, max_age = request.args.get('at'), 0
+    if at_ts is None:
+        date_range = cached_observation_date_range(db.session).first()
+        latest = date_range[1] if date_range is not None else None
+        if latest is None:
+            latest = pytz.utc.localize(datetime.datetime.utcnow())
+        at_ts = datetime_to_javascript_timestamp(latest)
+        at = javascript_timestamp_to_datetime(at_ts)
+    else:
+        at_ts, at = parse_at(at_ts)
+        max_age = historical_max_age(at)
+
+    tolerance = parse_duration(request.args.get('tolerance'), SNAPSHOT_TOLERANCE, 'tolerance')
+    tolerance = min(MAX_SNAPSHOT_TOLERANCE, tolerance)
+
+    if is_not_modified(etag, last_modified):
+        return not_modified_response(etag, last_modified, max_age)
+
+    # Record parameters of sanitised query
+    query_params = dict(types=list(type.value for type in types), bbox=bbox,
+            at=at_ts, tolerance=tolerance)
+
+    # Data is keyed by link id and then by type. Each value is a (timestamp,
+    # value) pair.
+    data = {}
+    q = snapshot_observation_values(db.session, types, at,
+            datetime.timedelta(milliseconds=tolerance), bbox=bbox)
+    for link_uuid, type, timestamp, value in q:
+        link_data = data.setdefault(uuid_to_urlsafe_id(link_uuid), {})
+        link_data[type.value] = (timestamp, value)
+
+    response = dict(data=data, query=query_params)
+    return set_cache_headers(jsonify(response), etag, last_modified, max_age)
+
+def get_create_requests(limit):
+    """Return the "create" array from a JSON request body. Aborts with 400 if
+    the body is malformed or has more than limit items.
+
+    """
+    # Get request body as JSON document
+    body = request.get_json()
+
+    # Sanitise body
+    if body is None:
+        raise ApiBadRequest('request body must be non-empty')
+    if not isinstance(body, dict):
+        raise ApiBadRequest('request body must be a JSON object')
+
+    # Extract create requests
+    try:
+        create_requests = body['create']
+    except KeyError:
+        create_requests = []
+    if not isinstance(create_requests, list) or len(create_requests) > limit:
+        raise ApiBadRequest('create request must be an array of at most {0} items'.format(limit))
+
+    return create_requests
+
+def parse_observation_create_requests(create_requests, link_id=None, offset=0):
+    """Convert a sequence of observation create requests into a list of
+    (link_id, type, observed_at, value) tuples suitable for passing to
+    copy_observations(). If link_id is None, each request must have either a
+    "link" field giving the link id of the observation or an "alias" field
+    giving a link alias. Aborts with 400 if any request is malformed or
+    references a non-existent link. offset is added to request numbers in
+    error messages.
+
+    """
+    # Resolve all referenced links and aliases up-front
+    if link_id is None:
+        link_ids = resolve_link_ids(
+            r['link'] for r in create_requests
+            if isinstance(r, dict) and isinstance(r.get('link'), six.string_types)
+        )
+        alias_links = resolve_alias_links(
+            r['alias'] for r in create_requests
+            if isinstance(r, dict) and isinstance(r.get('alias'), six.string_types)
+        )
+
+    rows = []
+    for r in create_requests:
+        request_number = offset + len(rows) + 1
+        try:
+            type = ObservationType(r['type'])
+            observed_at, value = r['observedAt'], r['value']
+            assert isinstance(observed_at, six.integer_types)
+            assert isinstance(value, (float,) + six.integer_types)
+            assert not isinstance(value, bool)
+            if link_id is None:
+                link_ref = r.get('link', r.get('alias'))
+                assert isinstance(link_ref, six.string_types)
+        except:
+            raise ApiBadRequest('create request number {0} is malformed'.format(request_number))
+
+        if link_id is None:
+            try:
+                if 'link' in r:
+                    row_link_id = link_ids[link_ref]
+                else:
+                    row_link_id = alias_links[link_ref][0]
+            except KeyError:
+                raise ApiBadRequest(
+                    'create request number {0} references non-existent link "{1}"'.format(
+                        request_number, link_ref))
+        else:
+            row_link_id = link_id
+
+        try:
+            observed_at = javascript_timestamp_to_datetime(observed_at)
+        except (OverflowError, ValueError):
+            raise ApiBadRequest(
+                'create request number {0} has out of range observedAt'.format(request_number))
+
+        rows.append((row_link_id, type, observed_at, value))
+
+    return rows
+
+def get_conflict_policy():
+    """Return the conflict policy for an observation ingest request. This is
+    taken from the "onConflict" query parameter if present or from the
+    OBSERVATION_CONFLICT_POLICY configuration otherwise.
+
+    """
+    policy = request.args.get('onConflict',
+            current_app.config['OBSERVATION_CONFLICT_POLICY'])
+    if policy not in CONFLICT_POLICIES:
+        raise ApiBadRequest('onConflict parameter must be one of: {0}'.format(
+            ', '.join(CONFLICT_POLICIES)))
+    return policy
+
+def request_lines():
+    """Iterate over the lines of the request body without reading the entire
+    body into memory.
+
+    """
+    for line in request.stream:
+        if six.PY3:
+            line = line.decode('utf8')
+        yield line
+
+def ndjson_records(lines):
+    """Parse newline-delimited JSON observation records. Blank lines are
+    skipped. Aborts with 400 if a line is not valid JSON.
+
+    """
+    for line_idx, line in enumerate(lines):
+        if line.strip() == '':
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            raise ApiBadRequest('line {0} is not a valid JSON document'.format(line_idx+1))
+
+def csv_records(lines):
+    """Parse CSV observation records. The first line must be a header naming
+    the columns: "type", "observedAt", "value" and one of "link" or "alias".
+    Empty link or alias fields are ignored.
+
+    """
+    for record in csv.DictReader(lines):
+        # Remove empty fields so that "link" and "alias" columns may be mixed
+        record = dict((k, v) for k, v in record.items() if v not in (None, ''))
+
+        # Convert numeric fields leaving malformed ones to be reported later
+        try:
+            record['observedAt'] = int(record['observedAt'])
+            record['value'] = float(record['value'])
+        except (KeyError, ValueError):
+            pass
+
+        yield record
+
+def load_observations(rows, on_conflict):
+    """Load observations into the current session refreshing rollups if
+    ROLLUP_REFRESH_ON_INGEST is set. Returns the number of observations
+    inserted or updated. The caller is responsible for committing.
+
+    """
+    count = copy_observations(db.session, rows, on_conflict=on_conflict)
+    if current_app.config['ROLLUP_REFRESH_ON_INGEST']:
+        refresh_rollups(db.session, current_app.config['PROFILE_TIMEZONE'])
+    return count
+
+def stream_observation_upload(records, on_conflict):
+    """Return a streaming response which loads observations from the
+    iterable records in chunks of INGEST_CHUNK_SIZE using the conflict policy
+    on_conflict. Each chunk is committed as it is loaded and a line of JSON
+    reporting progress is sent. The final line is either a create response
+    or, on failure, an error. Counts are of observations inserted or updated
+    as for the non-streamed endpoint.
+
+    """
+    def generate():
+        submitted, total = 0, 0
+        try:
+            records_iter = iter(records)
+            chunk_idx = 0
+            while True:
+                chunk = list(itertools.islice(records_iter, INGEST_CHUNK_SIZE))
+                if len(chunk) == 0:
+                    break
+
+                rows = parse_observation_create_requests(chunk, offset=submitted)
+                count = load_observations(rows, on_conflict)
+                db.session.commit()
+                submitted += len(rows)
+                total += count
+
+                yield json.dumps(dict(progress=dict(
+                    chunk=chunk_idx, count=count, total=total))) + '\n'
+                chunk_idx += 1
+        except ApiBadRequest as e:
+            # Chunks already committed are kept
+            db.session.rollback()
+            yield json.dumps(dict(error=dict(message=e.description, total=total))) + '\n'
+            return
+        except IntegrityError:
+            db.session.rollback()
+            yield json.dumps(dict(error=dict(
+                message='observations already exist', total=total))) + '\n'
+            return
+        except DataError:
+            db.session.rollback()
+            yield json.dumps(dict(error=dict(
+                message='observation values are out of range', total=total))) + '\n'
+            return
+        except (UnicodeDecodeError, csv.Error, OverflowError):
+            db.session.rollback()
+            yield json.dumps(dict(error=dict(
+                message='upload is malformed after record {0}'.format(submitted), total=total))) + '\n'
+            return
+        finally:
+            # Committed chunks invalidate cached responses
+            if submitted > 0:
+                current_app.extensions['cache_warmer'].trigger()
+
+        yield json.dumps(dict(create={ 'status': 'ok', 'count': total })) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+def commit_observations(rows, on_conflict):
+    """Load and commit observations returning the number of observations
+    inserted or updated. Aborts with 400 if an observation is rejected by the
+    conflict policy.
+
+    """
+    try:
+        count = load_observations(rows, on_conflict)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        raise ApiBadRequest('invalid request (perhaps observations already exist?)')
+
+    # Refill the response cache for popular requests in the background
+    current_app.extensions['cache_warmer'].trigger()
+    return count
+
+@app.route('/observations/', methods=['POST'])
+def post_observations():
+    on_conflict = get_conflict_policy()
+
+    # Large uploads may be streamed as NDJSON or CSV
+    if request.mimetype == 'application/x-ndjson':
+        return stream_observation_upload(ndjson_records(request_lines()), on_conflict)
+    if request.mimetype == 'text/csv':
+        return stream_observation_upload(csv_records(request_lines()), on_conflict)
+
+    create_requests = get_create_requests(INGEST_LIMIT)
+    rows = parse_observation_create_requests(create_requests)
+    count = commit_observations(rows, on_conflict)
+
+    response = dict(create={ 'status': 'ok', 'count': count })
+    return jsonify(response)
+
+@app.route('/links/<unverified_link_id>/observations', methods=['PATCH'])
+def patch_observations(unverified_link_id):
+    link_id, _ = verify_link_id(unverified_link_id)
+    on_conflict = get_conflict_policy()
+    create_requests = get_create_requests(INGEST_LIMIT)
+    rows = parse_observation_create_requests(create_requests, link_id=link_id)
+    count = commit_observations(rows, on_conflict)
+
+    response = dict(create={ 'status': 'ok', 'count': count })
+    return jsonify(response)
+
+@app.route('/observations/query', methods=['POST'])
+def observations_query():
+    # Request body should be JSON
+    body = request.get_json()
+    if body is None:
+        raise ApiBadRequest('request body must be non-empty')
+    if not isinstance(body, dict):
+        raise ApiBadRequest('request body must be a JSON object')
+
+    # Retrieve and sanitise link and alias lists
+    requested = {}
+    for field in ('links', 'aliases'):
+        names = body.get(field, [])
+        if not isinstance(names, list):
+            raise ApiBadRequest('{0} must be an array'.format(field))
+        if any(not isinstance(n, six.string_types) for n in names):
+            raise ApiBadRequest('{0} must contain only strings'.format(field))
+        requested[field] = names
+    if len(requested['links']) + len(requested['aliases']) > MULTI_LINK_LIMIT:
+        raise ApiBadRequest('at most {0} links and aliases may be queried'.format(
+            MULTI_LINK_LIMIT))
+
+    types = body.get('types')
+    if types is not None and not isinstance(types, list):
+        raise ApiBadRequest('types must be an array')
+    types = parse_observation_types(types)
+    start_ts, duration = parse_time_window(body.get('start'), body.get('duration'))
+
+    # Resolve links and aliases to link primary keys
+    link_ids = resolve_link_ids(requested['links'])
+    alias_links = resolve_alias_links(requested['aliases'])
+
+    # Map link primary keys back to link ids for the response
+    response_ids = dict((v, k) for k, v in link_ids.items())
+    for link_id, link_uuid in alias_links.values():
+        if link_id not in response_ids:
+            response_ids[link_id] = uuid_to_urlsafe_id(link_uuid)
+
+    # Fetch all observations in one query
+    data = dict(
+        (response_id, dict((type.value, dict(values=[])) for type in types))
+        for response_id in response_ids.values()
+    )
+    if len(response_ids) > 0:
+        q = link_observation_values(observations_for_links(db.session,
+            list(response_ids.keys()), types,
+            javascript_timestamp_to_datetime(start_ts),
+            javascript_timestamp_to_datetime(start_ts + duration)))
+        for link_id, type, timestamp, value in q:
+            data[response_ids[link_id]][type.value]['values'].append((timestamp, value))
+
+    response = dict(
+        data=data,
+        aliases=dict(
+            (alias, response_ids[alias_links[alias][0]] if alias in alias_links else None)
+            for alias in requested['aliases']
+        ),
+        missing=list(OrderedDict((l, None) for l in requested['links'] if l not in link_ids)),
+        query=dict(start=start_ts, duration=duration,
+            types=list(type.value for type in types)),
+    )
     return jsonify(response)
 
 @app.route('/links/<unverified_link_id>/')
@@ -290,6 +1538,16 @@ def link(unverified_link_id):
     link_id, link_uuid = verify_link_id(unverified_link_id)
     link_url_id = uuid_to_urlsafe_id(link_uuid)
 
+    # Link geometry does not change and so only aliases may be modified
+    etag, last_modified = get_cache_validators([link_aliases_version_name(link_id)])
+    if is_not_modified(etag, last_modified):
+        return not_modified_response(etag, last_modified)
+
+    cache_key = response_cache_key(etag)
+    response = get_cached_response(cache_key)
+    if response is not None:
+        return set_cache_headers(response, etag, last_modified)
+
     # Query aliases
     aliases = list(r[0] for r in
             db.session.query(LinkAlias.name).filter(LinkAlias.link_id==link_id))
@@ -308,7 +1566,8 @@ def link(unverified_link_id):
             aliases=aliases,
         ),
     )
-    return jsonify(response)
+    response = cache_response(cache_key, jsonify(response))
+    return set_cache_headers(response, etag, last_modified)
 
 @app.route('/aliases/')
 def link_aliases():
@@ -325,6 +1584,15 @@ def link_aliases():
     if requested_count < 0:
         raise ApiBadRequest('count parameter must be positive')
 
+    etag, last_modified = get_cache_validators([ALIASES])
+    if is_not_modified(etag, last_modified):
+        return not_modified_response(etag, last_modified)
+
+    cache_key = response_cache_key(etag)
+    response = get_cached_response(cache_key)
+    if response is not None:
+        return set_cache_headers(response, etag, last_modified)
+
     # Query link objects
     aliases_q = db.session.query(LinkAlias.name, Link.uuid).join(Link).\
         order_by(LinkAlias.name)
@@ -340,28 +1608,25 @@ def link_aliases():
         link_url = url_for('.link', unverified_link_id=link_id, _external=True)
         return dict(id=row[0], linkId=link_id, linkUrl=link_url)
 
-    aliases = list(row_to_item(l) for l in aliases_q)
-
-    # How many aliases to return and do we still have more?
-    count = min(requested_count, len(aliases))
-
-    # Limit size of output
-    next_link_id = aliases[requested_count]['id'] if len(aliases) > requested_count else None
-    aliases = aliases[:requested_count]
-
-    # Form response
-    page = dict(count = count)
-
-    # Form next url if necessary
-    if next_link_id is not None:
-        next_args = parse_qs(request.query_string)
-        next_args['from'.encode('utf8')] = [next_link_id,]
-        page['next'] = extend_request_query(
-            url_for('.link_aliases', _external=True),
-            {'from': next_link_id}
-        )
-
-    return jsonify(dict(aliases=aliases, page=page))
+    # The aliases are streamed and then the page is formed from the number of
+    # aliases sent and whether there was an extra alias.
+    page = dict(count=0)
+
+    def aliases():
+        for row in aliases_q.yield_per(STREAM_BATCH_SIZE):
+            if page['count'] == requested_count:
+                # Form next url
+                page['next'] = extend_request_query(
+                    url_for('.link_aliases', _external=True),
+                    {'from': row[0]}
+                )
+                break
+            page['count'] += 1
+            yield row_to_item(row)
+
+    response = stream_json(OrderedDict((('aliases', aliases()), ('page', page))))
+    response = cache_response(cache_key, response)
+    return set_cache_headers(response, etag, last_modified)
 
 @app.route('/aliases/resolve', methods=['POST'])
 def link_aliases_resolve():
@@ -435,6 +1700,8 @@ def patch_aliases():
         created_aliases.append(LinkAlias(name=req_name, link_id=link_id))
 
     db.session.add_all(created_aliases)
+    bump_versions(db.session, [ALIASES] +
+            list(link_aliases_version_name(a.link_id) for a in created_aliases))
 
     try:
         db.session.commit()
@@ -0,0 +1,221 @@
+"""
+Caches
+======
+
+Server-side caches of encoded API responses. A cache maps string keys to
+byte string values and supports get(), set() and clear().
+
+LRUCache holds values in process memory and evicts the least recently used
+values once their total size exceeds a limit. MemcachedCache stores values in
+memcached so that they are shared by all processes. TieredCache consults an
+in-process cache before a shared one.
+
+Keys are derived from the change versions of the data a response depends on,
+see trafficdb.versions, and so a write makes the affected keys unreachable
+rather than deleting them. Unreachable values are evicted in due course.
+
+LinkIdCache is an in-process cache of link primary keys by UUID used when
+verifying the link ids in request URLs.
+
+"""
+from collections import OrderedDict
+import hashlib
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Returned by LinkIdCache.get() for a UUID known not to be a link
+NOT_FOUND = object()
+
+class LRUCache(object):
+    """An in-process cache holding values with a total size of at most
+    max_size bytes. Safe for use by concurrent threads.
+
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._values = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._values.pop(key, None)
+            if value is not None:
+                # Re-insert as the most recently used
+                self._values[key] = value
+            return value
+
+    def set(self, key, value):
+        if len(value) > self.max_size:
+            return
+        with self._lock:
+            old_value = self._values.pop(key, None)
+            if old_value is not None:
+                self._size -= len(old_value)
+            self._values[key] = value
+            self._size += len(value)
+
+            while self._size > self.max_size:
+                _, evicted = self._values.popitem(last=False)
+                self._size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self._size = 0
+
+    def __len__(self):
+        return len(self._values)
+
+class MemcachedCache(object):
+    """A cache stored in memcached via client, an object with get(key) and
+    set(key, value, expire) methods such as a pymemcache client. Values
+    expire after ttl seconds. Keys are hashed to satisfy memcached's key
+    length and character restrictions. The cache fails open: errors from the
+    client are logged and treated as misses.
+
+    """
+    def __init__(self, client, ttl, prefix='trafficdb:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _key(self, key):
+        return self.prefix + hashlib.sha1(key.encode('utf8')).hexdigest()
+
+    def get(self, key):
+        try:
+            return self.client.get(self._key(key))
+        except Exception:
+            log.warning('memcached get failed', exc_info=True)
+            return None
+
+    def set(self, key, value):
+        try:
+            self.client.set(self._key(key), value, expire=self.ttl)
+        except Exception:
+            log.warning('memcached set failed', exc_info=True)
+
+    def clear(self):
+        # Values in a shared cache are left to expire
+        pass
+
+class TieredCache(object):
+    """A cache which consults each of a sequence of caches in turn. A value
+    found in a later cache is copied to the earlier ones.
+
+    """
+    def __init__(self, caches):
+        self.caches = list(caches)
+
+    def get(self, key):
+        for idx, cache in enumerate(self.caches):
+            value = cache.get(key)
+            if value is not None:
+                for earlier in self.caches[:idx]:
+                    earlier.set(key, value)
+                return value
+        return None
+
+    def set(self, key, value):
+        for cache in self.caches:
+            cache.set(key, value)
+
+    def clear(self):
+        for cache in self.caches:
+            cache.clear()
+
+def create_memcached_client(servers): # pragma: no cover
+    """Return a pymemcache client for the sequence of "host:port" server
+    addresses. Servers which are down are skipped rather than raising.
+    Requires pymemcache.
+
+    """
+    from pymemcache.client.hash import HashClient
+
+    addresses = []
+    for server in servers:
+        host, _, port = server.rpartition(':')
+        addresses.append((host, int(port)))
+    return HashClient(addresses, ignore_exc=True, connect_timeout=1, timeout=1)
+
+def create_response_cache(config):
+    """Return the response cache configured by the RESPONSE_CACHE_*
+    settings of config or None if caching is disabled.
+
+    """
+    caches = []
+    if config['RESPONSE_CACHE_SIZE'] > 0:
+        caches.append(LRUCache(config['RESPONSE_CACHE_SIZE']))
+
+    servers = config['RESPONSE_CACHE_MEMCACHED_SERVERS']
+    if len(servers) > 0:
+        caches.append(MemcachedCache(
+            create_memcached_client(servers), config['RESPONSE_CACHE_MEMCACHED_TTL']))
+
+    if len(caches) == 0:
+        return None
+    if len(caches) == 1:
+        return caches[0]
+    return TieredCache(caches)
+
+class LinkIdCache(object):
+    """An in-process cache mapping link UUIDs, as hex strings, to (id, uuid)
+    rows. Links are never modified and so rows are kept until evicted as
+    least recently used once there are more than max_size. UUIDs which are
+    not links are remembered for negative_ttl seconds since a link may be
+    created by another process. Safe for use by concurrent threads.
+
+    """
+    def __init__(self, max_size, negative_ttl):
+        self.max_size = max_size
+        self.negative_ttl = negative_ttl
+        self._rows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, link_uuid):
+        """Return the row for link_uuid, NOT_FOUND if link_uuid is known not
+        to be a link or None if it is not cached.
+
+        """
+        with self._lock:
+            row = self._rows.pop(link_uuid, None)
+            if row is None:
+                return None
+            if isinstance(row, float):
+                # Negative entries hold their expiry time
+                if row <= time.time():
+                    return None
+                self._rows[link_uuid] = row
+                return NOT_FOUND
+            self._rows[link_uuid] = row
+            return row
+
+    def set(self, link_uuid, row):
+        """Cache the row for link_uuid or, if row is None, that link_uuid is
+        not a link.
+
+        """
+        if self.max_size <= 0:
+            return
+        value = tuple(row) if row is not None else time.time() + self.negative_ttl
+        with self._lock:
+            self._rows.pop(link_uuid, None)
+            self._rows[link_uuid] = value
+            while len(self._rows) > self.max_size:
+                self._rows.popitem(last=False)
+
+    def invalidate(self, link_uuid):
+        """Forget anything cached for link_uuid, e.g. once it is created."""
+        with self._lock:
+            self._rows.pop(link_uuid, None)
+
+    def clear(self):
+        with self._lock:
+            self._rows.clear()
+
+    def __len__(self):
+        return len(self._rows)
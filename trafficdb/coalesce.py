@@ -0,0 +1,109 @@
+"""
+Request coalescing
+==================
+
+When a popular response drops out of the response cache, many identical
+requests may miss the cache at once and each run the same query. Coalescing
+makes identical requests take turns: the first runs the query and fills the
+cache while the others wait and are then served from the cache.
+
+Turns are held per key. SingleFlight holds keys among the threads of one
+process. Keys may additionally be held among processes by an AdvisoryLock,
+a PostgreSQL advisory lock held on a connection of its own so that it may be
+released before the request's transaction ends.
+
+"""
+import hashlib
+import struct
+import threading
+
+from sqlalchemy import text
+
+class SingleFlight(object):
+    """Per-key locks shared by the threads of a process. Locks are created
+    on demand and discarded once no thread holds or awaits them.
+
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    def acquire(self, key):
+        """Hold key, waiting for any other thread holding key to release it.
+        Returns True if the caller had to wait.
+
+        """
+        with self._lock:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [threading.Lock(), 0]
+            # Count holders and waiters so the lock is kept while needed
+            entry[1] += 1
+
+        if entry[0].acquire(False):
+            return False
+        entry[0].acquire()
+        return True
+
+    def release(self, key):
+        """Release key which must be held by the caller."""
+        with self._lock:
+            entry = self._locks[key]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+        entry[0].release()
+
+    def __len__(self):
+        return len(self._locks)
+
+def advisory_lock_key(key):
+    """Return the signed 64-bit PostgreSQL advisory lock key for the string
+    key.
+
+    """
+    digest = hashlib.sha1(key.encode('utf8')).digest()
+    return struct.unpack('>q', digest[:8])[0]
+
+class AdvisoryLock(object):
+    """A session-level advisory lock for the string key held on a connection
+    taken from engine for the purpose. The connection is closed on release.
+
+    """
+    def __init__(self, engine, key):
+        self.engine = engine
+        self.params = dict(key=advisory_lock_key(key))
+        self._connection = None
+
+    def acquire(self):
+        """Hold the lock, waiting for any other holder to release it. Returns
+        True if the caller had to wait.
+
+        """
+        self._connection = self.engine.connect()
+        try:
+            if self._connection.execute(
+                    text('SELECT pg_try_advisory_lock(:key)'), self.params).scalar():
+                return False
+            self._connection.execute(text('SELECT pg_advisory_lock(:key)'), self.params)
+            return True
+        except:
+            # The lock may be held and so must not be returned to the pool
+            self._connection.invalidate()
+            self._connection.close()
+            self._connection = None
+            raise
+
+    def release(self):
+        """Release the lock if it is held."""
+        if self._connection is None:
+            return
+        connection, self._connection = self._connection, None
+        try:
+            connection.execute(text('SELECT pg_advisory_unlock(:key)'), self.params)
+        except:
+            # Closing the database session releases the lock
+            connection.invalidate()
+            raise
+        finally:
+            connection.close()
@@ -0,0 +1,225 @@
+"""
+Columnar observations
+=====================
+
+Observations and rollups of a link returned as contiguous NumPy columns
+rather than as rows of Python objects. Rows are fetched with PostgreSQL's
+``COPY ... TO STDOUT`` in binary format. Every field of a row has a fixed
+width and so the whole copy is reinterpreted as a NumPy structured array and
+split into columns without visiting individual rows in Python.
+
+The columns of each type are a dictionary mapping column names to arrays.
+Timestamps are int64 JavaScript timestamps, i.e. milliseconds since the epoch,
+and all other columns are float64. Observations have "timestamp" and "value"
+columns. Rollups additionally have "min" and "max" columns and "value" is the
+bucket mean.
+
+Columns may be encoded as an Apache Arrow IPC stream, which requires
+PyArrow, or as a NumPy .npz archive.
+
+Requires NumPy.
+
+"""
+import io
+import json
+
+import six
+
+try:
+    import numpy as np
+except ImportError: # pragma: no cover
+    # NumPy is optional and only required for columnar responses
+    np = None
+
+try:
+    import pyarrow as pa
+except ImportError: # pragma: no cover
+    # PyArrow is optional and only required for Arrow responses
+    pa = None
+
+from .models import ObservationType
+from .partitions import as_utc
+
+# Media types of the supported encodings
+ARROW_STREAM_MIMETYPE = 'application/vnd.apache.arrow.stream'
+NPZ_MIMETYPE = 'application/x-npz'
+
+# Columns of observations and rollups in order
+OBSERVATION_COLUMNS = ('timestamp', 'value')
+ROLLUP_COLUMNS = ('timestamp', 'value', 'min', 'max')
+
+# Signature at the start of binary COPY output
+_COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+
+# The index of each type in declaration order. The database orders types in
+# the same way.
+_TYPE_INDEX_SQL = 'CASE type ' + ' '.join(
+    "WHEN '{0}' THEN {1}".format(type.name, idx)
+    for idx, type in enumerate(ObservationType)) + ' END'
+
+_OBSERVATIONS_SQL = (
+    'SELECT CAST(' + _TYPE_INDEX_SQL + ' AS smallint), '
+    '       CAST(floor(extract(epoch FROM observed_at) * 1000) AS bigint), value '
+    'FROM observations '
+    'WHERE link_id = %(link_id)s AND type IN %(types)s '
+    '    AND observed_at >= %(min)s AND observed_at <= %(max)s '
+    'ORDER BY type, observed_at'
+)
+
+_ROLLUPS_SQL = (
+    'SELECT CAST(' + _TYPE_INDEX_SQL + ' AS smallint), '
+    '       CAST(floor(extract(epoch FROM bucket) * 1000) AS bigint), '
+    '       sum / count, min, max '
+    'FROM observation_rollups '
+    'WHERE resolution = %(resolution)s AND link_id = %(link_id)s '
+    '    AND type IN %(types)s AND bucket >= %(min)s AND bucket < %(max)s '
+    'ORDER BY type, bucket'
+)
+
+def columnar_available():
+    """Return True if NumPy, and so columnar responses, are available."""
+    return np is not None
+
+def arrow_available():
+    """Return True if PyArrow, and so Arrow IPC streams, are available."""
+    return np is not None and pa is not None
+
+def _copy_rows_dtype(n_columns):
+    """Return the NumPy structured dtype of a binary COPY row with a
+    smallint type index, a bigint timestamp and n_columns-1 double
+    precision columns.
+
+    """
+    fields = [('n_fields', '>i2'), ('type_len', '>i4'), ('type', '>i2'),
+              ('timestamp_len', '>i4'), ('timestamp', '>i8')]
+    for idx in range(n_columns - 1):
+        fields.extend([('len_{0}'.format(idx), '>i4'), ('col_{0}'.format(idx), '>f8')])
+    return np.dtype(fields)
+
+def _copy_rows(session, sql, params, n_columns):
+    """Run sql with params as a binary COPY and return its rows as a NumPy
+    structured array. Raises ValueError if the output is not as expected.
+
+    """
+    # COPY is not exposed by SQLAlchemy so use the DBAPI cursor directly. This
+    # shares the session's connection and therefore its transaction.
+    buf = io.BytesIO()
+    cursor = session.connection().connection.cursor()
+    try:
+        query = cursor.mogrify(sql, params)
+        if isinstance(query, six.binary_type):
+            query = query.decode('utf8')
+        cursor.copy_expert('COPY (' + query + ') TO STDOUT WITH (FORMAT binary)', buf)
+    finally:
+        cursor.close()
+    data = buf.getvalue()
+
+    # Skip the header which is the signature, a flags field and a header
+    # extension area prefixed by its length. The data ends with a trailer.
+    if not data.startswith(_COPY_SIGNATURE):
+        raise ValueError('Unexpected COPY signature')
+    offset = len(_COPY_SIGNATURE) + 4
+    offset += 4 + int(np.frombuffer(data, dtype='>i4', count=1, offset=offset)[0])
+    body = memoryview(data)[offset:len(data)-2]
+
+    dtype = _copy_rows_dtype(n_columns)
+    if len(body) % dtype.itemsize != 0:
+        raise ValueError('Unexpected COPY row size')
+    rows = np.frombuffer(body, dtype=dtype)
+
+    # Every field has a fixed width and so a NULL, with length -1, or an
+    # unexpected field count means the rows have been misinterpreted
+    if len(rows) > 0 and (np.any(rows['n_fields'] != n_columns + 1) or
+            np.any(rows['timestamp_len'] != 8)):
+        raise ValueError('Unexpected COPY row layout')
+    for idx in range(n_columns - 1):
+        if np.any(rows['len_{0}'.format(idx)] != 8):
+            raise ValueError('Unexpected NULL in COPY output')
+
+    return rows
+
+def _split_columns(rows, type, names):
+    """Return the columns of rows for the ObservationType type as a
+    dictionary of native-endian arrays keyed by the column names in names.
+
+    """
+    type_idx = list(ObservationType).index(type)
+
+    # Rows are ordered by type and so the rows of each type are contiguous
+    start, end = np.searchsorted(rows['type'], [type_idx, type_idx+1])
+    type_rows = rows[start:end]
+
+    columns = dict(timestamp=type_rows['timestamp'].astype(np.int64))
+    for idx, name in enumerate(names[1:]):
+        columns[name] = type_rows['col_{0}'.format(idx)].astype(np.float64)
+    return columns
+
+def observation_columns(session, link_id, types, min_datetime, max_datetime):
+    """Return a dictionary keyed by ObservationType of the columns of the
+    observations of a link in a time range for each of the sequence of
+    ObservationTypes types. All types are fetched in one query.
+
+    """
+    params = dict(link_id=link_id, types=tuple(type.name for type in types),
+            min=as_utc(min_datetime), max=as_utc(max_datetime))
+    rows = _copy_rows(session, _OBSERVATIONS_SQL, params, len(OBSERVATION_COLUMNS))
+    return dict((type, _split_columns(rows, type, OBSERVATION_COLUMNS)) for type in types)
+
+def rollup_columns(session, link_id, types, resolution, min_datetime, max_datetime):
+    """As observation_columns() but returns the columns of the rollups of a
+    link at resolution for buckets starting in a time range.
+
+    """
+    params = dict(resolution=resolution, link_id=link_id,
+            types=tuple(type.name for type in types),
+            min=as_utc(min_datetime), max=as_utc(max_datetime))
+    rows = _copy_rows(session, _ROLLUPS_SQL, params, len(ROLLUP_COLUMNS))
+    return dict((type, _split_columns(rows, type, ROLLUP_COLUMNS)) for type in types)
+
+def encode_npz(columns, types):
+    """Encode columns as returned by observation_columns() or
+    rollup_columns() as a NumPy .npz archive. The arrays of each of the
+    sequence of ObservationTypes types are named "<type>_<column>", e.g.
+    "speed_timestamp". Returns a byte string.
+
+    """
+    arrays = {}
+    for type in types:
+        for name, column in columns[type].items():
+            arrays['{0}_{1}'.format(type.value, name)] = column
+
+    buf = io.BytesIO()
+    np.savez(buf, **arrays)
+    return buf.getvalue()
+
+def encode_arrow_stream(columns, types, metadata=None):
+    """Encode columns as returned by observation_columns() or
+    rollup_columns() as an Arrow IPC stream with one record batch for each of
+    the sequence of ObservationTypes types in order. The schema metadata
+    "types" is a JSON list of the type of each batch. Other metadata may be
+    given as a dictionary of JSON-serialisable values. Returns a byte string.
+    Requires PyArrow.
+
+    """
+    if pa is None:
+        raise RuntimeError('PyArrow is required for Arrow streams')
+
+    # Every type has the same columns
+    names = ROLLUP_COLUMNS if len(types) > 0 and 'min' in columns[types[0]] \
+            else OBSERVATION_COLUMNS
+    fields = [pa.field('timestamp', pa.timestamp('ms', tz='UTC'), nullable=False)]
+    fields.extend(pa.field(name, pa.float64(), nullable=False) for name in names[1:])
+
+    schema_metadata = dict((k, json.dumps(v)) for k, v in (metadata or {}).items())
+    schema_metadata['types'] = json.dumps(list(type.value for type in types))
+    schema = pa.schema(fields, metadata=schema_metadata)
+
+    sink = pa.BufferOutputStream()
+    writer = pa.ipc.new_stream(sink, schema)
+    for type in types:
+        type_columns = columns[type]
+        arrays = [pa.array(type_columns['timestamp'], type=fields[0].type)]
+        arrays.extend(pa.array(type_columns[name]) for name in names[1:])
+        writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+    writer.close()
+    return sink.getvalue().to_pybytes()
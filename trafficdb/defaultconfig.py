@@ -6,3 +6,68 @@ import os
 
 SQLALCHEMY_DATABASE_URI = os.environ['DATABASE_URI']
 
+# How to treat observations which duplicate an existing (link, type,
+# observed_at) on ingest. One of "keep-first", "overwrite" or "reject".
+OBSERVATION_CONFLICT_POLICY = 'keep-first'
+
+# Whether rollups should be refreshed as part of each ingest request. If False,
+# rollups are only refreshed by "webapp rollups refresh" which may then be run
+# periodically to move the cost of refreshing out of the ingest path.
+ROLLUP_REFRESH_ON_INGEST = True
+
+# The time zone in which typical-week profiles are computed. Profile slots
+# follow local clock time across daylight saving changes. Changing this
+# requires the profiles to be rebuilt with "webapp profiles build".
+PROFILE_TIMEZONE = 'UTC'
+
+# Number of seconds for which clients and proxies may use responses for time
+# windows entirely in the past without revalidating them. Other responses
+# must be revalidated on each use via their ETag.
+HISTORICAL_MAX_AGE = 60*60
+
+# Maximum total size in bytes of the responses held in each process's
+# response cache. Zero disables the in-process cache.
+RESPONSE_CACHE_SIZE = 64*1024*1024
+
+# Responses larger than this many bytes are never cached
+RESPONSE_CACHE_MAX_ITEM_SIZE = 1024*1024
+
+# Addresses, as "host:port" strings, of memcached servers shared by all
+# processes as a second level response cache. Requires pymemcache.
+RESPONSE_CACHE_MEMCACHED_SERVERS = []
+
+# Number of seconds for which responses are kept in memcached
+RESPONSE_CACHE_MEMCACHED_TTL = 60*60
+
+# Whether identical concurrent observations requests which miss the response
+# cache should take turns so that only the first queries the database and the
+# others are served the response it caches. Has no effect if the response
+# cache is disabled.
+COALESCE_REQUESTS = True
+
+# Whether observations requests should also be coalesced across processes
+# using PostgreSQL advisory locks. Waiting requests hold a database
+# connection. Only useful with a shared memcached response cache.
+COALESCE_ADVISORY_LOCKS = False
+
+# Number of the most frequently requested observations and link responses
+# which are requested again in the background after each ingest so that they
+# are cached before clients ask for them. Zero disables warming.
+CACHE_WARM_COUNT = 50
+
+# Maximum number of distinct requests whose frequency is tracked for warming,
+# both in each process and in the request_counts table shared by all of them
+ACCESS_TRACKER_SIZE = 10000
+
+# Interval in seconds at which each process flushes the requests it tracked to
+# the request_counts table and polls change versions so that it warms its own
+# cache after an ingest handled by any process
+CACHE_WARM_INTERVAL = 60
+
+# Maximum number of link ids cached by each process when verifying the link
+# ids in request URLs. Zero disables the cache.
+LINK_ID_CACHE_SIZE = 100000
+
+# Number of seconds for which each process remembers that a link id does not
+# exist. Links created by other processes may return 404 for this long.
+LINK_ID_NEGATIVE_TTL = 60
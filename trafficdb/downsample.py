@@ -0,0 +1,76 @@
+"""
+Downsampling
+============
+
+Shape-preserving downsampling of observation series. Unlike rollups, which
+average values within buckets and so hide short spikes, the
+largest-triangle-three-buckets (LTTB) algorithm selects actual points so that
+peaks and troughs survive. See Sveinn Steinarsson, "Downsampling Time Series
+for Visual Representation", 2013.
+
+Requires NumPy.
+
+"""
+try:
+    import numpy as np
+except ImportError: # pragma: no cover
+    # NumPy is optional and only required for downsampling
+    np = None
+
+# Supported downsampling methods
+LTTB = 'lttb'
+
+DOWNSAMPLE_METHODS = (LTTB,)
+
+# LTTB always keeps the first and last points and so needs at least one more
+MIN_POINTS = 3
+
+def downsampling_available():
+    """Return True if NumPy, and so downsampling, is available."""
+    return np is not None
+
+def lttb_indices(x, y, points):
+    """Return a sorted int64 array of the indices of at most points points of
+    the series (x, y) selected by the LTTB algorithm. x must be increasing.
+    If the series already has no more than points points, all indices are
+    returned. Requires NumPy. Raises ValueError if points is less than
+    MIN_POINTS.
+
+    """
+    if np is None:
+        raise RuntimeError('NumPy is required for downsampling')
+    if points < MIN_POINTS:
+        raise ValueError('At least {0} points are required'.format(MIN_POINTS))
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = x.shape[0]
+    if n <= points:
+        return np.arange(n, dtype=np.int64)
+
+    # Divide the interior points into points-2 buckets. Each bucket is
+    # non-empty since n > points.
+    edges = np.linspace(1, n - 1, points - 1).astype(np.int64)
+    starts, ends = edges[:-1], edges[1:]
+
+    # The mean of each bucket computed in one pass. The last point takes the
+    # place of the bucket after the last bucket.
+    counts = (ends - starts).astype(np.float64)
+    mean_x = np.append(np.add.reduceat(x[:n-1], starts) / counts, x[-1])
+    mean_y = np.append(np.add.reduceat(y[:n-1], starts) / counts, y[-1])
+
+    indices = np.empty(points, dtype=np.int64)
+    indices[0], indices[-1] = 0, n - 1
+
+    # Each selection depends on the previous one so buckets are visited in
+    # turn but the triangle areas within a bucket are computed together.
+    a = 0
+    for bucket_idx in range(points - 2):
+        start, end = starts[bucket_idx], ends[bucket_idx]
+        ax, ay = x[a], y[a]
+        cx, cy = mean_x[bucket_idx+1], mean_y[bucket_idx+1]
+        areas = np.abs((ax - cx) * (y[start:end] - ay) - (ax - x[start:end]) * (cy - ay))
+        a = start + int(np.argmax(areas))
+        indices[bucket_idx+1] = a
+
+    return indices
@@ -0,0 +1,190 @@
+"""
+Observation ingest
+==================
+
+Bulk loading of observations. Rows are streamed into a temporary staging table
+using PostgreSQL's ``COPY ... FROM STDIN`` and then merged into the
+observations table with a single ``INSERT ... SELECT``. This avoids the
+per-row overhead of ORM inserts and of large multi-row ``INSERT`` statements.
+
+Observations are uniquely identified by their link, type and observation time.
+When an ingested observation duplicates an existing one, the conflict policy
+determines the outcome:
+
+* KEEP_FIRST ("keep-first") silently keeps the existing observation,
+* OVERWRITE ("overwrite") replaces the existing observation's value, and
+* REJECT ("reject") raises an IntegrityError.
+
+The same policy applies to duplicates within a single ingest.
+
+Ingest also maintains the earliest and latest observation times in the
+observation_stats table, the most recent observation of each link and type in
+the latest_observations table, records the rollup buckets touched by new
+observations, see trafficdb.rollups, and defers bumping the change versions
+of the links observed until the session commits, see trafficdb.versions.
+
+"""
+import csv
+
+import six
+from sqlalchemy import text
+
+from .rollups import mark_dirty_rollups
+from .versions import OBSERVATIONS, defer_link_versions, defer_versions
+
+# Conflict policies
+KEEP_FIRST = 'keep-first'
+OVERWRITE = 'overwrite'
+REJECT = 'reject'
+
+CONFLICT_POLICIES = (KEEP_FIRST, OVERWRITE, REJECT)
+
+# Name of the temporary table used to stage observations before merging them.
+STAGING_TABLE = 'tmp_observation_staging'
+
+def prepare_observation_staging(session):
+    """Create the temporary staging table used by stage_observations() if it
+    does not already exist on this session's connection. It is safe to call
+    this function multiple times.
+
+    """
+    session.execute(text(
+        'CREATE TEMPORARY TABLE IF NOT EXISTS ' + STAGING_TABLE + ' ('
+        '    seq bigserial,'
+        '    link_id integer NOT NULL,'
+        '    type observation_types NOT NULL,'
+        '    observed_at timestamp with time zone NOT NULL,'
+        '    value double precision NOT NULL'
+        ')'
+    ))
+
+def stage_observations(session, rows):
+    """Copy observations into the staging table. rows is an iterable of
+    (link_id, type, observed_at, value) tuples where type is an
+    ObservationType. Returns the number of rows staged.
+
+    """
+    prepare_observation_staging(session)
+
+    # Serialise rows as CSV for COPY
+    buf = six.StringIO()
+    writer = csv.writer(buf)
+    count = 0
+    for link_id, type, observed_at, value in rows:
+        writer.writerow((link_id, type.name, observed_at.isoformat(), repr(float(value))))
+        count += 1
+    buf.seek(0)
+
+    if count == 0:
+        return 0
+
+    # COPY is not exposed by SQLAlchemy so use the DBAPI cursor directly. This
+    # shares the session's connection and therefore its transaction.
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(
+            'COPY ' + STAGING_TABLE + ' (link_id, type, observed_at, value) '
+            'FROM STDIN WITH CSV', buf)
+    finally:
+        cursor.close()
+
+    return count
+
+def merge_staged_observations(session, on_conflict=KEEP_FIRST):
+    """Move all rows in the staging table into the observations table and
+    empty the staging table. on_conflict is one of the policies in
+    CONFLICT_POLICIES. Returns the number of observations inserted or
+    updated.
+
+    """
+    if on_conflict not in CONFLICT_POLICIES:
+        raise ValueError('Unknown conflict policy: {0}'.format(on_conflict))
+
+    prepare_observation_staging(session)
+
+    if on_conflict == REJECT:
+        # Any duplicate will violate the unique index
+        merge_sql = (
+            'INSERT INTO observations (link_id, type, observed_at, value) '
+            'SELECT link_id, type, observed_at, value FROM ' + STAGING_TABLE
+        )
+    else:
+        # Remove duplicates within the staged rows keeping the first or last
+        # staged. ON CONFLICT cannot affect the same row twice.
+        merge_sql = (
+            'INSERT INTO observations (link_id, type, observed_at, value) '
+            'SELECT DISTINCT ON (link_id, type, observed_at) '
+            '    link_id, type, observed_at, value '
+            'FROM ' + STAGING_TABLE + ' '
+            'ORDER BY link_id, type, observed_at, seq {0} '
+            'ON CONFLICT (link_id, type, observed_at) {1}'
+        ).format(
+            'ASC' if on_conflict == KEEP_FIRST else 'DESC',
+            'DO NOTHING' if on_conflict == KEEP_FIRST else
+                'DO UPDATE SET value = EXCLUDED.value '
+                'WHERE observations.value IS DISTINCT FROM EXCLUDED.value'
+        )
+
+    result = session.execute(text(merge_sql))
+    update_observation_stats(session)
+    update_latest_observations(session)
+    mark_dirty_rollups(session, STAGING_TABLE)
+    defer_link_versions(session, STAGING_TABLE)
+    defer_versions(session, [OBSERVATIONS])
+    session.execute(text('TRUNCATE ' + STAGING_TABLE))
+    return result.rowcount
+
+def update_observation_stats(session):
+    """Widen the date range in observation_stats to include all rows in the
+    staging table.
+
+    """
+    session.execute(text(
+        'INSERT INTO observation_stats (id, earliest, latest) '
+        'SELECT 1, min(observed_at), max(observed_at) FROM ' + STAGING_TABLE + ' '
+        'HAVING count(*) > 0 '
+        'ON CONFLICT (id) DO UPDATE SET '
+        '    earliest = LEAST(observation_stats.earliest, EXCLUDED.earliest),'
+        '    latest = GREATEST(observation_stats.latest, EXCLUDED.latest)'
+    ))
+
+def update_latest_observations(session):
+    """Update latest_observations with any staged observation which is more
+    recent than the latest observation of its link and type. Values are read
+    back from the observations table so that the result respects the conflict
+    policy used when merging.
+
+    """
+    session.execute(text(
+        'INSERT INTO latest_observations (link_id, type, observed_at, value) '
+        'SELECT DISTINCT ON (s.link_id, s.type) o.link_id, o.type, o.observed_at, o.value '
+        'FROM ' + STAGING_TABLE + ' s JOIN observations o '
+        '    ON o.link_id = s.link_id AND o.type = s.type AND o.observed_at = s.observed_at '
+        'ORDER BY s.link_id, s.type, s.observed_at DESC '
+        'ON CONFLICT (link_id, type) DO UPDATE SET '
+        '    observed_at = EXCLUDED.observed_at, value = EXCLUDED.value '
+        'WHERE EXCLUDED.observed_at >= latest_observations.observed_at'
+    ))
+
+def refresh_observation_stats(session):
+    """Recompute observation_stats from the observations table. This must be
+    called after observations are removed other than via ingest, e.g. after
+    dropping partitions.
+
+    """
+    session.execute(text(
+        'INSERT INTO observation_stats (id, earliest, latest) '
+        'SELECT 1, min(observed_at), max(observed_at) FROM observations '
+        'ON CONFLICT (id) DO UPDATE SET '
+        '    earliest = EXCLUDED.earliest, latest = EXCLUDED.latest'
+    ))
+
+def copy_observations(session, rows, on_conflict=KEEP_FIRST):
+    """Bulk load observations via the staging table. rows is as for
+    stage_observations() and on_conflict as for merge_staged_observations().
+    Returns the number of observations inserted or updated. The caller is
+    responsible for committing the session.
+
+    """
+    stage_observations(session, rows)
+    return merge_staged_observations(session, on_conflict=on_conflict)
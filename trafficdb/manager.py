@@ -2,19 +2,231 @@
 Command-line utility to manage webapp
 
 """
+import datetime
+from multiprocessing.pool import ThreadPool
+
+from flask import current_app
 from flask.ext.migrate import MigrateCommand
-from flask.ext.script import Manager
+from flask.ext.script import Command, Manager, Option
+import pytz
 
+from .ingest import refresh_observation_stats
+from .models import db
+from .partitions import (
+        BRIN_INDEX,
+        add_months,
+        create_observation_partitions,
+        expired_observation_partitions,
+        month_start,
+        retain_observations,
+        retention_cutoff,
+        set_brin_index,
+)
+from .rollups import (
+        build_profiles,
+        rebuild_rollup_ranges,
+        rebuild_rollups,
+        refresh_rollups,
+)
+from .versions import HISTORY, OBSERVATIONS, bump_versions
+from .warming import hottest_requests, warm_requests
 from .wsgi import create_app
 
+def parse_date(date_str):
+    """Parse a YYYY-MM-DD date as midnight UTC. Raises ValueError if date_str
+    cannot be parsed.
+
+    """
+    return pytz.utc.localize(datetime.datetime.strptime(date_str, '%Y-%m-%d'))
+
+class CreatePartitionsCommand(Command):
+    """Create monthly observation partitions for the current month and the
+    following months if they do not already exist.
+
+    """
+    option_list = (
+        Option('--months', '-m', dest='months', type=int, default=3,
+            help='number of months after the current one to create (default: 3)'),
+    )
+
+    def run(self, months):
+        start = month_start(datetime.datetime.now(pytz.utc))
+        created = create_observation_partitions(db.session, start, add_months(start, months+1))
+        db.session.commit()
+
+        for name in created:
+            print('Created partition {0}'.format(name))
+
+class RetainCommand(Command):
+    """Drop or archive monthly observation partitions which only hold
+    observations older than a retention period.
+
+    """
+    option_list = (
+        Option('--older-than', dest='older_than', required=True,
+            help='retention period, e.g. 90d, 6w, 18m or 2y'),
+        Option('--archive', dest='archive_schema', default=None,
+            help='move expired partitions to this schema rather than dropping them'),
+        Option('--dry-run', dest='dry_run', action='store_true', default=False,
+            help='list expired partitions without detaching them'),
+    )
+
+    def run(self, older_than, archive_schema, dry_run):
+        try:
+            cutoff = retention_cutoff(older_than)
+        except ValueError as e:
+            print(str(e))
+            return 1
+
+        if dry_run:
+            for name, _, _ in expired_observation_partitions(db.session, cutoff):
+                print('Would detach partition {0}'.format(name))
+            return
+
+        detached = retain_observations(db.session, cutoff, archive_schema=archive_schema)
+        refresh_observation_stats(db.session)
+        bump_versions(db.session, [HISTORY, OBSERVATIONS])
+        db.session.commit()
+
+        for name in detached:
+            if archive_schema is None:
+                print('Dropped partition {0}'.format(name))
+            else:
+                print('Archived partition {0} to {1}'.format(name, archive_schema))
+
+class BrinIndexCommand(Command):
+    """Create or drop the optional BRIN index on observation times. See
+    scripts/benchmark_brin.py for a comparison with the B-tree index.
+
+    """
+    option_list = (
+        Option('state', choices=('on', 'off'),
+            help='"on" to create the index or "off" to drop it'),
+    )
+
+    def run(self, state):
+        changed = set_brin_index(db.session, state == 'on')
+        db.session.commit()
+
+        if not changed:
+            print('Index {0} is already {1}'.format(
+                BRIN_INDEX, 'present' if state == 'on' else 'absent'))
+        elif state == 'on':
+            print('Created index {0}'.format(BRIN_INDEX))
+        else:
+            print('Dropped index {0}'.format(BRIN_INDEX))
+
+class RebuildRollupsCommand(Command):
+    """Recompute observation rollups for a date range from raw observations.
+    Each day in the range is rebuilt in its own transaction and days are
+    rebuilt in parallel.
+
+    """
+    option_list = (
+        Option('--start', dest='start', required=True,
+            help='first day to rebuild as YYYY-MM-DD'),
+        Option('--end', dest='end', required=True,
+            help='day after the last day to rebuild as YYYY-MM-DD'),
+        Option('--jobs', '-j', dest='jobs', type=int, default=4,
+            help='number of days to rebuild concurrently (default: 4)'),
+    )
+
+    def run(self, start, end, jobs):
+        try:
+            start, end = parse_date(start), parse_date(end)
+        except ValueError as e:
+            print(str(e))
+            return 1
+
+        # Each worker uses its own connection from the engine's pool
+        engine = db.engine
+        profile_timezone = current_app.config['PROFILE_TIMEZONE']
+        def rebuild(day_range):
+            with engine.begin() as connection:
+                rebuild_rollups(connection, day_range[0], day_range[1],
+                        profile_timezone=profile_timezone)
+            return day_range[0]
+
+        pool = ThreadPool(max(1, jobs))
+        try:
+            for day in pool.imap(rebuild, rebuild_rollup_ranges(start, end)):
+                print('Rebuilt rollups for {0}'.format(day.strftime('%Y-%m-%d')))
+        finally:
+            pool.close()
+            pool.join()
+
+        # Bumped once at the end so that the parallel rebuilds do not contend
+        # for the version
+        bump_versions(db.session, [HISTORY])
+        db.session.commit()
+
+class RefreshRollupsCommand(Command):
+    """Recompute observation rollups for buckets which have had observations
+    ingested since they were last refreshed.
+
+    """
+    def run(self):
+        count = refresh_rollups(db.session, current_app.config['PROFILE_TIMEZONE'])
+        db.session.commit()
+        print('Refreshed {0} bucket(s)'.format(count))
+
+class BuildProfilesCommand(Command):
+    """Recompute all typical-week link profiles from the rollups. Profiles
+    are otherwise kept up to date as rollups are refreshed.
+
+    """
+    def run(self):
+        build_profiles(db.session, current_app.config['PROFILE_TIMEZONE'])
+        bump_versions(db.session, [HISTORY])
+        db.session.commit()
+
+class WarmCacheCommand(Command):
+    """Make the requests most frequently made to any process, as recorded in
+    the request_counts table, so that the responses are stored in the
+    response cache. This is only useful with a shared memcached response
+    cache and may be run after each ingest, e.g. by cron. Each process warms
+    its own cache after ingest otherwise.
+
+    """
+    option_list = (
+        Option('--count', '-n', dest='count', type=int, default=None,
+            help='number of requests to warm (default: CACHE_WARM_COUNT)'),
+    )
+
+    def run(self, count):
+        if count is None:
+            count = current_app.config['CACHE_WARM_COUNT']
+        requests = hottest_requests(db.session, count)
+        db.session.commit()
+
+        app = current_app._get_current_object()
+        count = warm_requests(app, requests)
+        print('Warmed {0} of {1} request(s)'.format(count, len(requests)))
+
 def create_manager():
     # Create app
     app = create_app()
 
     # Create script manager
     manager = Manager(app)
+    MigrateCommand.add_command('partition', CreatePartitionsCommand())
+    MigrateCommand.add_command('retain', RetainCommand())
+    MigrateCommand.add_command('brin', BrinIndexCommand())
     manager.add_command('db', MigrateCommand)
 
+    rollups_manager = Manager(usage='Maintain observation rollups')
+    rollups_manager.add_command('rebuild', RebuildRollupsCommand())
+    rollups_manager.add_command('refresh', RefreshRollupsCommand())
+    manager.add_command('rollups', rollups_manager)
+
+    profiles_manager = Manager(usage='Maintain typical-week link profiles')
+    profiles_manager.add_command('build', BuildProfilesCommand())
+    manager.add_command('profiles', profiles_manager)
+
+    cache_manager = Manager(usage='Maintain the response cache')
+    cache_manager.add_command('warm', WarmCacheCommand())
+    manager.add_command('cache', cache_manager)
+
     return manager
 
 def main():
@@ -4,10 +4,18 @@ Database models
 """
 
 __all__ = ['db',
+    'ChangeVersion',
+    'LatestObservation',
     'Link',
     'LinkAlias',
+    'LinkProfile',
     'Observation',
-    'ObservationType'
+    'ObservationRollup',
+    'ObservationRollupDirty',
+    'ObservationSketch',
+    'ObservationStats',
+    'ObservationType',
+    'RequestCount'
 ]
 
 from enum import Enum
@@ -78,18 +86,144 @@ db.Index('ix_link_geom', Link.geom, postgresql_using='gist')
 class Observation(db.Model):
     __tablename__ = 'observations'
 
+    # Observations are range partitioned by month. See trafficdb.partitions.
+    # The partition key must form part of the primary key.
+    __table_args__ = {'postgresql_partition_by': 'RANGE (observed_at)'}
+
     id          = db.Column(db.Integer, primary_key=True)
     value       = db.Column(db.Float, nullable=False)
     type        = db.Column(PythonEnum(ObservationType, name='observation_types'), nullable=False)
-    observed_at = db.Column(db.DateTime(timezone=True), nullable=False)
+    observed_at = db.Column(db.DateTime(timezone=True), primary_key=True)
     link_id     = db.Column(db.Integer, db.ForeignKey('links.id'), nullable=False)
 
-# An index to enable efficient retrieval of observations in a range.
+# An index to enable efficient retrieval of observations in a range. A BRIN
+# index, ix_observation_observed_at_brin, may optionally be created with
+# "webapp db brin on".
 db.Index('ix_observation_observed_at', Observation.observed_at)
 
 # An index to enable efficient retrieval of observations in a range and link.
 db.Index('ix_observation_observed_at_link_id', Observation.observed_at, Observation.link_id)
 
+# A unique index on the natural key of an observation. Used to detect duplicate
+# observations on ingest. Including value allows per-link queries for
+# observation values to be answered by an index-only scan.
+db.Index('ix_observation_link_id_type_observed_at_value',
+        Observation.link_id, Observation.type, Observation.observed_at,
+        unique=True, postgresql_include=['value'])
+
+class LatestObservation(db.Model):
+    """The most recent observation of each type for each link. This is
+    maintained on ingest so that the current state of the network can be read
+    without searching the observations table.
+
+    """
+    __tablename__ = 'latest_observations'
+
+    link_id     = db.Column(db.Integer, db.ForeignKey('links.id'), primary_key=True)
+    type        = db.Column(PythonEnum(ObservationType, name='observation_types'), primary_key=True)
+    observed_at = db.Column(db.DateTime(timezone=True), nullable=False)
+    value       = db.Column(db.Float, nullable=False)
+
+class ObservationStats(db.Model):
+    """Summary statistics over all observations. These are maintained on
+    ingest so that they need not be computed from the observations table on
+    each request. The table has at most one row whose id is 1.
+
+    """
+    __tablename__ = 'observation_stats'
+
+    id          = db.Column(db.Integer, primary_key=True)
+    earliest    = db.Column(db.DateTime(timezone=True))
+    latest      = db.Column(db.DateTime(timezone=True))
+
+class ChangeVersion(db.Model):
+    """A counter which is incremented whenever the data it names is
+    written. See trafficdb.versions.
+
+    """
+    __tablename__ = 'change_versions'
+
+    name        = db.Column(db.String, primary_key=True)
+    version     = db.Column(db.BigInteger, nullable=False)
+    modified_at = db.Column(db.DateTime(timezone=True), nullable=False)
+
+class RequestCount(db.Model):
+    """The number of times a request was recently made to any process as
+    recorded by their access trackers. accept is the empty string for requests
+    without an Accept header. See trafficdb.warming.
+
+    """
+    __tablename__ = 'request_counts'
+
+    url_root    = db.Column(db.String, primary_key=True)
+    full_path   = db.Column(db.String, primary_key=True)
+    accept      = db.Column(db.String, primary_key=True)
+    count       = db.Column(db.BigInteger, nullable=False)
+
+class ObservationRollup(db.Model):
+    """Aggregated observation values for a link and type over a time bucket.
+    resolution is the width of the bucket in seconds and bucket is the start
+    of the bucket. See trafficdb.rollups.
+
+    """
+    __tablename__ = 'observation_rollups'
+
+    resolution  = db.Column(db.Integer, primary_key=True)
+    link_id     = db.Column(db.Integer, db.ForeignKey('links.id'), primary_key=True)
+    type        = db.Column(PythonEnum(ObservationType, name='observation_types'), primary_key=True)
+    bucket      = db.Column(db.DateTime(timezone=True), primary_key=True)
+    count       = db.Column(db.Integer, nullable=False)
+    sum         = db.Column(db.Float, nullable=False)
+    sum_sq      = db.Column(db.Float, nullable=False)
+    min         = db.Column(db.Float, nullable=False)
+    max         = db.Column(db.Float, nullable=False)
+
+# An index to enable removal of rollups in a time range when rebuilding
+db.Index('ix_observation_rollups_bucket', ObservationRollup.bucket)
+
+class ObservationRollupDirty(db.Model):
+    """Finest rollup buckets which have had observations ingested since
+    they were last refreshed.
+
+    """
+    __tablename__ = 'observation_rollup_dirty'
+
+    link_id     = db.Column(db.Integer, primary_key=True)
+    type        = db.Column(PythonEnum(ObservationType, name='observation_types'), primary_key=True)
+    bucket      = db.Column(db.DateTime(timezone=True), primary_key=True)
+
+class ObservationSketch(db.Model):
+    """A quantile sketch of observation values for a link and type over an
+    hour starting at bucket. means and weights are the sorted centroids of
+    the sketch. See trafficdb.sketches.
+
+    """
+    __tablename__ = 'observation_sketches'
+
+    link_id     = db.Column(db.Integer, db.ForeignKey('links.id'), primary_key=True)
+    type        = db.Column(PythonEnum(ObservationType, name='observation_types'), primary_key=True)
+    bucket      = db.Column(db.DateTime(timezone=True), primary_key=True)
+    means       = db.Column(pg.ARRAY(db.Float), nullable=False)
+    weights     = db.Column(pg.ARRAY(db.Integer), nullable=False)
+
+# An index to enable removal of sketches in a time range when rebuilding
+db.Index('ix_observation_sketches_bucket', ObservationSketch.bucket)
+
+class LinkProfile(db.Model):
+    """The typical-week profile of observation values for a link and type.
+    slot is the index of a 15 minute period of the week starting at midnight
+    on Monday in local time. See trafficdb.rollups.
+
+    """
+    __tablename__ = 'link_profiles'
+
+    link_id     = db.Column(db.Integer, db.ForeignKey('links.id'), primary_key=True)
+    type        = db.Column(PythonEnum(ObservationType, name='observation_types'), primary_key=True)
+    slot        = db.Column(db.SmallInteger, primary_key=True, autoincrement=False)
+    count       = db.Column(db.BigInteger, nullable=False)
+    sum         = db.Column(db.Float, nullable=False)
+    sum_sq      = db.Column(db.Float, nullable=False)
+
 class LinkAlias(db.Model):
     __tablename__ = 'link_aliases'
 
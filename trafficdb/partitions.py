@@ -0,0 +1,208 @@
+"""
+Observation partitions
+======================
+
+The observations table is range partitioned by month on observed_at. Each
+monthly partition is named ``observations_yYYYYmMM`` and holds observations
+from the start of that month up to, but not including, the start of the next
+month in UTC. Observations for which no monthly partition exists are stored in
+the default partition.
+
+Old observations are removed by detaching whole monthly partitions and either
+dropping them or moving them to an archive schema. This is far cheaper than
+deleting rows and does not leave the table bloated.
+
+"""
+import datetime
+import re
+
+import pytz
+from sqlalchemy import text
+
+# Name of the partition holding observations not covered by a monthly partition
+DEFAULT_PARTITION = 'observations_default'
+
+# Name of the optional BRIN index on observation times
+BRIN_INDEX = 'ix_observation_observed_at_brin'
+
+_PARTITION_NAME_RE = re.compile(r'^observations_y(\d{4})m(\d{2})$')
+
+_RETENTION_PERIOD_RE = re.compile(r'^(\d+)([dwmy])$')
+
+def as_utc(dt):
+    """Return dt as a timezone-aware datetime in UTC. Naive datetimes are
+    assumed to already be in UTC.
+
+    """
+    if dt.tzinfo is None:
+        return pytz.utc.localize(dt)
+    return dt.astimezone(pytz.utc)
+
+def month_start(dt):
+    """Return the start of the month containing dt in UTC."""
+    dt = as_utc(dt)
+    return datetime.datetime(dt.year, dt.month, 1, tzinfo=pytz.utc)
+
+def add_months(dt, months):
+    """Return the start of the month which is months after the month
+    containing dt. months may be negative.
+
+    """
+    dt = month_start(dt)
+    month_idx = dt.year * 12 + (dt.month - 1) + months
+    return datetime.datetime(month_idx // 12, (month_idx % 12) + 1, 1, tzinfo=pytz.utc)
+
+def partition_name(month):
+    """Return the name of the partition for the month containing month."""
+    month = month_start(month)
+    return 'observations_y{0:04d}m{1:02d}'.format(month.year, month.month)
+
+def observation_partitions(session):
+    """Return a list of (name, start, end) tuples for each monthly observation
+    partition ordered by start. The default partition is not included.
+
+    """
+    q = session.execute(text(
+        'SELECT c.relname FROM pg_inherits i '
+        'JOIN pg_class c ON c.oid = i.inhrelid '
+        'WHERE i.inhparent = \'observations\'::regclass'
+    ))
+
+    partitions = []
+    for name, in q:
+        match = _PARTITION_NAME_RE.match(name)
+        if match is None:
+            continue
+        start = datetime.datetime(
+            int(match.group(1)), int(match.group(2)), 1, tzinfo=pytz.utc)
+        partitions.append((name, start, add_months(start, 1)))
+
+    partitions.sort(key=lambda p: p[1])
+    return partitions
+
+def create_observation_partition(session, month):
+    """Create the partition for the month containing month if it does not
+    already exist. Any observations for that month in the default partition
+    are moved into the new partition. Returns the name of the partition if it
+    was created or None if it already existed.
+
+    """
+    name = partition_name(month)
+    start = month_start(month)
+    end = add_months(start, 1)
+
+    exists = session.execute(text('SELECT to_regclass(:name)'), dict(name=name)).scalar()
+    if exists is not None:
+        return None
+
+    # The partition is populated from the default partition before being
+    # attached since a partition may not be attached while the default
+    # partition holds rows in its range.
+    session.execute(text(
+        'CREATE TABLE ' + name + ' '
+        '(LIKE observations INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'
+    ))
+    session.execute(text(
+        'WITH moved AS ('
+        '    DELETE FROM ' + DEFAULT_PARTITION + ' '
+        '    WHERE observed_at >= :start AND observed_at < :end '
+        '    RETURNING *'
+        ') INSERT INTO ' + name + ' SELECT * FROM moved'
+    ), dict(start=start, end=end))
+    session.execute(text(
+        'ALTER TABLE observations ATTACH PARTITION ' + name + ' '
+        'FOR VALUES FROM (:start) TO (:end)'
+    ), dict(start=start, end=end))
+
+    return name
+
+def create_observation_partitions(session, start, end):
+    """Create partitions for each month from the month containing start up
+    to, but not including, the month starting at or after end. Returns a list
+    of the names of partitions which were created. The caller is responsible
+    for committing the session.
+
+    """
+    created = []
+    month = month_start(start)
+    while month < end:
+        name = create_observation_partition(session, month)
+        if name is not None:
+            created.append(name)
+        month = add_months(month, 1)
+    return created
+
+def set_brin_index(session, enabled):
+    """Create the BRIN index on observation times if enabled is True or
+    drop it otherwise. A BRIN index is a small fraction of the size of the
+    B-tree index ix_observation_observed_at on append-mostly, time-ordered
+    data. An index created on the partitioned table is created on every
+    partition including those created later. Returns True if the index was
+    created or dropped and False if it was already in the requested state.
+    The caller is responsible for committing the session.
+
+    """
+    exists = session.execute(text('SELECT to_regclass(:name)'),
+            dict(name=BRIN_INDEX)).scalar() is not None
+    if exists == enabled:
+        return False
+    if enabled:
+        session.execute(text(
+            'CREATE INDEX ' + BRIN_INDEX + ' ON observations USING brin (observed_at)'))
+    else:
+        session.execute(text('DROP INDEX ' + BRIN_INDEX))
+    return True
+
+def retention_cutoff(period, now=None):
+    """Return the datetime before which observations fall outside of the
+    retention period given as a string such as "90d", "6w", "18m" or "2y".
+    Periods in months or years are rounded to the start of a month so that
+    the cutoff is never later than the exact value. now defaults to the
+    current time. Raises ValueError if period cannot be parsed.
+
+    """
+    match = _RETENTION_PERIOD_RE.match(period.strip())
+    if match is None:
+        raise ValueError('Invalid retention period: {0}'.format(period))
+    count, unit = int(match.group(1)), match.group(2)
+
+    if now is None:
+        now = datetime.datetime.now(pytz.utc)
+    now = as_utc(now)
+
+    if unit == 'd':
+        return now - datetime.timedelta(days=count)
+    if unit == 'w':
+        return now - datetime.timedelta(weeks=count)
+    if unit == 'm':
+        return add_months(now, -count)
+    return add_months(now, -12*count)
+
+def expired_observation_partitions(session, cutoff):
+    """Return a list of (name, start, end) tuples for each monthly partition
+    which only holds observations from before cutoff.
+
+    """
+    return list(p for p in observation_partitions(session) if p[2] <= cutoff)
+
+def retain_observations(session, cutoff, archive_schema=None):
+    """Detach each monthly partition which only holds observations from
+    before cutoff. Detached partitions are dropped or, if archive_schema is
+    not None, moved into that schema. Observations in the default partition
+    are not affected. Returns a list of the names of detached partitions. The
+    caller is responsible for committing the session.
+
+    """
+    if archive_schema is not None:
+        session.execute(text('CREATE SCHEMA IF NOT EXISTS ' + archive_schema))
+
+    detached = []
+    for name, _, _ in expired_observation_partitions(session, cutoff):
+        session.execute(text('ALTER TABLE observations DETACH PARTITION ' + name))
+        if archive_schema is None:
+            session.execute(text('DROP TABLE ' + name))
+        else:
+            session.execute(text('ALTER TABLE ' + name + ' SET SCHEMA ' + archive_schema))
+        detached.append(name)
+
+    return detached
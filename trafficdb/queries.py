@@ -4,27 +4,230 @@ Query helper functions
 
 These queries are optimised to use available indices.
 
+Queries over observations compare observed_at against timezone-aware
+datetimes. Comparing a ``timestamp with time zone`` column against a
+``timestamp`` value requires a timezone conversion which prevents the planner
+from pruning monthly partitions when the query is planned.
+
 """
 import uuid
 
-from sqlalchemy import exc, func
+from sqlalchemy import BigInteger, case, cast, exc, extract, func
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.schema import MetaData
+from sqlalchemy.sql.expression import ClauseElement, Executable
 
 from .models import *
+from .partitions import as_utc
+
+try:
+    import numpy as np
+except ImportError: # pragma: no cover
+    # NumPy is optional and only required for observation_arrays()
+    np = None
+
+def _timestamp(column):
+    """Return an expression for the datetime column as a JavaScript
+    timestamp, i.e. integer milliseconds since the epoch, computed by the
+    database.
+
+    """
+    return cast(func.floor(extract('epoch', column) * 1000), BigInteger)
+
+# Observation time as a JavaScript timestamp
+observed_at_timestamp = _timestamp(Observation.observed_at)
+
+# Rollup bucket start as a JavaScript timestamp
+rollup_bucket_timestamp = _timestamp(ObservationRollup.bucket)
+
+def _bbox_filter(bbox):
+    """Return a filter clause matching links which intersect bbox, a
+    (min_lng, min_lat, max_lng, max_lat) tuple. The spatial index on link
+    geometry is used.
+
+    """
+    min_lng, min_lat, max_lng, max_lat = bbox
+    return func.ST_Intersects(Link.geom,
+            func.ST_MakeEnvelope(min_lng, min_lat, max_lng, max_lat, 4326))
+
+def _type_filter(type, column=Observation.type):
+    """Return a filter clause matching rows whose type column is type which
+    may be an ObservationType or a sequence of them.
+
+    """
+    if isinstance(type, ObservationType):
+        return column == type
+    return column.in_(list(type))
 
 def observations_for_link(session, link_id, type, min_datetime, max_datetime):
-    return session.query(Observation).filter_by(link_id=link_id, type=type).\
-            filter(Observation.observed_at >= min_datetime).\
-            filter(Observation.observed_at <= max_datetime).\
-            order_by(Observation.observed_at)
+    """A query for observations of a link in a time range. type may be an
+    ObservationType or a sequence of them. Observations are ordered by type
+    and then by time.
+
+    """
+    return session.query(Observation).filter_by(link_id=link_id).\
+            filter(_type_filter(type)).\
+            filter(Observation.observed_at >= as_utc(min_datetime)).\
+            filter(Observation.observed_at <= as_utc(max_datetime)).\
+            order_by(Observation.type, Observation.observed_at)
 
 def observations_for_links(session, link_ids, type, min_datetime, max_datetime):
-    return session.query(Observation).filter_by(type=type).\
+    """A query for observations of several links in a time range. type may
+    be an ObservationType or a sequence of them. As for
+    observations_for_link(), the range includes both ends. Observations are
+    ordered by link, type and then by time.
+
+    """
+    return session.query(Observation).filter(_type_filter(type)).\
             filter(Observation.link_id.in_(link_ids)).\
-            filter(Observation.observed_at >= min_datetime).\
-            filter(Observation.observed_at < max_datetime).\
-            order_by(Observation.link_id, Observation.observed_at)
+            filter(Observation.observed_at >= as_utc(min_datetime)).\
+            filter(Observation.observed_at <= as_utc(max_datetime)).\
+            order_by(Observation.link_id, Observation.type, Observation.observed_at)
+
+def observation_values(q):
+    """Restrict a query returned by observations_for_link() or
+    observations_for_links() to yield (type, timestamp, value) rows where
+    timestamp is a JavaScript timestamp. No ORM objects are created and the
+    timestamp conversion is performed by the database. The underlying
+    columns are included in the covering observation index and so rows may be
+    retrieved with an index-only scan.
+
+    """
+    return q.with_entities(Observation.type, observed_at_timestamp, Observation.value)
+
+def link_observation_values(q):
+    """As observation_values() but yields (link_id, type, timestamp, value)
+    rows. Useful with queries returned by observations_for_links().
+
+    """
+    return q.with_entities(Observation.link_id, Observation.type,
+            observed_at_timestamp, Observation.value)
+
+def rollups_for_link(session, link_id, type, resolution, min_datetime, max_datetime):
+    """A query for rollups of a link at resolution for buckets starting in a
+    time range. type may be an ObservationType or a sequence of them. Rollups
+    are ordered by type and then by time.
+
+    """
+    return session.query(ObservationRollup).\
+            filter_by(resolution=resolution, link_id=link_id).\
+            filter(_type_filter(type, ObservationRollup.type)).\
+            filter(ObservationRollup.bucket >= as_utc(min_datetime)).\
+            filter(ObservationRollup.bucket < as_utc(max_datetime)).\
+            order_by(ObservationRollup.type, ObservationRollup.bucket)
+
+def rollup_values(q):
+    """Restrict a query returned by rollups_for_link() to yield (type,
+    timestamp, mean, min, max) rows where timestamp is the JavaScript
+    timestamp of the start of the bucket.
+
+    """
+    return q.with_entities(ObservationRollup.type, rollup_bucket_timestamp,
+            ObservationRollup.sum / ObservationRollup.count,
+            ObservationRollup.min, ObservationRollup.max)
+
+def sketches_for_link(session, link_id, type, min_datetime, max_datetime):
+    """A query which returns (type, means, weights) rows for each hourly
+    quantile sketch of a link for hours starting in a time range. type may be
+    an ObservationType or a sequence of them. Rows are ordered by type and
+    then by time.
+
+    """
+    return session.query(ObservationSketch.type,
+                ObservationSketch.means, ObservationSketch.weights).\
+            filter_by(link_id=link_id).\
+            filter(_type_filter(type, ObservationSketch.type)).\
+            filter(ObservationSketch.bucket >= as_utc(min_datetime)).\
+            filter(ObservationSketch.bucket < as_utc(max_datetime)).\
+            order_by(ObservationSketch.type, ObservationSketch.bucket)
+
+def profile_for_link(session, link_id, type, slot=None):
+    """A query which returns (type, slot, count, mean, stddev) rows for each
+    slot of the typical-week profile of a link. type may be an
+    ObservationType or a sequence of them. If slot is not None, only that
+    slot is returned. stddev is the sample standard deviation and is None for
+    slots with fewer than two observations. Rows are ordered by type and then
+    by slot.
+
+    """
+    count = LinkProfile.count
+    variance = (LinkProfile.sum_sq - LinkProfile.sum * LinkProfile.sum / count) / (count - 1)
+    q = session.query(LinkProfile.type, LinkProfile.slot, count,
+                LinkProfile.sum / func.nullif(count, 0),
+                case([(count > 1, func.sqrt(func.greatest(variance, 0)))], else_=None)).\
+            filter_by(link_id=link_id).\
+            filter(_type_filter(type, LinkProfile.type))
+    if slot is not None:
+        q = q.filter(LinkProfile.slot == slot)
+    return q.order_by(LinkProfile.type, LinkProfile.slot)
+
+def latest_observation_values(session, type, bbox=None):
+    """A query which returns (link uuid, type, timestamp, value) rows for the
+    most recent observation of each link and type as maintained by ingest.
+    type may be an ObservationType or a sequence of them. If bbox is not None
+    only links intersecting the (min_lng, min_lat, max_lng, max_lat) box are
+    included. timestamp is a JavaScript timestamp.
+
+    """
+    q = session.query(Link.uuid, LatestObservation.type,
+                _timestamp(LatestObservation.observed_at), LatestObservation.value).\
+            join(Link, Link.id == LatestObservation.link_id).\
+            filter(_type_filter(type, LatestObservation.type))
+    if bbox is not None:
+        q = q.filter(_bbox_filter(bbox))
+    return q
+
+def snapshot_observation_values(session, type, at, tolerance, bbox=None):
+    """A query which returns (link uuid, type, timestamp, value) rows for the
+    last observation of each link and type at or before the datetime at and
+    less than the timedelta tolerance before it. type and bbox are as for
+    latest_observation_values().
+
+    DISTINCT ON picks the first row of each (link_id, type) group. All keys
+    are ordered descending so that the rows may be read by a backward scan
+    of the observation natural key index rather than sorted. Restricting
+    observation times to the tolerance window allows monthly partitions to
+    be pruned. A window reaching before the earliest datetime is not bounded
+    below.
+
+    """
+    at = as_utc(at)
+    q = session.query(Link.uuid, Observation.type, observed_at_timestamp, Observation.value).\
+            join(Link, Link.id == Observation.link_id).\
+            filter(_type_filter(type)).\
+            filter(Observation.observed_at <= at)
+    try:
+        q = q.filter(Observation.observed_at > at - tolerance)
+    except OverflowError:
+        pass
+    if bbox is not None:
+        q = q.filter(_bbox_filter(bbox))
+    return q.distinct(Observation.link_id, Observation.type).\
+            order_by(Observation.link_id.desc(), Observation.type.desc(),
+                    Observation.observed_at.desc())
+
+def observation_arrays(q):
+    """Execute a query returned by observations_for_link() or
+    observations_for_links() and return a dict mapping each ObservationType
+    present to a (timestamps, values) pair of NumPy arrays. timestamps is an
+    int64 array of JavaScript timestamps and values is a float64 array.
+    Requires NumPy.
+
+    """
+    if np is None:
+        raise RuntimeError('NumPy is required for observation_arrays()')
+
+    columns = {}
+    for type, timestamp, value in observation_values(q):
+        timestamps, values = columns.setdefault(type, ([], []))
+        timestamps.append(timestamp)
+        values.append(value)
+
+    return dict(
+        (type, (np.array(timestamps, dtype=np.int64), np.array(values, dtype=np.float64)))
+        for type, (timestamps, values) in columns.items()
+    )
 
 def observation_date_range(session):
     """A query which returns one row with the minimum (earliest) observation
@@ -34,6 +237,33 @@ def observation_date_range(session):
     return session.query(func.min(Observation.observed_at),
         func.max(Observation.observed_at))
 
+def cached_observation_date_range(session):
+    """A query which returns at most one row with the minimum (earliest)
+    observation date and the maximum (latest) observation date as maintained
+    by ingest. Unlike observation_date_range() this does not need to scan
+    the observations table.
+
+    """
+    return session.query(ObservationStats.earliest, ObservationStats.latest).\
+            filter(ObservationStats.id == 1)
+
+def links_for_uuids(session, link_uuids):
+    """A query which returns (id, uuid) rows for each link whose uuid is in
+    the sequence link_uuids. UUIDs which do not correspond to a link are
+    omitted.
+
+    """
+    return session.query(Link.id, Link.uuid).filter(Link.uuid.in_(list(link_uuids)))
+
+def links_for_aliases(session, aliases):
+    """A query which returns (name, link_id, link_uuid) rows for each link
+    alias whose name is in the sequence aliases. Names which do not
+    correspond to an alias are omitted.
+
+    """
+    return session.query(LinkAlias.name, Link.id, Link.uuid).join(Link).\
+            filter(LinkAlias.name.in_(list(aliases)))
+
 def prepare_resolve_link_aliases(session):
     """Must be called once before resolve_link_aliases in order to create a
     temporary table used by that query. Pass the return value from this
@@ -78,3 +308,26 @@ def resolve_link_aliases(session, aliases, temp_table):
             outerjoin(sub_q, temp_table.name == sub_q.c.name)
 
     return q
+
+# From https://bitbucket.org/zzzeek/sqlalchemy/wiki/UsageRecipes/Explain
+class explain(Executable, ClauseElement):
+    def __init__(self, stmt, analyze=False):
+        # Queries are converted into their underlying select statement
+        self.statement = getattr(stmt, 'statement', stmt)
+        self.analyze = analyze
+
+@compiles(explain, 'postgresql')
+def pg_explain(element, compiler, **kw):
+    text = "EXPLAIN "
+    if element.analyze:
+        text += "ANALYZE "
+    text += compiler.process(element.statement)
+    return text
+
+def query_plan(session, q, analyze=False):
+    """Return the lines of the query plan chosen by the planner for the
+    query q. If analyze is True the query is executed and the plan includes
+    actual timings.
+
+    """
+    return list(r[0] for r in session.execute(explain(q, analyze=analyze)))
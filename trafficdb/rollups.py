@@ -0,0 +1,474 @@
+"""
+Observation rollups
+===================
+
+Rollups hold the count, sum, sum of squares, minimum and maximum of
+observation values for each link and type over fixed-width time buckets.
+Buckets are aligned to the UNIX epoch and so to UTC days. The bucket widths,
+in seconds, are given by RESOLUTIONS. Each resolution is computed from the
+next finer one with the finest computed from raw observations. Reading
+rollups for long time ranges is therefore far cheaper than aggregating raw
+observations.
+
+Rollups are kept up to date incrementally. Ingest records the finest buckets
+touched by new observations in the observation_rollup_dirty table and
+refresh_rollups() recomputes those buckets, and the coarser buckets which
+contain them, at every resolution. rebuild_rollups() recomputes all rollups in
+a time range from scratch.
+
+Both replace rows by deleting and re-inserting them and so must not touch the
+same buckets concurrently. A refresh holds an exclusive transaction-level
+advisory lock until it commits. A rebuild holds the same lock shared, so that
+rebuilds of different days may run in parallel, and an exclusive lock for
+each day it rebuilds.
+
+Hourly quantile sketches in the observation_sketches table are maintained in
+the same way. Each sketch is computed by the database by dividing the sorted
+values of the hour into at most SKETCH_CENTROIDS groups, which are smallest
+in the tails, and recording the mean and size of each. See
+trafficdb.sketches.
+
+Typical-week profiles in the link_profiles table hold the count, sum and sum
+of squares of values for each link, type and 15 minute slot of the week in
+local time. A profile is the sum of all finest rollups falling within its
+slot. Whenever finest rollups are replaced, the difference between the new
+and old rollups is added to the profiles so that they are kept up to date
+without re-reading history. build_profiles() recomputes all profiles.
+
+refresh_rollups() defers bumping the change versions of the links whose
+rollups it recomputes until the session commits. rebuild_rollups() and
+build_profiles() rewrite history wholesale and their callers should bump the
+HISTORY version once all work is committed. See trafficdb.versions.
+
+The functions in this module execute SQL via the execute() method of their
+first argument and so accept either a session or a connection.
+
+"""
+import datetime
+
+import pytz
+from sqlalchemy import text
+
+from .coalesce import advisory_lock_key
+from .partitions import as_utc
+from .sketches import SKETCH_CENTROIDS
+from .versions import defer_link_versions
+
+# Rollup bucket widths in seconds from finest to coarsest
+RESOLUTIONS = (5*60, 60*60, 24*60*60)
+
+# Quantile sketch bucket width in seconds
+SKETCH_RESOLUTION = 60*60
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+# Width of a profile slot in seconds and the number of slots in a week
+PROFILE_SLOT = 15*60
+PROFILE_SLOTS = 7*24*60*60 // PROFILE_SLOT
+
+# Name of the temporary table holding dirty buckets being refreshed
+_CLAIMED_TABLE = 'tmp_observation_rollup_claimed'
+
+# Name of the temporary table holding changes to finest rollups which are yet
+# to be applied to profiles
+_PROFILE_DELTA_TABLE = 'tmp_link_profile_delta'
+
+# Advisory lock serialising refreshes and rebuilds
+_LOCK_KEY = advisory_lock_key('rollups')
+
+def _lock(session, key, shared=False):
+    """Hold the transaction-level advisory lock key, waiting for any
+    conflicting holder's transaction to end.
+
+    """
+    function = 'pg_advisory_xact_lock'
+    if shared:
+        function += '_shared'
+    session.execute(text('SELECT ' + function + '(:key)'), dict(key=key))
+
+def bucket_sql(column, resolution):
+    """Return an SQL expression for the start of the bucket of width
+    resolution seconds containing the time in column.
+
+    """
+    return 'to_timestamp(floor(extract(epoch FROM {0}) / {1}) * {1})'.format(
+            column, int(resolution))
+
+def bucket_start(dt, resolution):
+    """Return the start of the bucket of width resolution seconds containing
+    the datetime dt.
+
+    """
+    seconds = int((as_utc(dt) - _EPOCH).total_seconds())
+    return _EPOCH + datetime.timedelta(
+            seconds=seconds - (seconds % resolution))
+
+def profile_slot_sql(column):
+    """Return an SQL expression for the profile slot containing the time in
+    column. Slot 0 starts at midnight on Monday in the time zone given by the
+    :timezone bind parameter.
+
+    """
+    local = '({0} AT TIME ZONE :timezone)'.format(column)
+    return (
+        '((CAST(extract(isodow FROM {0}) AS integer) - 1) * {1} + '
+        'CAST(extract(hour FROM {0}) AS integer) * {2} + '
+        'CAST(extract(minute FROM {0}) AS integer) / {3})'
+    ).format(local, 24*60*60 // PROFILE_SLOT, 60*60 // PROFILE_SLOT,
+            PROFILE_SLOT // 60)
+
+def profile_slot(dt, timezone):
+    """Return the profile slot containing the datetime dt. timezone is the
+    name of the time zone of profile slots. This is the Python counterpart
+    of profile_slot_sql().
+
+    """
+    local = as_utc(dt).astimezone(pytz.timezone(timezone))
+    return (local.weekday() * (24*60*60 // PROFILE_SLOT) +
+            local.hour * (60*60 // PROFILE_SLOT) +
+            local.minute // (PROFILE_SLOT // 60))
+
+def mark_dirty_rollups(session, staging_table):
+    """Record the finest rollup buckets touched by the observations in the
+    table staging_table as needing to be refreshed.
+
+    """
+    session.execute(text(
+        'INSERT INTO observation_rollup_dirty (link_id, type, bucket) '
+        'SELECT DISTINCT link_id, type, ' +
+        bucket_sql('observed_at', RESOLUTIONS[0]) + ' '
+        'FROM ' + staging_table + ' '
+        'ON CONFLICT DO NOTHING'
+    ))
+
+def _prepare_profile_deltas(session):
+    """Create the temporary profile delta table if it does not exist."""
+    session.execute(text(
+        'CREATE TEMPORARY TABLE IF NOT EXISTS ' + _PROFILE_DELTA_TABLE + ' ('
+        '    link_id integer NOT NULL,'
+        '    type observation_types NOT NULL,'
+        '    bucket timestamp with time zone NOT NULL,'
+        '    count bigint NOT NULL,'
+        '    sum double precision NOT NULL,'
+        '    sum_sq double precision NOT NULL'
+        ')'
+    ))
+
+def _profile_delta_sql(statement_sql, alias, sign):
+    """Return the body of a WITH clause executing statement_sql, a DELETE
+    from or INSERT into observation_rollups referred to as alias, and
+    recording the affected rollups as profile deltas with the given sign.
+
+    """
+    returning = ', '.join(alias + '.' + c
+            for c in ('link_id', 'type', 'bucket', 'count', 'sum', 'sum_sq'))
+    negate = '-' if sign < 0 else ''
+    return (
+        'changed AS (' + statement_sql + ' RETURNING ' + returning + ') '
+        'INSERT INTO ' + _PROFILE_DELTA_TABLE + ' '
+        'SELECT link_id, type, bucket, ' + negate + 'count, ' +
+        negate + 'sum, ' + negate + 'sum_sq FROM changed'
+    )
+
+def _apply_profile_deltas(session, timezone):
+    """Add the recorded profile deltas to the profiles. Rows are upserted in
+    key order so that concurrent transactions cannot deadlock.
+
+    """
+    session.execute(text(
+        'INSERT INTO link_profiles (link_id, type, slot, count, sum, sum_sq) '
+        'SELECT link_id, type, ' + profile_slot_sql('bucket') + ', '
+        '    sum(count), sum(sum), sum(sum_sq) '
+        'FROM ' + _PROFILE_DELTA_TABLE + ' '
+        'GROUP BY 1, 2, 3 ORDER BY 1, 2, 3 '
+        'ON CONFLICT (link_id, type, slot) DO UPDATE SET '
+        '    count = link_profiles.count + EXCLUDED.count,'
+        '    sum = link_profiles.sum + EXCLUDED.sum,'
+        '    sum_sq = link_profiles.sum_sq + EXCLUDED.sum_sq'
+    ), dict(timezone=timezone))
+    session.execute(text('TRUNCATE ' + _PROFILE_DELTA_TABLE))
+
+def _replace_rollups(session, resolution, source_sql, dirty_sql):
+    """Replace rollups at resolution for the (link_id, type, bucket) rows
+    selected by dirty_sql with aggregates over source_sql. source_sql must
+    select (link_id, type, bucket, count, sum, sum_sq, min, max) rows already
+    aggregated at resolution. Changes to finest rollups are recorded as
+    profile deltas.
+
+    """
+    params = dict(resolution=resolution)
+    delete_sql = (
+        'DELETE FROM observation_rollups r USING dirty d '
+        'WHERE r.resolution = :resolution AND r.link_id = d.link_id '
+        'AND r.type = d.type AND r.bucket = d.bucket'
+    )
+    insert_sql = (
+        'INSERT INTO observation_rollups '
+        '    (resolution, link_id, type, bucket, '
+        '     count, sum, sum_sq, min, max) '
+        'SELECT :resolution, link_id, type, bucket, '
+        '    count, sum, sum_sq, min, max '
+        'FROM (' + source_sql + ') AS source'
+    )
+
+    if resolution != RESOLUTIONS[0]:
+        session.execute(text(
+            'WITH dirty AS (' + dirty_sql + ') ' + delete_sql
+        ), params)
+        session.execute(text(insert_sql), params)
+        return
+
+    session.execute(text(
+        'WITH dirty AS (' + dirty_sql + '), ' +
+        _profile_delta_sql(delete_sql, 'r', -1)
+    ), params)
+    session.execute(text(
+        'WITH ' + _profile_delta_sql(insert_sql, 'observation_rollups', 1)
+    ), params)
+
+def _sketch_sql(source_sql):
+    """Return SQL selecting (link_id, type, bucket, means, weights) sketch
+    rows for the (link_id, type, bucket, value) rows selected by source_sql.
+
+    Sorted values are grouped into at most SKETCH_CENTROIDS centroids by the
+    t-digest scale function k(q) = asin(2q - 1) / pi + 1/2 applied to the
+    quantile q at the centre of each value. Centroids span equal steps of k
+    and so are smallest in the tails.
+
+    """
+    window = 'PARTITION BY link_id, type, bucket'
+    quantile = (
+        '(CAST(row_number() OVER (' + window + ' ORDER BY value) '
+        'AS double precision) - 0.5) / count(*) OVER (' + window + ')'
+    )
+    return (
+        'SELECT link_id, type, bucket, '
+        '    array_agg(mean ORDER BY mean) AS means, '
+        '    array_agg(weight ORDER BY mean) AS weights '
+        'FROM ('
+        '    SELECT link_id, type, bucket, '
+        '        avg(value) AS mean, count(*) AS weight '
+        '    FROM ('
+        '        SELECT link_id, type, bucket, value, '
+        '            floor((asin(2 * ' + quantile + ' - 1) / pi() + 0.5) * ' +
+        str(SKETCH_CENTROIDS) + ') AS centroid '
+        '        FROM (' + source_sql + ') AS source'
+        '    ) AS grouped GROUP BY link_id, type, bucket, centroid'
+        ') AS centroids GROUP BY link_id, type, bucket'
+    )
+
+def _refresh_sketches(session):
+    """Recompute sketches for the hours containing the claimed dirty
+    buckets.
+
+    """
+    dirty_sql = (
+        'SELECT DISTINCT link_id, type, ' +
+        bucket_sql('bucket', SKETCH_RESOLUTION) + ' AS bucket '
+        'FROM ' + _CLAIMED_TABLE
+    )
+    session.execute(text(
+        'WITH dirty AS (' + dirty_sql + ') '
+        'DELETE FROM observation_sketches s USING dirty d '
+        'WHERE s.link_id = d.link_id AND s.type = d.type '
+        'AND s.bucket = d.bucket'
+    ))
+    session.execute(text(
+        'INSERT INTO observation_sketches '
+        '    (link_id, type, bucket, means, weights) ' +
+        _sketch_sql(
+            'WITH dirty AS (' + dirty_sql + ') '
+            'SELECT d.link_id, d.type, d.bucket, o.value '
+            'FROM dirty d JOIN observations o '
+            '    ON o.link_id = d.link_id AND o.type = d.type '
+            '    AND o.observed_at >= d.bucket '
+            '    AND o.observed_at < d.bucket + '
+            '        interval \'{0} seconds\''.format(SKETCH_RESOLUTION))
+    ))
+
+def refresh_rollups(session, profile_timezone='UTC'):
+    """Recompute all rollup buckets recorded as dirty, the sketches of the
+    hours containing them and the profiles of the slots containing them.
+    profile_timezone is the name of the time zone of profile slots. Returns
+    the number of finest buckets refreshed. The caller is responsible for
+    committing the session.
+
+    """
+    # Wait for concurrent refreshes and rebuilds to commit so that their
+    # replacements of the same buckets are seen
+    _lock(session, _LOCK_KEY)
+
+    # Claim the dirty buckets. Later refreshes will not see buckets claimed
+    # here.
+    session.execute(text(
+        'CREATE TEMPORARY TABLE IF NOT EXISTS ' + _CLAIMED_TABLE + ' ('
+        '    link_id integer NOT NULL,'
+        '    type observation_types NOT NULL,'
+        '    bucket timestamp with time zone NOT NULL'
+        ')'
+    ))
+    session.execute(text('TRUNCATE ' + _CLAIMED_TABLE))
+    result = session.execute(text(
+        'WITH claimed AS ('
+        '    DELETE FROM observation_rollup_dirty '
+        '    RETURNING link_id, type, bucket'
+        ') INSERT INTO ' + _CLAIMED_TABLE + ' '
+        'SELECT link_id, type, bucket FROM claimed'
+    ))
+    if result.rowcount == 0:
+        return 0
+
+    # Responses derived from the rollups of these links are now stale
+    defer_link_versions(session, _CLAIMED_TABLE)
+
+    _prepare_profile_deltas(session)
+    finest = RESOLUTIONS[0]
+    _replace_rollups(session, finest,
+        'SELECT d.link_id, d.type, d.bucket, count(o.value) AS count, '
+        '    sum(o.value) AS sum, sum(o.value * o.value) AS sum_sq, '
+        '    min(o.value) AS min, max(o.value) AS max '
+        'FROM ' + _CLAIMED_TABLE + ' d JOIN observations o '
+        '    ON o.link_id = d.link_id AND o.type = d.type '
+        '    AND o.observed_at >= d.bucket '
+        '    AND o.observed_at < d.bucket + interval \'{0} seconds\' '
+        'GROUP BY d.link_id, d.type, d.bucket'.format(finest),
+        'SELECT link_id, type, bucket FROM ' + _CLAIMED_TABLE)
+
+    for finer, coarser in zip(RESOLUTIONS[:-1], RESOLUTIONS[1:]):
+        dirty_sql = (
+            'SELECT DISTINCT link_id, type, ' +
+            bucket_sql('bucket', coarser) + ' AS bucket '
+            'FROM ' + _CLAIMED_TABLE
+        )
+        _replace_rollups(session, coarser,
+            'WITH dirty AS (' + dirty_sql + ') '
+            'SELECT d.link_id, d.type, d.bucket, sum(r.count) AS count, '
+            '    sum(r.sum) AS sum, sum(r.sum_sq) AS sum_sq, '
+            '    min(r.min) AS min, max(r.max) AS max '
+            'FROM dirty d JOIN observation_rollups r '
+            '    ON r.resolution = {0} AND r.link_id = d.link_id '
+            '    AND r.type = d.type '
+            '    AND r.bucket >= d.bucket '
+            '    AND r.bucket < d.bucket + interval \'{1} seconds\' '
+            'GROUP BY d.link_id, d.type, d.bucket'.format(finer, coarser),
+            dirty_sql)
+
+    _refresh_sketches(session)
+    _apply_profile_deltas(session, profile_timezone)
+
+    return result.rowcount
+
+def rebuild_rollups(session, start, end, profile_timezone='UTC'):
+    """Recompute all rollups and sketches for buckets between start and end
+    from raw observations and update profiles to match. start and end are
+    rounded outwards to the coarsest resolution. profile_timezone is as for
+    refresh_rollups(). The caller is responsible for committing the session
+    or connection.
+
+    """
+    coarsest = RESOLUTIONS[-1]
+    start = bucket_start(start, coarsest)
+    end = bucket_start(end - datetime.timedelta(microseconds=1), coarsest) + \
+            datetime.timedelta(seconds=coarsest)
+    params = dict(start=start, end=end)
+
+    # Exclude refreshes and rebuilds of the same days. Days are locked in
+    # order so that overlapping rebuilds cannot deadlock.
+    _lock(session, _LOCK_KEY, shared=True)
+    for day_start, _ in rebuild_rollup_ranges(start, end):
+        _lock(session, advisory_lock_key('rollups:' + day_start.isoformat()))
+
+    # Any dirty buckets in the range are rebuilt here
+    session.execute(text(
+        'DELETE FROM observation_rollup_dirty '
+        'WHERE bucket >= :start AND bucket < :end'
+    ), params)
+    _prepare_profile_deltas(session)
+    finest = RESOLUTIONS[0]
+    session.execute(text(
+        'WITH ' + _profile_delta_sql(
+            'DELETE FROM observation_rollups '
+            'WHERE resolution = :resolution '
+            'AND bucket >= :start AND bucket < :end',
+            'observation_rollups', -1)
+    ), dict(resolution=finest, **params))
+    session.execute(text(
+        'DELETE FROM observation_rollups '
+        'WHERE bucket >= :start AND bucket < :end'
+    ), params)
+    session.execute(text(
+        'DELETE FROM observation_sketches '
+        'WHERE bucket >= :start AND bucket < :end'
+    ), params)
+
+    session.execute(text(
+        'WITH ' + _profile_delta_sql(
+            'INSERT INTO observation_rollups '
+            '    (resolution, link_id, type, bucket, '
+            '     count, sum, sum_sq, min, max) '
+            'SELECT :resolution, link_id, type, ' +
+            bucket_sql('observed_at', finest) + ', '
+            '    count(value), sum(value), sum(value * value), '
+            '    min(value), max(value) '
+            'FROM observations '
+            'WHERE observed_at >= :start AND observed_at < :end '
+            'GROUP BY 1, 2, 3, 4',
+            'observation_rollups', 1)
+    ), dict(resolution=finest, **params))
+
+    for finer, coarser in zip(RESOLUTIONS[:-1], RESOLUTIONS[1:]):
+        session.execute(text(
+            'INSERT INTO observation_rollups '
+            '    (resolution, link_id, type, bucket, '
+            '     count, sum, sum_sq, min, max) '
+            'SELECT :resolution, link_id, type, ' +
+            bucket_sql('bucket', coarser) + ', '
+            '    sum(count), sum(sum), sum(sum_sq), min(min), max(max) '
+            'FROM observation_rollups '
+            'WHERE resolution = :finer AND bucket >= :start AND bucket < :end '
+            'GROUP BY 1, 2, 3, 4'
+        ), dict(resolution=coarser, finer=finer, **params))
+
+    session.execute(text(
+        'INSERT INTO observation_sketches '
+        '    (link_id, type, bucket, means, weights) ' +
+        _sketch_sql(
+            'SELECT link_id, type, ' +
+            bucket_sql('observed_at', SKETCH_RESOLUTION) + ' AS bucket, '
+            '    value '
+            'FROM observations '
+            'WHERE observed_at >= :start AND observed_at < :end')
+    ), params)
+
+    _apply_profile_deltas(session, profile_timezone)
+
+def rebuild_rollup_ranges(start, end):
+    """Return a list of (start, end) pairs dividing the time between start
+    and end into periods of the coarsest resolution. Each period may be
+    rebuilt independently and so in parallel.
+
+    """
+    coarsest = datetime.timedelta(seconds=RESOLUTIONS[-1])
+    ranges = []
+    period_start = bucket_start(start, RESOLUTIONS[-1])
+    while period_start < end:
+        ranges.append((period_start, period_start + coarsest))
+        period_start += coarsest
+    return ranges
+
+def build_profiles(session, profile_timezone='UTC'):
+    """Recompute all profiles from the finest rollups. This is only needed
+    if profile_timezone changes or to remove accumulated rounding error. The
+    caller is responsible for committing the session.
+
+    """
+    # Prevent concurrent refreshes from updating profiles while rebuilding
+    session.execute(text('LOCK TABLE link_profiles IN EXCLUSIVE MODE'))
+    session.execute(text('DELETE FROM link_profiles'))
+    session.execute(text(
+        'INSERT INTO link_profiles (link_id, type, slot, count, sum, sum_sq) '
+        'SELECT link_id, type, ' + profile_slot_sql('bucket') + ', '
+        '    sum(count), sum(sum), sum(sum_sq) '
+        'FROM observation_rollups WHERE resolution = :resolution '
+        'GROUP BY 1, 2, 3'
+    ), dict(resolution=RESOLUTIONS[0], timezone=profile_timezone))
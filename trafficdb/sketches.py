@@ -0,0 +1,99 @@
+"""
+Quantile sketches
+=================
+
+A quantile sketch summarises a set of values as a short list of (mean,
+weight) centroids sorted by mean. Values in the tails are held in small
+centroids and values near the median in larger ones so that extreme quantiles
+remain accurate. Sketches are mergeable: the centroids of several sketches
+together form a sketch of the union of their values. This is the approach of
+Dunning and Ertl's t-digest.
+
+Sketches of each link and type are stored per hour in the observation_sketches
+table. They are computed by the database alongside the rollups, see
+trafficdb.rollups. Stored centroids are sized by the t-digest scale function
+so that the tails of each hour are kept at high resolution. Sketches are
+merged here to answer quantile queries over any range of hours in time
+proportional to the number of hours rather than the number of observations.
+
+"""
+import math
+
+# Maximum number of centroids in each stored hourly sketch
+SKETCH_CENTROIDS = 32
+
+# Compression used when merging sketches. Larger values keep more centroids
+# and so give more accurate quantiles.
+DEFAULT_COMPRESSION = 100
+
+def merge_centroids(centroids, compression=DEFAULT_COMPRESSION):
+    """Merge an iterable of (mean, weight) centroids, typically the
+    concatenated centroids of several sketches, into a single sketch. Returns
+    a list of (mean, weight) pairs sorted by mean. The size of each merged
+    centroid is limited according to its quantile so that the tails are kept
+    at high resolution.
+
+    """
+    centroids = sorted((float(m), float(w)) for m, w in centroids if w > 0)
+    total = sum(w for _, w in centroids)
+    if total == 0:
+        return []
+
+    merged = []
+    mean, weight = centroids[0]
+    cumulative = 0.0
+    for next_mean, next_weight in centroids[1:]:
+        # Quantile at the centre of the centroid which would result from merging
+        q = (cumulative + 0.5 * (weight + next_weight)) / total
+        if weight + next_weight <= max(1.0, 4.0 * total * q * (1.0 - q) / compression):
+            mean += (next_mean - mean) * next_weight / (weight + next_weight)
+            weight += next_weight
+        else:
+            merged.append((mean, weight))
+            cumulative += weight
+            mean, weight = next_mean, next_weight
+    merged.append((mean, weight))
+
+    return merged
+
+def centroid_quantile(centroids, q):
+    """Estimate the q-th quantile, 0 <= q <= 1, of the values summarised by a
+    list of (mean, weight) centroids sorted by mean. Quantiles between the
+    centres of adjacent centroids are linearly interpolated. Returns None if
+    there are no centroids. Raises ValueError if q is out of range.
+
+    """
+    if q < 0 or q > 1 or math.isnan(q):
+        raise ValueError('Quantile must be between 0 and 1')
+    if len(centroids) == 0:
+        return None
+
+    total = sum(w for _, w in centroids)
+    target = q * total
+
+    # Find the pair of centroids whose centres bracket the target
+    cumulative = 0.0
+    prev_centre, prev_mean = None, None
+    for mean, weight in centroids:
+        centre = cumulative + 0.5 * weight
+        if target <= centre:
+            if prev_centre is None:
+                return mean
+            frac = (target - prev_centre) / (centre - prev_centre)
+            return prev_mean + frac * (mean - prev_mean)
+        prev_centre, prev_mean = centre, mean
+        cumulative += weight
+
+    return centroids[-1][0]
+
+def sketch_quantiles(sketches, qs, compression=DEFAULT_COMPRESSION):
+    """Merge an iterable of (means, weights) sketches and return a list of
+    the estimated value for each quantile in qs and the total weight as a
+    pair. Values are None if the sketches are empty.
+
+    """
+    centroids = []
+    for means, weights in sketches:
+        centroids.extend(zip(means, weights))
+    merged = merge_centroids(centroids, compression=compression)
+    return list(centroid_quantile(merged, q) for q in qs), int(sum(w for _, w in merged))
@@ -0,0 +1,127 @@
+"""
+Change versions
+===============
+
+Named counters in the change_versions table which are incremented, or
+"bumped", whenever the data they name is written. Responses derived from that
+data are identified by the versions they were read at and so a client or
+proxy holding a response may check whether it is still current by reading a
+handful of counters rather than repeating the query.
+
+The following names are used:
+
+* LINKS is bumped when links are created,
+* ALIASES is bumped when link aliases are created,
+* the name returned by link_aliases_version_name() for a link is bumped when
+  aliases of that link are created,
+* OBSERVATIONS is bumped on every ingest,
+* the name returned by link_version_name() for a link is bumped when
+  observations of that link are ingested or its rollups are refreshed, and
+* HISTORY is bumped when stored history is rewritten wholesale: when
+  observations are removed by retention, rollups are rebuilt or profiles are
+  built.
+
+A name which has never been bumped has version 0. Bumping locks the counter
+rows until the transaction ends. The rows bumped by a single call are locked
+in name order. A transaction which bumps several groups of names, such as an
+ingest which refreshes rollups, should defer them with defer_versions() or
+defer_link_versions(). Deferred names are bumped by a single statement when
+the session commits, so concurrent writers cannot deadlock and the rows are
+locked only briefly.
+
+"""
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
+from .models import *
+
+LINKS = 'links'
+ALIASES = 'aliases'
+OBSERVATIONS = 'observations'
+HISTORY = 'history'
+
+# Prefixes of the per-link version names
+_LINK_PREFIX = 'link:'
+_LINK_ALIASES_PREFIX = 'link-aliases:'
+
+# Key in Session.info of the set of deferred version names
+_DEFERRED_KEY = 'trafficdb.deferred_versions'
+
+def link_version_name(link_id):
+    """Return the observations version name of the link with primary key
+    link_id.
+
+    """
+    return _LINK_PREFIX + str(link_id)
+
+def link_aliases_version_name(link_id):
+    """Return the aliases version name of the link with primary key
+    link_id.
+
+    """
+    return _LINK_ALIASES_PREFIX + str(link_id)
+
+def _bump_sql(names_sql):
+    """Return SQL which bumps the versions named by the rows of the query
+    names_sql which must have a single text column named "name".
+
+    """
+    return (
+        'INSERT INTO change_versions (name, version, modified_at) '
+        'SELECT name, 1, now() FROM (' + names_sql + ') AS names ORDER BY name '
+        'ON CONFLICT (name) DO UPDATE SET '
+        '    version = change_versions.version + 1, modified_at = now()'
+    )
+
+def bump_versions(session, names):
+    """Bump each of the sequence of version names. The caller is responsible
+    for committing the session.
+
+    """
+    names = sorted(set(names))
+    if len(names) == 0:
+        return
+    session.execute(text(_bump_sql('SELECT unnest(CAST(:names AS text[])) AS name')),
+            dict(names=names))
+
+def defer_versions(session, names):
+    """Bump each of the sequence of version names when session commits."""
+    session.info.setdefault(_DEFERRED_KEY, set()).update(names)
+
+def defer_link_versions(session, table):
+    """Bump the version of each distinct link_id in table, e.g. the ingest
+    staging table, when session commits.
+
+    """
+    q = session.execute(text('SELECT DISTINCT link_id FROM ' + table))
+    defer_versions(session, list(link_version_name(link_id) for link_id, in q))
+
+def bump_deferred_versions(session):
+    """Bump the version names deferred on session now. This is called when
+    the session commits.
+
+    """
+    names = session.info.pop(_DEFERRED_KEY, None)
+    if names:
+        bump_versions(session, names)
+
+@event.listens_for(Session, 'before_commit')
+def _bump_deferred_on_commit(session):
+    bump_deferred_versions(session)
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_deferred_on_rollback(session):
+    session.info.pop(_DEFERRED_KEY, None)
+
+def get_versions(session, names):
+    """Return a dictionary mapping each of the sequence of version names to a
+    (version, modified_at) pair. modified_at is None for a name which has
+    never been bumped.
+
+    """
+    versions = dict((name, (0, None)) for name in names)
+    q = session.query(ChangeVersion.name, ChangeVersion.version, ChangeVersion.modified_at).\
+            filter(ChangeVersion.name.in_(list(versions.keys())))
+    for name, version, modified_at in q:
+        versions[name] = (version, modified_at)
+    return versions
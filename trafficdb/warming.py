@@ -0,0 +1,256 @@
+"""
+Cache warming
+=============
+
+Ingest bumps change versions and so makes cached responses for the links
+observed unreachable. The first request for each afterwards must query the
+database. To move that cost off the request path, the requests for the most
+popular responses are recorded by an AccessTracker in each process and a
+CacheWarmer repeats them in a background thread after each ingest so that the
+response cache is filled before clients ask.
+
+Each process handles only some of the requests and, unless the response cache
+is shared via memcached, has its own cache. The warmer therefore periodically
+flushes the requests its tracker recorded to the request_counts table with
+store_request_counts() and warms the hottest requests over all processes as
+returned by hottest_requests(). It warms at once when the process itself
+ingests and otherwise when polling change versions shows that another process
+has. The "cache warm" command warms the same requests on demand.
+
+Warming requests are made through the WSGI application itself and so are
+cached exactly as client requests would be. They are marked in the WSGI
+environment by WARMING_ENVIRON_KEY so that they are not themselves tracked.
+
+"""
+import heapq
+import logging
+import threading
+
+from sqlalchemy import text
+
+from .models import *
+from .versions import HISTORY, OBSERVATIONS, get_versions
+
+log = logging.getLogger(__name__)
+
+# WSGI environment key set on requests made by the warmer
+WARMING_ENVIRON_KEY = 'trafficdb.warming'
+
+# Change versions polled by the warmer to notice ingests by other processes
+_WARM_VERSIONS = (OBSERVATIONS, HISTORY)
+
+class AccessTracker(object):
+    """Counts requests keyed by (url_root, full_path, accept) tuples. Once
+    more than max_size distinct requests are tracked, all counts are halved
+    and requests whose count falls to zero are forgotten so that counts
+    favour recent requests. Safe for use by concurrent threads.
+
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, url_root, full_path, accept):
+        key = (url_root, full_path, accept)
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + 1
+            if len(self._counts) > self.max_size:
+                self._age()
+
+    def _age(self):
+        counts = {}
+        for key, count in self._counts.items():
+            if count > 1:
+                counts[key] = count // 2
+        self._counts = counts
+
+    def hottest(self, count):
+        """Return a list of the count most frequently made requests as
+        (url_root, full_path, accept) tuples, most frequent first.
+
+        """
+        with self._lock:
+            items = list(self._counts.items())
+        return list(key for key, _ in heapq.nlargest(count, items, key=lambda item: item[1]))
+
+    def drain(self):
+        """Return a dictionary mapping each request recorded since the last
+        drain as a (url_root, full_path, accept) tuple to its count and
+        forget them.
+
+        """
+        with self._lock:
+            counts, self._counts = self._counts, {}
+        return counts
+
+    def clear(self):
+        with self._lock:
+            self._counts = {}
+
+    def __len__(self):
+        return len(self._counts)
+
+def store_request_counts(session, counts):
+    """Add the counts of requests in counts, a dictionary as returned by
+    AccessTracker.drain(), to the request_counts table. Rows are locked in key
+    order so that concurrent processes cannot deadlock. The caller is
+    responsible for committing the session.
+
+    """
+    if len(counts) == 0:
+        return
+    merged = {}
+    for (url_root, full_path, accept), count in counts.items():
+        key = (url_root, full_path, accept or '')
+        merged[key] = merged.get(key, 0) + count
+    keys = sorted(merged)
+    session.execute(text(
+        'INSERT INTO request_counts (url_root, full_path, accept, count) '
+        'SELECT * FROM unnest('
+        '    CAST(:url_roots AS text[]), CAST(:full_paths AS text[]), '
+        '    CAST(:accepts AS text[]), CAST(:counts AS bigint[])'
+        ') AS counts (url_root, full_path, accept, count) '
+        'ORDER BY url_root, full_path, accept '
+        'ON CONFLICT (url_root, full_path, accept) DO UPDATE SET '
+        '    count = request_counts.count + EXCLUDED.count'
+    ), dict(
+        url_roots=list(key[0] for key in keys),
+        full_paths=list(key[1] for key in keys),
+        accepts=list(key[2] for key in keys),
+        counts=list(merged[key] for key in keys),
+    ))
+
+def age_request_counts(session, max_size):
+    """Age the request_counts table as AccessTracker ages its counts: if more
+    than max_size requests are counted, forget those made once and halve the
+    counts of the rest. This must be called in a transaction which has not
+    stored counts since it locks the table against concurrent writers. The
+    caller is responsible for committing the session.
+
+    """
+    session.execute(text('LOCK TABLE request_counts IN SHARE ROW EXCLUSIVE MODE'))
+    size = session.execute(text('SELECT count(*) FROM request_counts')).scalar()
+    if size <= max_size:
+        return
+    session.execute(text('DELETE FROM request_counts WHERE count <= 1'))
+    session.execute(text('UPDATE request_counts SET count = count / 2'))
+
+def hottest_requests(session, count):
+    """Return a list of the count most frequently made requests over all
+    processes as (url_root, full_path, accept) tuples, most frequent first.
+
+    """
+    q = session.query(RequestCount.url_root, RequestCount.full_path, RequestCount.accept).\
+            order_by(RequestCount.count.desc(), RequestCount.url_root,
+                    RequestCount.full_path, RequestCount.accept).\
+            limit(count)
+    return list((url_root, full_path, accept or None) for url_root, full_path, accept in q)
+
+def warm_requests(app, requests):
+    """Make each of the iterable of (url_root, full_path, accept) requests to
+    app in turn reading each response in full so that it is cached. Failures
+    are logged and skipped. Returns the number of successful requests.
+
+    """
+    client = app.test_client()
+    count = 0
+    for url_root, full_path, accept in requests:
+        headers = {'Accept': accept} if accept else {}
+        try:
+            response = client.get(full_path, base_url=url_root, headers=headers,
+                    environ_overrides={WARMING_ENVIRON_KEY: True})
+            response.get_data()
+        except Exception:
+            log.exception('Failed to warm {0}'.format(full_path))
+            continue
+        if response.status_code == 200:
+            count += 1
+    return count
+
+class CacheWarmer(object):
+    """Runs a background thread which every CACHE_WARM_INTERVAL seconds
+    flushes the requests recorded by tracker to the request_counts table and
+    polls change versions. The CACHE_WARM_COUNT hottest requests over all
+    processes are warmed when the versions have changed since the last poll
+    or trigger() has been called. Triggers received while warming cause one
+    further round of warming.
+
+    """
+    def __init__(self, app, tracker):
+        self.app = app
+        self.tracker = tracker
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._versions = None
+
+    def start(self):
+        """Start the background thread if it is not running. Returns
+        immediately.
+
+        """
+        if self.app.config['CACHE_WARM_COUNT'] <= 0:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='cache-warmer')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def trigger(self):
+        """Start warming in the background. Returns immediately."""
+        if self.app.config['CACHE_WARM_COUNT'] <= 0:
+            return
+        self.start()
+        self._event.set()
+
+    def flush(self):
+        """Store and age the requests recorded by tracker in the
+        request_counts table and commit.
+
+        """
+        counts = self.tracker.drain()
+        if len(counts) == 0:
+            return
+        store_request_counts(db.session, counts)
+        db.session.commit()
+        age_request_counts(db.session, self.app.config['ACCESS_TRACKER_SIZE'])
+        db.session.commit()
+
+    def warm(self):
+        """Flush and warm the hottest requests in the calling thread. Returns
+        the number of successful requests.
+
+        """
+        self.flush()
+        requests = hottest_requests(db.session, self.app.config['CACHE_WARM_COUNT'])
+        db.session.commit()
+        return warm_requests(self.app, requests)
+
+    def _poll(self):
+        """Return True if the polled change versions have changed since the
+        last call.
+
+        """
+        versions = get_versions(db.session, _WARM_VERSIONS)
+        db.session.commit()
+        changed = self._versions is not None and versions != self._versions
+        self._versions = versions
+        return changed
+
+    def _run(self):
+        while True:
+            triggered = self._event.wait(self.app.config['CACHE_WARM_INTERVAL'])
+            self._event.clear()
+            try:
+                with self.app.app_context():
+                    try:
+                        self.flush()
+                        changed = self._poll()
+                        if triggered or changed:
+                            self.warm()
+                    finally:
+                        db.session.remove()
+            except Exception:
+                log.exception('Cache warming failed')
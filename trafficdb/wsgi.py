@@ -18,6 +18,21 @@ def create_app():
     # Create migration helper
     migrate = Migrate(app, db)
 
+    # Create response cache and link id cache
+    from trafficdb.cache import LinkIdCache, create_response_cache
+    app.extensions['response_cache'] = create_response_cache(app.config)
+    app.extensions['link_id_cache'] = LinkIdCache(
+            app.config['LINK_ID_CACHE_SIZE'], app.config['LINK_ID_NEGATIVE_TTL'])
+
+    # Create per-process request coalescing locks
+    from trafficdb.coalesce import SingleFlight
+    app.extensions['single_flight'] = SingleFlight()
+
+    # Create access tracker and background cache warmer
+    from trafficdb.warming import AccessTracker, CacheWarmer
+    app.extensions['access_tracker'] = AccessTracker(app.config['ACCESS_TRACKER_SIZE'])
+    app.extensions['cache_warmer'] = CacheWarmer(app, app.extensions['access_tracker'])
+
     # Create blueprints
     import trafficdb.blueprint as bp
     for bp_name in bp.__all__: